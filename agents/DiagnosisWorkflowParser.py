@@ -8,14 +8,12 @@ from thefuzz import process
 
 from tools.Actions import Actions, is_valid_action
 from tools.utils import (
-    count_matches,
     count_radiology_modality_and_organ_matches,
-    REGION_EXACT_DICT,
-    REGION_SUBSTR_DICT,
-    MODALITY_EXACT_DICT,
-    MODALITY_SUBSTR_DICT,
-    MODALITY_SPECIAL_CASES_DICT,
+    MODALITY_MATCHER,
+    REGION_MATCHER,
     UNIQUE_MODALITY_TO_ORGAN_MAPPING,
+    ItemidLookup,
+    KeywordMatcher,
 )
 from agents.AgentAction import AgentAction
 from utils.nlp import (
@@ -23,9 +21,33 @@ from utils.nlp import (
     extract_keywords_nltk,
     convert_labs_to_itemid,
     remove_stop_words,
+    LabTestMatcher,
 )
 
 
+ACTION_REGEX = re.compile(
+    r"Action:([\s\S]*?)(?=[\.\n].*Input.*:|$)", flags=re.IGNORECASE
+)
+ACTION_INPUT_REGEX = re.compile(r"(Action )?Input:([\s\S]*)", flags=re.IGNORECASE)
+# Words removed from the lab tests action input
+LAB_TEST_FILLER_REGEXES = [
+    re.compile(rf"\b{word}\b", flags=re.IGNORECASE)
+    for word in ["order", "run", "level[s]?", "repeat", "check"]
+]
+AND_REGEX = re.compile(r"\band\b")
+# Commas that are not between parentheses
+LIST_SPLIT_REGEX = re.compile(r",\s*(?![^()]*\))")
+
+
+def lab_test_name_matcher(lab_test_mapping_df: pd.DataFrame) -> KeywordMatcher:
+    """Matcher of the lab test names that an action is checked against if it is not the name of a tool."""
+    lab_test_names = lab_test_mapping_df["label"].tolist()
+
+    # Remove single character tests (most importantly the test "I")
+    lab_test_names = [name for name in lab_test_names if len(name) > 1]
+    return KeywordMatcher(exact_dict={"names": lab_test_names})
+
+
 class InvalidActionError(Exception):
     """Raised when an invalid action or action_input is provided in the LLM output."""
 
@@ -42,6 +64,9 @@ class InvalidActionError(Exception):
 
 class DiagnosisWorkflowParser(AgentOutputParser):
     lab_test_mapping_df: pd.DataFrame
+    lab_test_matcher: LabTestMatcher = None
+    itemid_lookup: ItemidLookup = None
+    lab_test_name_matcher: KeywordMatcher = None
     custom_parsings: int = 0
     action: str = ""
     action_input: Union[List[str], Dict] = None
@@ -51,6 +76,16 @@ class DiagnosisWorkflowParser(AgentOutputParser):
     class Config:
         arbitrary_types_allowed = True
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Lookup structures of the lab test mapping are built once per parser, or shared by the agent executor factory
+        if self.lab_test_name_matcher is None:
+            self.lab_test_name_matcher = lab_test_name_matcher(self.lab_test_mapping_df)
+        if self.lab_test_matcher is None:
+            self.lab_test_matcher = LabTestMatcher(
+                self.lab_test_mapping_df, itemid_lookup=self.itemid_lookup
+            )
+
     def parse(self, llm_output: str) -> Union[AgentAction, AgentFinish]:
         self.llm_output = llm_output
         self.action_input = None
@@ -107,8 +142,7 @@ class DiagnosisWorkflowParser(AgentOutputParser):
         Parse the desired action from the LLM output. Keep track of custom parsings done. If no explicit action is given, return invalid tool
         """
         # Parse the desired action)
-        regex = r"Action:([\s\S]*?)(?=[\.\n].*Input.*:|$)"
-        match = re.search(regex, self.llm_output, flags=re.IGNORECASE)
+        match = ACTION_REGEX.search(self.llm_output)
 
         if match:
             self.action = match.group(1).strip()
@@ -154,17 +188,8 @@ class DiagnosisWorkflowParser(AgentOutputParser):
             # action_keywords = extract_keywords_spacy(action)
 
             # Check if imaging modality is directly given as action
-            modality_counts = count_matches(
-                self.action,
-                exact_dict=MODALITY_EXACT_DICT,
-                substr_dict=MODALITY_SUBSTR_DICT,
-                special_cases_dict=MODALITY_SPECIAL_CASES_DICT,
-            )
-            organ_counts = count_matches(
-                self.action,
-                exact_dict=REGION_EXACT_DICT,
-                substr_dict=REGION_SUBSTR_DICT,
-            )
+            modality_counts = MODALITY_MATCHER.count(self.action)
+            organ_counts = REGION_MATCHER.count(self.action)
 
             # Valid imaging keywords should make up more than 25% of the action keywords or else it is likely a false positive
             if sum(modality_counts.values()) + sum(organ_counts.values()) > 0.25 * len(
@@ -173,14 +198,7 @@ class DiagnosisWorkflowParser(AgentOutputParser):
                 self.action_input_prepend = self.action
                 self.action = "Imaging"
 
-            lab_test_names = self.lab_test_mapping_df["label"].tolist()
-
-            # Remove single character tests (most importantly the test "I")
-            lab_test_names = [name for name in lab_test_names if len(name) > 1]
-
-            lab_test_matches = count_matches(
-                self.action, exact_dict={"names": lab_test_names}
-            )
+            lab_test_matches = self.lab_test_name_matcher.count(self.action)
 
             # Valid lab tests should make up more than 25% of the action or else it is likely a false positive
             if sum(lab_test_matches.values()) > 0.25 * len(action_keywords):
@@ -221,8 +239,7 @@ class DiagnosisWorkflowParser(AgentOutputParser):
         Returns:
             bool: True if action input is found, False otherwise
         """
-        regex = r"(Action )?Input:([\s\S]*)"
-        match = re.search(regex, self.llm_output, flags=re.IGNORECASE)
+        match = ACTION_INPUT_REGEX.search(self.llm_output)
         if match or self.action_input_prepend:
             if match:
                 # Check if provided as 'Action Input' as instructed, or just 'Input'
@@ -278,25 +295,23 @@ class DiagnosisWorkflowParser(AgentOutputParser):
         """
 
         # Remove extra words from action input
-        for word in ["order", "run", "level[s]?", "repeat", "check"]:
+        for filler_regex in LAB_TEST_FILLER_REGEXES:
             change_check = self.action_input
-            self.action_input = re.sub(
-                rf"\b{word}\b", "", self.action_input, flags=re.IGNORECASE
-            )
+            self.action_input = filler_regex.sub("", self.action_input)
             if change_check != self.action_input:
                 self.custom_parsings += 1
 
         # Replace and with comma to be found when splitting
-        self.action_input = re.sub(r"\band\b", ",", self.action_input)
+        self.action_input = AND_REGEX.sub(",", self.action_input)
 
         # Replace new lines with comma to be found when splitting
-        self.action_input = re.sub(r"\n", ",", self.action_input)
+        self.action_input = self.action_input.replace("\n", ",")
 
         # Remove stop words from action input
         self.action_input = remove_stop_words(self.action_input)
 
         # Convert to list by splitting on comma (except when between parantheses)
-        self.action_input = re.split(r",\s*(?![^()]*\))", self.action_input)
+        self.action_input = LIST_SPLIT_REGEX.split(self.action_input)
 
         # Remove leading and trailing white spaces and remove entries that are only spaces (due to oxford comma replacement above)
         self.action_input = [
@@ -305,7 +320,7 @@ class DiagnosisWorkflowParser(AgentOutputParser):
 
         # Convert to canonical itemid found in dataset (identified through lab_test_mapping)
         self.action_input = convert_labs_to_itemid(
-            self.action_input, self.lab_test_mapping_df
+            self.action_input, self.lab_test_mapping_df, matcher=self.lab_test_matcher
         )
 
         # Remove repeated entries
@@ -321,16 +336,16 @@ class DiagnosisWorkflowParser(AgentOutputParser):
         """
 
         # Replace and with comma to be found when splitting
-        self.action_input = re.sub(r"\band\b", ",", self.action_input)
+        self.action_input = AND_REGEX.sub(",", self.action_input)
 
         # Replace new lines with comma to be found when splitting
-        self.action_input = re.sub(r"\n", ",", self.action_input)
+        self.action_input = self.action_input.replace("\n", ",")
 
         # Remove stop words from action input
         self.action_input = remove_stop_words(self.action_input)
 
         # Convert to list by splitting on comma (except when between parantheses)
-        self.action_input = re.split(r",\s*(?![^()]*\))", self.action_input)
+        self.action_input = LIST_SPLIT_REGEX.split(self.action_input)
 
         # Remove leading and trailing white spaces and remove entries that are only spaces (due to oxford comma replacement above)
         self.action_input = [
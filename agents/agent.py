@@ -1,4 +1,6 @@
 import pickle
+import sqlite3
+import threading
 from typing import List, Tuple, Union, Dict, Any
 from hashlib import sha256
 import pandas as pd
@@ -10,6 +12,7 @@ from langchain.agents.mrkl.base import ZeroShotAgent
 from langchain.schema.messages import BaseMessage
 from langchain.schema import AgentAction
 from langchain.callbacks import FileCallbackHandler
+from langchain.callbacks.base import BaseCallbackHandler
 
 
 from agents.prompts import (
@@ -19,24 +22,56 @@ from agents.prompts import (
     TOOL_USE_EXAMPLES,
     DIAG_CRIT_TOOL_USE_EXAMPLE,
 )
-from agents.DiagnosisWorkflowParser import DiagnosisWorkflowParser
+from agents.DiagnosisWorkflowParser import (
+    DiagnosisWorkflowParser,
+    lab_test_name_matcher,
+)
 from tools.Tools import (
     RunLaboratoryTests,
     RunImaging,
     DoPhysicalExamination,
     ReadDiagnosticCriteria,
 )
-from tools.utils import action_input_pretty_printer
-from utils.nlp import calculate_num_tokens, truncate_text
+from tools.utils import action_input_pretty_printer, ItemidLookup
+from utils.nlp import (
+    truncate_text,
+    LabTestMatcher,
+    TokenCounter,
+    prompt_segments,
+)
 
 STOP_WORDS = ["Observation:", "Observations:", "observation:", "observations:"]
 
 
 class TextSummaryCache:
-    def __init__(self):
+    """
+    Summaries of observations keyed on the hash of the observation. Without a path the cache lives as long as the
+    agent. With a path the summaries are also written to a SQLite file, so that they are shared by all patients of a
+    run and by later runs, e.g. for lab results and imaging reports that recur.
+
+    Args:
+        path (str): Path to the .db file. It is created if it does not exist.
+        namespace (str): Prefix of the hashed texts, e.g. the model name and summary prompt (see summary_cache_namespace),
+            so runs with different settings do not read each other's summaries
+    """
+
+    def __init__(self, path=None, namespace=""):
         self.cache = {}
+        self.namespace = namespace
+        self.connection = None
+        self.lock = None
+        if path:
+            self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.lock = threading.Lock()
+            with self.connection:
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS summaries (hash TEXT PRIMARY KEY, summary TEXT NOT NULL)"
+                )
 
     def hash_text(self, text):
+        if self.namespace:
+            text = f"{self.namespace}\n{text}"
         return sha256(text.encode()).hexdigest()
 
     def add_summary(self, text, summary):
@@ -44,15 +79,68 @@ class TextSummaryCache:
         if text_hash in self.cache:
             return
         self.cache[text_hash] = summary
+        if self.connection is not None:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO summaries VALUES (?, ?)",
+                    (text_hash, summary),
+                )
 
     def get_summary(self, text):
         text_hash = self.hash_text(text)
-        return self.cache.get(text_hash, None)
+        summary = self.cache.get(text_hash, None)
+        if summary is None and self.connection is not None:
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT summary FROM summaries WHERE hash = ?", (text_hash,)
+                ).fetchone()
+            if row is not None:
+                summary = self.cache[text_hash] = row[0]
+        return summary
+
+
+class TokenUsageCallbackHandler(BaseCallbackHandler):
+    """
+    Counts the prompt and completion tokens of all LLM calls of an agent with its token counter. Passed to the agent
+    for the summaries of observations and as callback when running the agent executor, so that it sees every call.
+
+    Args:
+        token_counter (TokenCounter): Token counter of the agent
+    """
+
+    def __init__(self, token_counter):
+        self.token_counter = token_counter
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_calls += len(prompts)
+        self.prompt_tokens += sum(
+            self.token_counter.count(prompt) for prompt in prompts
+        )
+
+    def on_llm_end(self, response, **kwargs):
+        self.completion_tokens += sum(
+            self.token_counter.count(generation.text, add_special_tokens=False)
+            for generations in response.generations
+            for generation in generations
+        )
+
+    def usage(self):
+        return {
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
 
 
 class CustomZeroShotAgent(ZeroShotAgent):
     lab_test_mapping_df: pd.DataFrame = None
+    itemid_lookup: ItemidLookup = None
     observation_summary_cache: TextSummaryCache = TextSummaryCache()
+    token_counter: TokenCounter = None
+    token_usage: TokenUsageCallbackHandler = None
     stop: List[str]
     max_context_length: int
     tags: Dict[str, str]
@@ -76,55 +164,53 @@ class CustomZeroShotAgent(ZeroShotAgent):
         full_inputs = {**kwargs, **new_inputs}
         return full_inputs
 
+    def get_token_counter(self) -> TokenCounter:
+        if self.token_counter is None:
+            self.token_counter = TokenCounter(self.llm_chain.llm.tokenizer)
+        return self.token_counter
+
     # Construct the running thoughts and observations of the model. Summarize the convo if we hit our token limit
     def _construct_scratchpad(
         self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any
     ) -> Union[str, List[BaseMessage]]:
         """Construct the scratchpad that lets the agent continue its thought process."""
-        thoughts = ""
+        # Every step is counted on its own, so only the newest step is tokenized in every turn
+        steps = []
         for action, observation in intermediate_steps:
-            thoughts += action.log
-            thoughts += f"{self.tags['ai_tag_end']}{self.tags['user_tag_start']}{self.observation_prefix}{observation.strip()}{self.tags['user_tag_end']}{self.tags['ai_tag_start']}{self.llm_prefix}"
-        if (
-            calculate_num_tokens(
-                self.llm_chain.llm.tokenizer,
-                [
-                    self.llm_chain.prompt.format(
-                        input=kwargs["input"],
-                        agent_scratchpad=thoughts,
-                    )
-                ],
+            steps.append(action.log)
+            steps.append(
+                f"{self.tags['ai_tag_end']}{self.tags['user_tag_start']}{self.observation_prefix}{observation.strip()}{self.tags['user_tag_end']}{self.tags['ai_tag_start']}{self.llm_prefix}"
             )
-            >= self.max_context_length - 100
-        ) and self.summarize:
+        thoughts = "".join(steps)
+        # Same as counting the whole prompt and comparing it with max_context_length - 100
+        too_long = self.get_token_counter().exceeds(
+            prompt_segments(
+                self.llm_chain.prompt.format,
+                input=kwargs["input"],
+                agent_scratchpad=steps,
+            ),
+            self.max_context_length - 101,
+        )
+        if too_long and self.summarize:
             thoughts = self._summarize_steps(intermediate_steps)
+            too_long = self.get_token_counter().exceeds(
+                prompt_segments(
+                    self.llm_chain.prompt.format,
+                    input=kwargs["input"],
+                    agent_scratchpad=thoughts,
+                ),
+                self.max_context_length - 101,
+            )
 
         # Worst worst case, we are still over or close to the limit even after summarizing and thus should truncate and force a diagnosis
-        if (
-            calculate_num_tokens(
-                self.llm_chain.llm.tokenizer,
-                [
-                    self.llm_chain.prompt.format(
-                        input=kwargs["input"],
-                        agent_scratchpad=thoughts,
-                    )
-                ],
-            )
-            >= self.max_context_length - 100
-        ):
-            prompt_and_input_tokens = calculate_num_tokens(
-                self.llm_chain.llm.tokenizer,
-                [
-                    self.llm_chain.prompt.format(
-                        input=kwargs["input"], agent_scratchpad=""
-                    )
-                ],
+        if too_long:
+            prompt_and_input_tokens = self.get_token_counter().count(
+                self.llm_chain.prompt.format(input=kwargs["input"], agent_scratchpad="")
             )
             # Could be that input is already over limit and we need to truncate input
             if prompt_and_input_tokens > self.max_context_length - 100:
-                prompt_tokens = calculate_num_tokens(
-                    self.llm_chain.llm.tokenizer,
-                    [self.llm_chain.prompt.format(input="", agent_scratchpad="")],
+                prompt_tokens = self.get_token_counter().count(
+                    self.llm_chain.prompt.format(input="", agent_scratchpad="")
                 )
                 kwargs["input"] = truncate_text(
                     self.llm_chain.llm.tokenizer,
@@ -145,18 +231,48 @@ class CustomZeroShotAgent(ZeroShotAgent):
 
     # Takes all tool requests and observations and summarizes them one-by-one
     def _summarize_steps(self, intermediate_steps):
-        prompt = PromptTemplate(
-            template=SUMMARIZE_OBSERVATION_TEMPLATE,
-            input_variables=["observation"],
-            partial_variables={
-                "system_tag_start": self.tags["system_tag_start"],
-                "system_tag_end": self.tags["system_tag_end"],
-                "user_tag_start": self.tags["user_tag_start"],
-                "user_tag_end": self.tags["user_tag_end"],
-                "ai_tag_start": self.tags["ai_tag_start"],
-            },
+        prompt = create_summarize_prompt(self.tags)
+        chain = LLMChain(
+            llm=self.llm_chain.llm,
+            prompt=prompt,
+            callbacks=[self.token_usage] if self.token_usage is not None else None,
         )
-        chain = LLMChain(llm=self.llm_chain.llm, prompt=prompt)
+
+        # Summarize all observations that are not cached yet at once. The LLM generates them as a batch, or sends
+        # them concurrently to the API
+        to_summarize = {}
+        for action, observation in intermediate_steps:
+            if (
+                action.tool in self.allowed_tools
+                and observation not in to_summarize
+                and self.observation_summary_cache.get_summary(observation) is None
+            ):
+                to_summarize[observation] = None
+        if to_summarize:
+            # Summary of each step should be minimal and should not exceed max_context_length
+            prompt_tokens = self.get_token_counter().count(
+                prompt.format(observation="")
+            )
+            results = chain.apply(
+                [
+                    {
+                        "observation": truncate_text(
+                            self.llm_chain.llm.tokenizer,
+                            observation,
+                            self.max_context_length
+                            - prompt_tokens
+                            - 100,  # Gives a max of 100 tokens to generate for the summary if we are near context length limit. Usually only used when model does really weird infinite generations of action inputs and doesnt hit a stop token so shouldnt be much actual info to summarize anyway
+                        ),
+                        "stop": [],
+                    }
+                    for observation in to_summarize
+                ]
+            )
+            for observation, result in zip(to_summarize, results):
+                self.observation_summary_cache.add_summary(
+                    observation, result[chain.output_key]
+                )
+
         summaries = []
         summaries.append("A summary of information I know thus far:")
         for indx, (action, observation) in enumerate(intermediate_steps):
@@ -172,30 +288,11 @@ class CustomZeroShotAgent(ZeroShotAgent):
                     summaries.append(
                         "Action Input: "
                         + action_input_pretty_printer(
-                            action.tool_input["action_input"], self.lab_test_mapping_df
+                            action.tool_input["action_input"],
+                            self.itemid_lookup or self.lab_test_mapping_df,
                         )
                     )
-                # Check cache to not re-summarize same observation
                 summary = self.observation_summary_cache.get_summary(observation)
-                if not summary:
-                    # Summary of each step should be minimal and should not exceed max_context_length
-                    prompt_tokens = calculate_num_tokens(
-                        self.llm_chain.llm.tokenizer,
-                        [
-                            prompt.format(observation=""),
-                        ],
-                    )
-
-                    observation = truncate_text(
-                        self.llm_chain.llm.tokenizer,
-                        observation,
-                        self.max_context_length
-                        - prompt_tokens
-                        - 100,  # Gives a max of 100 tokens to generate for the summary if we are near context length limit. Usually only used when model does really weird infinite generations of action inputs and doesnt hit a stop token so shouldnt be much actual info to summarize anyway
-                    )
-                    summary = chain.predict(observation=observation, stop=[])
-                    # Add to cache
-                    self.observation_summary_cache.add_summary(observation, summary)
                 summaries.append("Observation: " + summary)
             else:
                 # Include invalid requests in summary to not run into infinite loop of same invalid tool being ordered
@@ -216,6 +313,35 @@ class CustomZeroShotAgent(ZeroShotAgent):
         return "\n".join(summaries)
 
 
+def create_summarize_prompt(tags) -> PromptTemplate:
+    return PromptTemplate(
+        template=SUMMARIZE_OBSERVATION_TEMPLATE,
+        input_variables=["observation"],
+        partial_variables={
+            "system_tag_start": tags["system_tag_start"],
+            "system_tag_end": tags["system_tag_end"],
+            "user_tag_start": tags["user_tag_start"],
+            "user_tag_end": tags["user_tag_end"],
+            "ai_tag_start": tags["ai_tag_start"],
+        },
+    )
+
+
+def summary_cache_namespace(llm, tags, max_context_length):
+    """Namespace of the summaries on disk. Covers everything besides the observation that determines a summary: the
+    model, the summary prompt with its tags, the length observations are truncated to and the decoding.
+    """
+    decoding = "sampled" if getattr(llm, "self_consistency", False) else "greedy"
+    return "\n".join(
+        [
+            getattr(llm, "model_name", ""),
+            f"max_context_length={max_context_length}",
+            f"decoding={decoding}",
+            create_summarize_prompt(tags).format(observation=""),
+        ]
+    )
+
+
 def create_prompt(
     tags, tool_names, add_tool_descr, tool_use_examples
 ) -> PromptTemplate:
@@ -236,6 +362,154 @@ def create_prompt(
     return template
 
 
+class AgentExecutorFactory:
+    """
+    Builds the agent executors of a run. Everything that does not depend on the patient, i.e. the lab test mapping,
+    the prompt, the output parser and the LLM chain, is created once. build only binds the action results of a
+    patient to new tools and a new agent, so no state is carried over between patients. Executors can be built and run
+    in multiple threads at once, every thread gets its own output parser.
+
+    Example:
+        factory = AgentExecutorFactory(llm=llm, lab_test_mapping_path=..., ...)
+        for _id in hadm_info_clean:
+            agent_executor = factory.build(hadm_info_clean[_id])
+            # Callbacks passed to the call reach the LLM calls of the agent, those of the executor do not
+            agent_executor({"input": ...}, callbacks=[agent_executor.agent.token_usage])
+    """
+
+    def __init__(
+        self,
+        llm,
+        lab_test_mapping_path,
+        logfile,
+        max_context_length,
+        tags,
+        include_ref_range,
+        bin_lab_results,
+        include_tool_use_examples,
+        provide_diagnostic_criteria,
+        summarize,
+        model_stop_words,
+        summary_cache_path=None,
+    ):
+        with open(lab_test_mapping_path, "rb") as f:
+            self.lab_test_mapping_df = pickle.load(f)
+        self.itemid_lookup = ItemidLookup(self.lab_test_mapping_df)
+        self.max_context_length = max_context_length
+        self.tags = tags
+        self.include_ref_range = include_ref_range
+        self.bin_lab_results = bin_lab_results
+        self.provide_diagnostic_criteria = provide_diagnostic_criteria
+        self.summarize = summarize
+        self.stop = list(STOP_WORDS + model_stop_words)
+
+        self.tool_names = [tool.name for tool in self.create_tools({})]
+
+        # Go through options and see if we want to add any extra tools.
+        add_tool_use_examples = ""
+        add_tool_descr = ""
+        if provide_diagnostic_criteria:
+            add_tool_descr += DIAG_CRIT_TOOL_DESCR
+            add_tool_use_examples += DIAG_CRIT_TOOL_USE_EXAMPLE
+
+        # Create prompt
+        tool_use_examples = ""
+        if include_tool_use_examples:
+            tool_use_examples = TOOL_USE_EXAMPLES.format(
+                add_tool_use_examples=add_tool_use_examples
+            )
+        self.prompt = create_prompt(
+            tags, self.tool_names, add_tool_descr, tool_use_examples
+        )
+
+        # Output parsers keep the state of a single parse, so they are shared by the patients run in the same thread
+        self.lab_test_matcher = LabTestMatcher(
+            self.lab_test_mapping_df, itemid_lookup=self.itemid_lookup
+        )
+        self.lab_test_name_matcher = lab_test_name_matcher(self.lab_test_mapping_df)
+        self.thread_state = threading.local()
+
+        # Summaries on disk are shared by all patients, otherwise every agent starts with an empty cache. Sampled
+        # summaries are neither read from nor written to disk, as for the response cache of the LLM.
+        self.summary_cache = None
+        if summary_cache_path and not getattr(llm, "self_consistency", False):
+            self.summary_cache = TextSummaryCache(
+                summary_cache_path,
+                namespace=summary_cache_namespace(llm, tags, max_context_length),
+            )
+
+        # Initialize logging callback if file provided
+        self.handler = None
+        if logfile:
+            self.handler = [FileCallbackHandler(logfile)]
+
+        # LLM chain consisting of the LLM and a prompt
+        self.llm_chain = LLMChain(llm=llm, prompt=self.prompt, callbacks=self.handler)
+
+    @property
+    def output_parser(self):
+        if not hasattr(self.thread_state, "output_parser"):
+            self.thread_state.output_parser = DiagnosisWorkflowParser(
+                lab_test_mapping_df=self.lab_test_mapping_df,
+                itemid_lookup=self.itemid_lookup,
+                lab_test_matcher=self.lab_test_matcher,
+                lab_test_name_matcher=self.lab_test_name_matcher,
+            )
+        return self.thread_state.output_parser
+
+    def create_tools(self, patient):
+        # Define which tools the agent can use to answer user queries
+        tools = [
+            DoPhysicalExamination(action_results=patient),
+            RunLaboratoryTests(
+                action_results=patient,
+                lab_test_mapping_df=self.lab_test_mapping_df,
+                itemid_lookup=self.itemid_lookup,
+                include_ref_range=self.include_ref_range,
+                bin_lab_results=self.bin_lab_results,
+            ),
+            RunImaging(action_results=patient),
+        ]
+        if self.provide_diagnostic_criteria:
+            tools.append(ReadDiagnosticCriteria())
+        return tools
+
+    def build(self, patient):
+        tools = self.create_tools(patient)
+        # Counts are kept per patient, the static prompt is the only text shared between patients
+        token_counter = TokenCounter(self.llm_chain.llm.tokenizer)
+
+        # Create agent
+        agent = CustomZeroShotAgent(
+            llm_chain=self.llm_chain,
+            output_parser=self.output_parser,
+            stop=self.stop,
+            allowed_tools=self.tool_names,
+            verbose=True,
+            return_intermediate_steps=True,
+            max_context_length=self.max_context_length,
+            tags=self.tags,
+            lab_test_mapping_df=self.lab_test_mapping_df,
+            itemid_lookup=self.itemid_lookup,
+            summarize=self.summarize,
+            observation_summary_cache=self.summary_cache or TextSummaryCache(),
+            token_counter=token_counter,
+            token_usage=TokenUsageCallbackHandler(token_counter),
+        )
+
+        # Init agent executor
+        agent_executor = AgentExecutor.from_agent_and_tools(
+            agent=agent,
+            tools=tools,
+            verbose=True,
+            max_iterations=10,
+            return_intermediate_steps=True,
+            callbacks=self.handler,
+        )
+
+        return agent_executor
+
+
 def build_agent_executor_ZeroShot(
     patient,
     llm,
@@ -249,73 +523,21 @@ def build_agent_executor_ZeroShot(
     provide_diagnostic_criteria,
     summarize,
     model_stop_words,
+    summary_cache_path=None,
 ):
-    with open(lab_test_mapping_path, "rb") as f:
-        lab_test_mapping_df = pickle.load(f)
-
-    # Define which tools the agent can use to answer user queries
-    tools = [
-        DoPhysicalExamination(action_results=patient),
-        RunLaboratoryTests(
-            action_results=patient,
-            lab_test_mapping_df=lab_test_mapping_df,
-            include_ref_range=include_ref_range,
-            bin_lab_results=bin_lab_results,
-        ),
-        RunImaging(action_results=patient),
-    ]
-
-    # Go through options and see if we want to add any extra tools.
-    add_tool_use_examples = ""
-    add_tool_descr = ""
-    if provide_diagnostic_criteria:
-        tools.append(ReadDiagnosticCriteria())
-        add_tool_descr += DIAG_CRIT_TOOL_DESCR
-        add_tool_use_examples += DIAG_CRIT_TOOL_USE_EXAMPLE
-
-    tool_names = [tool.name for tool in tools]
-
-    # Create prompt
-    tool_use_examples = ""
-    if include_tool_use_examples:
-        tool_use_examples = TOOL_USE_EXAMPLES.format(
-            add_tool_use_examples=add_tool_use_examples
-        )
-    prompt = create_prompt(tags, tool_names, add_tool_descr, tool_use_examples)
-
-    # Create output parser
-    output_parser = DiagnosisWorkflowParser(lab_test_mapping_df=lab_test_mapping_df)
-
-    # Initialize logging callback if file provided
-    handler = None
-    if logfile:
-        handler = [FileCallbackHandler(logfile)]
-
-    # LLM chain consisting of the LLM and a prompt
-    llm_chain = LLMChain(llm=llm, prompt=prompt, callbacks=handler)
-
-    # Create agent
-    agent = CustomZeroShotAgent(
-        llm_chain=llm_chain,
-        output_parser=output_parser,
-        stop=list(STOP_WORDS + model_stop_words),
-        allowed_tools=tool_names,
-        verbose=True,
-        return_intermediate_steps=True,
+    # Builds a single executor. Use AgentExecutorFactory directly when running multiple patients
+    factory = AgentExecutorFactory(
+        llm=llm,
+        lab_test_mapping_path=lab_test_mapping_path,
+        logfile=logfile,
         max_context_length=max_context_length,
         tags=tags,
-        lab_test_mapping_df=lab_test_mapping_df,
+        include_ref_range=include_ref_range,
+        bin_lab_results=bin_lab_results,
+        include_tool_use_examples=include_tool_use_examples,
+        provide_diagnostic_criteria=provide_diagnostic_criteria,
         summarize=summarize,
+        model_stop_words=model_stop_words,
+        summary_cache_path=summary_cache_path,
     )
-
-    # Init agent executor
-    agent_executor = AgentExecutor.from_agent_and_tools(
-        agent=agent,
-        tools=tools,
-        verbose=True,
-        max_iterations=10,
-        return_intermediate_steps=True,
-        callbacks=handler,
-    )
-
-    return agent_executor
+    return factory.build(patient)
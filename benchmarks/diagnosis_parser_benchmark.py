@@ -0,0 +1,208 @@
+"""Compares the throughput of PathologyEvaluator.parse_diagnosis with precompiled patterns against the previous
+parser, which passed the patterns as strings to re and removed every extra section with its own re.sub.
+
+Both parsers run on synthetic predictions that combine the formats the custom parsing rules were written for, and
+must agree on the diagnosis and on whether custom parsing was needed.
+
+Run from the root of the repository with python -m benchmarks.diagnosis_parser_benchmark
+"""
+import argparse
+import random
+import re
+import time
+
+from evaluators.appendicitis_evaluator import AppendicitisEvaluator
+
+
+def parse_diagnosis_uncompiled(prediction):
+    # Previous implementation, returns the diagnosis and whether custom parsing was needed
+    custom_parsing = False
+    regex = r"(Final )?Diagnosis:([\s\S]*?)(?=[\.\n].*Treatment.*:|$)"
+    match = re.search(regex, prediction, flags=re.IGNORECASE)
+    if not match:
+        return "", False
+    if not match.group(1):
+        custom_parsing = True
+    diagnosis = match.group(2).strip()
+
+    modify_check = diagnosis
+    diagnosis = re.sub(r"^Based on.*:\n\n", "", diagnosis)
+    if modify_check != diagnosis:
+        custom_parsing = True
+
+    modify_check = diagnosis
+    for section in [
+        "rationale",
+        "note",
+        "recommendation",
+        "explanation",
+        "finding",
+        "other.*diagnos.*include",
+        "other.*diagnos.*considered(?: were)?",
+        "management",
+        "action",
+        "plan",
+        "reasoning",
+        "assessment",
+        "justification",
+        "tests",
+        "additional diagnoses",
+        "notification",
+        "impression",
+        "background",
+        "additional findings include",
+    ]:
+        diagnosis = re.sub(
+            rf"{section}[s]?:.*", "", diagnosis, flags=re.IGNORECASE | re.DOTALL
+        )
+    if modify_check != diagnosis:
+        custom_parsing = True
+
+    modify_check = diagnosis
+    match = re.search(r"^1\.(.*)", diagnosis, flags=re.MULTILINE)
+    if match:
+        diagnosis = match.group(1).strip()
+    if modify_check != diagnosis:
+        custom_parsing = True
+        diagnosis = re.sub(r"[-:].*", "", diagnosis)
+
+    modify_check = diagnosis
+    match = re.search(r"^\*(.*)", diagnosis, flags=re.MULTILINE)
+    if match:
+        diagnosis = match.group(1).strip()
+    if modify_check != diagnosis:
+        custom_parsing = True
+        diagnosis = re.sub(r"[-:] .*", "", diagnosis)
+
+    modify_check = diagnosis
+    diagnosis = re.sub(r"\n\n.*", "", diagnosis)
+    if modify_check != diagnosis:
+        custom_parsing = True
+
+    modify_check = diagnosis
+    match = re.search(
+        r".*?diagnosis[^.\n]*?\bis\b(.*?)[.\n]", diagnosis, flags=re.DOTALL
+    )
+    if match:
+        diagnosis = match.group(1).strip()
+    if modify_check != diagnosis:
+        custom_parsing = True
+
+    modify_check = diagnosis
+    diagnosis = re.sub(r".*?patient has", "", diagnosis, count=1, flags=re.DOTALL)
+    if modify_check != diagnosis:
+        custom_parsing = True
+
+    diagnoses = re.split(r"[,.\n]|(?:\s*\b(?:and|or|vs[.]?)\b\s*)", diagnosis)
+    diagnoses = [d for d in diagnoses if d != ""]
+    if len(diagnoses) > 1:
+        custom_parsing = True
+    diagnosis = diagnoses[0] if diagnoses else ""
+    return diagnosis.strip(), custom_parsing
+
+
+DIAGNOSES = [
+    "Acute appendicitis",
+    "Acute cholecystitis",
+    "Perforated diverticulitis",
+    "Gallstone pancreatitis",
+    "Small bowel obstruction",
+    "Ruptured appendix with abscess",
+]
+SECTIONS = [
+    "Rationale",
+    "Notes",
+    "Recommendation",
+    "Explanation",
+    "Findings",
+    "Other diagnoses to consider include",
+    "Other diagnoses considered were",
+    "Management",
+    "Plan",
+    "Reasoning",
+    "Assessment",
+    "Tests",
+    "Additional diagnoses",
+    "Impression",
+    "Background",
+    # Sections that contain other sections
+    "Other\ndiagnoses to consider include",
+    "Other notes: diagnoses include",
+    "Other findings and tests: diagnoses considered were",
+]
+EXPLANATIONS = [
+    "The patient presents with right lower quadrant pain and an elevated white blood cell count.",
+    "CT shows a dilated appendix - 9 mm: with periappendiceal fat stranding.",
+    "Lipase is elevated and ultrasound shows gallstones, or sludge in the gallbladder.",
+]
+
+
+def synthetic_prediction(rng):
+    diagnoses = rng.sample(DIAGNOSES, rng.randint(1, 3))
+    header = rng.choice(["Final Diagnosis:", "Diagnosis:", "final diagnosis:"])
+    if rng.random() < 0.2:
+        header += " Based on the findings, the diagnosis is:\n\n"
+    style = rng.randrange(6)
+    if style == 0:
+        body = " " + diagnoses[0]
+    elif style == 1:
+        body = "\n" + "\n".join(
+            f"{i + 1}. {d} - {rng.choice(EXPLANATIONS)}"
+            for i, d in enumerate(diagnoses)
+        )
+    elif style == 2:
+        body = "\n" + "\n".join(f"* {d}: likely" for d in diagnoses)
+    elif style == 3:
+        body = f" The most likely diagnosis is {diagnoses[0]}.\n"
+    elif style == 4:
+        body = f" The patient has {' and '.join(diagnoses)}"
+    else:
+        body = " " + " vs ".join(diagnoses) + "\n\n" + rng.choice(EXPLANATIONS)
+    for section in rng.sample(SECTIONS, rng.randint(0, 2)):
+        body += f"\n{section}: {rng.choice(EXPLANATIONS)}"
+    prediction = rng.choice(EXPLANATIONS) + "\n" + header + body
+    if rng.random() < 0.7:
+        prediction += "\nTreatment: " + rng.choice(
+            ["Appendectomy", "Cholecystectomy", "IV antibiotics and fluids"]
+        )
+    return prediction
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_predictions", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    predictions = [synthetic_prediction(rng) for _ in range(args.num_predictions)]
+
+    # Creating the evaluators is not part of parsing, so they are created beforehand
+    evaluators = [AppendicitisEvaluator() for _ in range(len(predictions))]
+    start = time.perf_counter()
+    for evaluator, prediction in zip(evaluators, predictions):
+        evaluator.parse_diagnosis(prediction)
+    compiled_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    uncompiled = [parse_diagnosis_uncompiled(p) for p in predictions]
+    uncompiled_time = time.perf_counter() - start
+
+    compiled = [
+        (e.answers["Diagnosis"], e.scores["Diagnosis Parsing"] == 1) for e in evaluators
+    ]
+    assert compiled == uncompiled
+    num_custom = sum(custom for _, custom in compiled)
+
+    print("{} predictions, {} with custom parsing".format(len(predictions), num_custom))
+    for name, seconds in [("Uncompiled", uncompiled_time), ("Compiled", compiled_time)]:
+        print(
+            "{:<12} {:8.2f} s, {:10.0f} predictions/s".format(
+                name, seconds, len(predictions) / seconds
+            )
+        )
+    print("Speedup: {:.1f}x".format(uncompiled_time / compiled_time))
+
+
+if __name__ == "__main__":
+    main()
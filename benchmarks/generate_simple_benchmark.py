@@ -0,0 +1,190 @@
+"""Compares the generation loop of ExLlamaV2BaseGenerator.generate_simple against the previous loop, which grew the
+sequence and probabilities with torch.cat and copied the full logits of every step for sampling.
+
+A lookup table of random logits stands in for ExLlamaV2, so the times only include the overhead of the generation
+loop around the forward pass. Pass --device cuda to include the copies of the logits from the GPU.
+
+Run from the root of the repository with python -m benchmarks.generate_simple_benchmark
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+import torch
+from loguru import logger
+
+from models.exllamav2_generator_base_custom import ExLlamaV2BaseGenerator
+
+
+class RandomModel:
+    def __init__(self, vocab_size, max_seq_len, device, num_rows=256, seed=0):
+        # Logits of the next token are looked up from a small table, so the forward pass costs almost nothing
+        generator = torch.Generator().manual_seed(seed)
+        self.logits = torch.randn((num_rows, 1, vocab_size), generator=generator)
+        self.logits = self.logits.half().to(device)
+        self.config = SimpleNamespace(max_seq_len=max_seq_len)
+        self.device = device
+
+    def forward(
+        self, input_ids, cache, input_mask=None, preprocess_only=False, loras=None
+    ):
+        cache.current_seq_len += input_ids.shape[-1]
+        if preprocess_only:
+            return None
+        return self.logits[input_ids[:, -1].to(self.device) % len(self.logits)]
+
+
+class RandomTokenizer:
+    def __init__(self, vocab_size):
+        self.vocab_size = vocab_size
+
+    def encode(self, prompt, encode_special_tokens=True):
+        return torch.tensor(
+            [[3 + ord(char) % (self.vocab_size - 3) for char in prompt]]
+        )
+
+
+def greedy_settings():
+    # Same as ExLlamaV2Sampler.Settings().greedy_clone()
+    return SimpleNamespace(
+        top_k=1,
+        temperature=0.9,
+        token_repetition_penalty=1.15,
+        token_repetition_range=-1,
+        token_repetition_decay=0,
+        token_bias=None,
+        mirostat=False,
+        filters=[],
+        begin_filters=lambda prefix: None,
+        feed_filters=lambda token: None,
+    )
+
+
+def sample_greedy_cpu(logits, settings, sequence_ids):
+    # Greedy sampling as done by ExLlamaV2Sampler.sample on the CPU, including the repetition penalty over the sequence
+    logits = logits.clone().squeeze(1)
+    seen_tokens = torch.zeros(logits.shape, dtype=torch.bool)
+    seen_tokens.scatter_(1, sequence_ids, True)
+    penalty = settings.token_repetition_penalty
+    logits = torch.where(
+        seen_tokens,
+        torch.where(logits > 0, logits / penalty, logits * penalty),
+        logits,
+    )
+    token = logits[:, 1:].argmax(dim=-1, keepdim=True) + 1
+    probabilities = torch.softmax(logits / settings.temperature, dim=-1)
+    return token, probabilities.gather(1, token), False
+
+
+def generate_concatenating(generator, prompt, settings, num_tokens, stop_criteria):
+    # Previous generation loop
+    ids = generator.tokenizer.encode(prompt)
+    generator._gen_begin_base(ids)
+    probabilities_sequence = torch.empty((1, 0))
+    for _ in range(num_tokens):
+        logits = (
+            generator.model.forward(generator.sequence_ids[:, -1:], generator.cache)
+            .float()
+            .cpu()
+        )
+        token, probabilities, eos = sample_greedy_cpu(
+            logits, settings, generator.sequence_ids
+        )
+        generator.sequence_ids = torch.cat([generator.sequence_ids, token], dim=1)
+        probabilities_sequence = torch.cat(
+            [probabilities_sequence, probabilities], dim=1
+        )
+        if stop_criteria(generator.sequence_ids, None):
+            break
+        if eos:
+            break
+    return generator.sequence_ids, probabilities_sequence
+
+
+def time_generation(function, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = function()
+    return (time.perf_counter() - start) / repeats, output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_size", type=int, default=32000)
+    parser.add_argument("--prompt_length", type=int, default=2048)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    model = RandomModel(args.vocab_size, 8192, args.device)
+    tokenizer = RandomTokenizer(args.vocab_size)
+    generator = ExLlamaV2BaseGenerator(
+        model, SimpleNamespace(current_seq_len=0), tokenizer
+    )
+    # Only measure the generation loop
+    generator.reuse_cache = False
+    generator.greedy_sampling = True
+    logger.disable("models")
+    never_stop = lambda input_ids, scores: False  # noqa: E731
+
+    random.seed(0)
+    prompt = "".join(
+        random.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(args.prompt_length)
+    )
+    settings = greedy_settings()
+
+    # Warm up
+    generator.generate_simple(
+        prompt, gen_settings=settings, num_tokens=64, stop_criteria=never_stop
+    )
+
+    for num_tokens in [1024, 2048]:
+        concatenating_time, (expected_ids, expected_probabilities) = time_generation(
+            lambda: generate_concatenating(
+                generator, prompt, settings, num_tokens, never_stop
+            ),
+            args.repeats,
+        )
+        preallocated_time, (sequence_ids, probabilities) = time_generation(
+            lambda: generator.generate_simple(
+                prompt,
+                gen_settings=settings,
+                num_tokens=num_tokens,
+                stop_criteria=never_stop,
+            ),
+            args.repeats,
+        )
+        no_probabilities_time, _ = time_generation(
+            lambda: generator.generate_simple(
+                prompt,
+                gen_settings=settings,
+                num_tokens=num_tokens,
+                stop_criteria=never_stop,
+                collect_probabilities=False,
+            ),
+            args.repeats,
+        )
+        assert torch.equal(sequence_ids, expected_ids)
+        assert torch.allclose(probabilities, expected_probabilities)
+
+        print(
+            "{} generated tokens after a {} token prompt".format(
+                num_tokens, len(prompt)
+            )
+        )
+        for name, seconds in [
+            ("torch.cat", concatenating_time),
+            ("Preallocated", preallocated_time),
+            ("No probs", no_probabilities_time),
+        ]:
+            print(
+                "{:<14} {:8.1f} ms, {:8.0f} tokens/s".format(
+                    name, 1000 * seconds, num_tokens / seconds
+                )
+            )
+        print("Speedup: {:.1f}x".format(concatenating_time / preallocated_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Compares per-admission extraction of lab events by boolean masking against a HadmIndex.
+
+Run from the root of the repository with python -m benchmarks.hadm_index_benchmark
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from dataset.labs import parse_lab_events
+from dataset.utils import HadmIndex, select_hadm
+
+
+def synthetic_lab_events(num_admissions, rows_per_admission, seed=0):
+    rng = np.random.default_rng(seed)
+    n = num_admissions * rows_per_admission
+    hadm_ids = (20000000 + rng.integers(0, num_admissions, size=n)).astype(float)
+    # Some events are not assigned to an admission, as in MIMIC
+    hadm_ids[rng.random(n) < 0.3] = np.nan
+    return pd.DataFrame(
+        {
+            "subject_id": rng.integers(10000000, 10100000, size=n),
+            "hadm_id": hadm_ids,
+            "itemid": rng.integers(50800, 51000, size=n),
+            "charttime": pd.Timestamp("2150-01-01")
+            + pd.to_timedelta(rng.integers(0, 10**6, size=n), unit="m"),
+            "valuestr": rng.normal(10, 3, size=n).round(1).astype(str),
+            "ref_range_lower": 4.0,
+            "ref_range_upper": 11.0,
+        }
+    )
+
+
+def time_extraction(lab_events, hadm_ids, extractor=parse_lab_events):
+    start = time.perf_counter()
+    for _id in hadm_ids:
+        extractor(lab_events, _id)
+    return time.perf_counter() - start
+
+
+def report(name, total_time, num_queries, num_admissions, build_time=0.0):
+    print(
+        "{:<32} {:8.3f} ms per admission, {:8.1f} s for all admissions (+{:.2f} s to build)".format(
+            name,
+            1000 * total_time / num_queries,
+            total_time * num_admissions / num_queries,
+            build_time,
+        )
+    )
+    return total_time * num_admissions / num_queries + build_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_admissions", type=int, default=100_000)
+    parser.add_argument("--rows_per_admission", type=int, default=20)
+    parser.add_argument(
+        "--num_queries",
+        type=int,
+        default=500,
+        help="Number of admissions extracted. Timings are extrapolated to all admissions.",
+    )
+    args = parser.parse_args()
+
+    lab_events = synthetic_lab_events(args.num_admissions, args.rows_per_admission)
+    rng = np.random.default_rng(1)
+    hadm_ids = 20000000 + rng.choice(args.num_admissions, args.num_queries, False)
+    print(
+        "{} lab events, {} admissions, extracting {} admissions".format(
+            len(lab_events), args.num_admissions, args.num_queries
+        )
+    )
+
+    start = time.perf_counter()
+    index = HadmIndex(lab_events)
+    build_time = time.perf_counter() - start
+
+    # Both approaches must select the same rows
+    for _id in hadm_ids[:10]:
+        assert parse_lab_events(lab_events, _id) == parse_lab_events(index, _id)
+
+    def report_speedup(extractor, name):
+        mask_total = report(
+            "Boolean mask " + name,
+            time_extraction(lab_events, hadm_ids, extractor),
+            args.num_queries,
+            args.num_admissions,
+        )
+        index_total = report(
+            "HadmIndex " + name,
+            time_extraction(index, hadm_ids, extractor),
+            args.num_queries,
+            args.num_admissions,
+            build_time,
+        )
+        print("Speedup: {:.1f}x".format(mask_total / index_total))
+
+    report_speedup(select_hadm, "(selection)")
+    report_speedup(parse_lab_events, "(parse_lab_events)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compares formatting a lab panel with itemid_to_field on the lab test mapping DataFrame against an ItemidLookup.
+
+Run from the root of the repository with python -m benchmarks.lab_panel_benchmark
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from tools.utils import ItemidLookup, action_input_pretty_printer
+from utils.nlp import create_lab_test_string
+
+
+def synthetic_lab_test_mapping(num_itemids, seed=0):
+    rng = np.random.default_rng(seed)
+    itemids = 50000 + np.arange(num_itemids)
+    return pd.DataFrame(
+        {
+            "label": ["Lab Test {}".format(i) for i in range(num_itemids)],
+            "fluid": rng.choice(["Blood", "Urine", "Ascites", "Pleural"], num_itemids),
+            "itemid": itemids,
+            "corresponding_ids": [[itemid] for itemid in itemids],
+        }
+    )
+
+
+def synthetic_patient(itemids, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(10, 3, size=len(itemids)).round(1)
+    return {
+        "Laboratory Tests": {
+            itemid: "{} mg/dL".format(value) for itemid, value in zip(itemids, values)
+        },
+        "Microbiology": {},
+        "Reference Range Lower": {itemid: 4.0 for itemid in itemids},
+        "Reference Range Upper": {itemid: 11.0 for itemid in itemids},
+    }
+
+
+def format_panel(itemids, lab_test_mapping, patient):
+    panel = action_input_pretty_printer(itemids, lab_test_mapping) + "\n"
+    for itemid in itemids:
+        panel += create_lab_test_string(
+            itemid, lab_test_mapping, patient, include_ref_range=True
+        )
+    return panel
+
+
+def time_formatting(itemids, lab_test_mapping, patient, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        format_panel(itemids, lab_test_mapping, patient)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--num_itemids",
+        type=int,
+        default=2000,
+        help="Number of rows of the lab test mapping",
+    )
+    parser.add_argument("--panel_size", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    lab_test_mapping_df = synthetic_lab_test_mapping(args.num_itemids)
+    rng = np.random.default_rng(1)
+    itemids = [
+        int(itemid)
+        for itemid in rng.choice(
+            lab_test_mapping_df["itemid"], args.panel_size, replace=False
+        )
+    ]
+    patient = synthetic_patient(itemids)
+
+    start = time.perf_counter()
+    itemid_lookup = ItemidLookup(lab_test_mapping_df)
+    build_time = time.perf_counter() - start
+
+    # Both lookups must format the same panel
+    assert format_panel(itemids, lab_test_mapping_df, patient) == format_panel(
+        itemids, itemid_lookup, patient
+    )
+
+    df_time = time_formatting(itemids, lab_test_mapping_df, patient, args.repeats)
+    lookup_time = time_formatting(itemids, itemid_lookup, patient, args.repeats)
+    print(
+        "{} lab tests, mapping with {} itemids".format(
+            args.panel_size, args.num_itemids
+        )
+    )
+    print("{:<12} {:8.3f} ms per panel".format("DataFrame", 1000 * df_time))
+    print(
+        "{:<12} {:8.3f} ms per panel (+{:.1f} ms to build once)".format(
+            "ItemidLookup", 1000 * lookup_time, 1000 * build_time
+        )
+    )
+    print("Speedup: {:.1f}x".format(df_time / lookup_time))
+
+
+if __name__ == "__main__":
+    main()
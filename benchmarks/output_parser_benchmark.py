@@ -0,0 +1,103 @@
+"""Measures the throughput of DiagnosisWorkflowParser on LLM outputs logged by earlier runs.
+
+The outputs are the logs of all actions in the intermediate steps of results logs written by run.py or
+run_sharded.py, or of results pickles of earlier runs. Without results files, a small set of typical outputs is used.
+The parser is timed when it is reused for all outputs, as in the agents, when the stop words are loaded again for every
+output, as remove_stop_words did before, and when a new parser is created for every output.
+
+Run from the root of the repository with
+python -m benchmarks.output_parser_benchmark --lab_test_mapping_path <path> <results.jsonl.zst> [...]
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from agents.DiagnosisWorkflowParser import DiagnosisWorkflowParser
+from utils.results_log import read_results
+from utils.nlp import stop_word_sets
+
+SAMPLE_OUTPUTS = [
+    "Thought: The patient has RLQ pain. I should examine the patient.\nAction: Physical Examination",
+    "Action: Laboratory Tests\nAction Input: Complete Blood Count (CBC), Lipase and C-Reactive Protein",
+    "Action: Laboratory Tests\nAction Input: Order white blood cells, repeat amylase levels\nand sodium",
+    "Action: Labs - Amylase",
+    "Action: Imaging\nAction Input: CT Abdomen with contrast",
+    "Action: Abdominal Ultrasound\nAction Input: None",
+    "Action: Imaging - Upper GI Series\nAction Input: No contrast",
+    "Action: White Blood Cells, Lipase\nAction Input: Blood",
+    "I would like to order some tests to narrow down the differential.",
+    "Final Diagnosis: Acute Appendicitis\nTreatment: Laparoscopic appendectomy",
+]
+
+
+def logged_outputs(results_paths):
+    outputs = []
+    for results_path in results_paths:
+        for _, result in read_results(results_path):
+            if isinstance(result, dict):
+                outputs.extend(action.log for action, _ in result["intermediate_steps"])
+    return outputs
+
+
+def time_parsing(outputs, create_parser, clear_stop_words=False):
+    parser = create_parser()
+    start = time.perf_counter()
+    for llm_output in outputs:
+        if clear_stop_words:
+            stop_word_sets.cache_clear()
+        parser.parse(llm_output)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("results_paths", nargs="*")
+    parser.add_argument("--lab_test_mapping_path", required=True)
+    parser.add_argument("--repeats", type=int, default=100)
+    parser.add_argument("--max_new_parsers", type=int, default=50)
+    args = parser.parse_args()
+
+    lab_test_mapping_df = pd.read_pickle(args.lab_test_mapping_path)
+    outputs = logged_outputs(args.results_paths)
+    if not outputs:
+        outputs = SAMPLE_OUTPUTS * args.repeats
+
+    start = time.perf_counter()
+    DiagnosisWorkflowParser(lab_test_mapping_df=lab_test_mapping_df)
+    print(
+        "Created parser for {} lab tests in {:.3f}s".format(
+            len(lab_test_mapping_df), time.perf_counter() - start
+        )
+    )
+
+    def reused_parser():
+        return DiagnosisWorkflowParser(lab_test_mapping_df=lab_test_mapping_df)
+
+    reused_time = time_parsing(outputs, reused_parser)
+    stop_words_time = time_parsing(outputs, reused_parser, clear_stop_words=True)
+
+    # Creating a parser per output is slow, so only a few outputs are parsed
+    new_parser_outputs = outputs[: args.max_new_parsers]
+    start = time.perf_counter()
+    for llm_output in new_parser_outputs:
+        reused_parser().parse(llm_output)
+    new_parser_time = (
+        (time.perf_counter() - start) * len(outputs) / len(new_parser_outputs)
+    )
+
+    print("{} outputs".format(len(outputs)))
+    for name, seconds in [
+        ("Reused parser", reused_time),
+        ("Stop words reloaded", stop_words_time),
+        ("New parser (estimated)", new_parser_time),
+    ]:
+        print(
+            "{:<24} {:8.3f} s, {:10.0f} outputs/s".format(
+                name, seconds, len(outputs) / seconds
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Measures the time to first token of CustomLLM on the transformers path with and without a cached prompt prefix.
+
+A randomly initialized Llama model runs on the CPU, so only the relative times are meaningful.
+
+Run from the root of the repository with python -m benchmarks.prefix_cache_benchmark
+"""
+import argparse
+import re
+import time
+
+import torch
+from tokenizers import Tokenizer, models, decoders, pre_tokenizers, processors
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+from transformers.utils import logging as transformers_logging
+from langchain.prompts import PromptTemplate
+
+from agents.prompts import FULL_INFO_TEMPLATE, FI_FEWSHOT_TEMPLATE_COPD
+from models.models import CustomLLM
+from utils.nlp import static_prompt_prefix
+
+TAGS = {
+    "system_tag_start": "<s>[INST] <<SYS>>\n",
+    "system_tag_end": "\n<</SYS>>\n\n",
+    "user_tag_start": "",
+    "user_tag_end": " [/INST]",
+    "ai_tag_start": "",
+    "ai_tag_end": "</s>",
+}
+
+
+def create_tokenizer(texts):
+    # Word level tokenizer, so that the prompts have a realistic number of tokens without downloading a vocabulary
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.decoder = decoders.WordPiece()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", 1)]
+    )
+    words = {
+        word
+        for text in texts
+        for part in re.split("</?s>", text)
+        for word, _ in tokenizer.pre_tokenizer.pre_tokenize_str(part)
+    }
+    tokenizer.add_tokens(sorted(words))
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        pad_token="<unk>",
+    )
+
+
+def create_llm(texts, hidden_size, num_layers, max_context_length):
+    tokenizer = create_tokenizer(texts)
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=8,
+        max_position_embeddings=max_context_length,
+    )
+    return CustomLLM(
+        model_name="benchmark-llama",
+        max_context_length=max_context_length,
+        seed=0,
+        model=LlamaForCausalLM(config).eval(),
+        tokenizer=tokenizer,
+    )
+
+
+def time_to_first_token(llm, prompts, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for prompt in prompts:
+            llm._call(prompt, stop=[], max_new_tokens=1)
+    return (time.perf_counter() - start) / (repeats * len(prompts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_patients", type=int, default=8)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--num_layers", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    transformers_logging.set_verbosity_error()
+
+    prompt = PromptTemplate(
+        template=FULL_INFO_TEMPLATE,
+        input_variables=["input", "fewshot_examples", "diagnostic_criteria"],
+        partial_variables={
+            tag: TAGS[tag]
+            for tag in [
+                "system_tag_start",
+                "system_tag_end",
+                "user_tag_start",
+                "user_tag_end",
+                "ai_tag_start",
+            ]
+        },
+    )
+    fewshot_examples = FI_FEWSHOT_TEMPLATE_COPD.format(
+        user_tag_start=TAGS["user_tag_start"],
+        user_tag_end=TAGS["user_tag_end"],
+        ai_tag_start=TAGS["ai_tag_start"],
+        ai_tag_end=TAGS["ai_tag_end"],
+    )
+    prompts = [
+        prompt.format(
+            input="Patient History:\nPatient {} presents with abdominal pain, nausea and fever.".format(
+                i
+            ),
+            fewshot_examples=fewshot_examples,
+            diagnostic_criteria="",
+        )
+        for i in range(args.num_patients)
+    ]
+    prefix = static_prompt_prefix(
+        prompt, "input", fewshot_examples=fewshot_examples, diagnostic_criteria=""
+    )
+
+    llm = create_llm(prompts, args.hidden_size, args.num_layers, 4096)
+    prompt_tokens = len(llm.tokenizer(prompts[0])["input_ids"])
+
+    # Warm up
+    llm._call(prompts[0], stop=[], max_new_tokens=1)
+    expected = [llm._call(prompt, stop=[], max_new_tokens=8) for prompt in prompts]
+    uncached_time = time_to_first_token(llm, prompts, args.repeats)
+
+    start = time.perf_counter()
+    num_tokens = llm.cache_prefix(prefix)
+    cache_time = time.perf_counter() - start
+    # The cached prefix must not change the outputs
+    assert [
+        llm._call(prompt, stop=[], max_new_tokens=8) for prompt in prompts
+    ] == expected
+    cached_time = time_to_first_token(llm, prompts, args.repeats)
+
+    print(
+        "{} tokens per prompt, {} of them in the cached prefix".format(
+            prompt_tokens, num_tokens
+        )
+    )
+    print("{:<16} {:8.1f} ms to first token".format("No cache", 1000 * uncached_time))
+    print(
+        "{:<16} {:8.1f} ms to first token (+{:.1f} ms to cache once)".format(
+            "Prefix cache", 1000 * cached_time, 1000 * cache_time
+        )
+    )
+    print("Speedup: {:.1f}x".format(uncached_time / cached_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Compares the per token cost of checking stop words with a Python loop over the keywords against the vectorized
+KeywordsStoppingCriteria.
+
+Run from the root of the repository with python -m benchmarks.stop_criteria_benchmark
+"""
+import argparse
+import time
+
+import torch
+
+from models.utils import KeywordsStoppingCriteria, BatchKeywordsStoppingCriteria
+
+
+class LoopKeywordsStoppingCriteria:
+    # Previous implementation comparing every keyword on its own for every sequence
+    def __init__(self, keywords, batch_size):
+        self.keywords = keywords
+        self.finished_lengths = [None] * batch_size
+
+    def __call__(self, input_ids, scores):
+        for i, finished_length in enumerate(self.finished_lengths):
+            if finished_length is not None:
+                continue
+            for k in self.keywords:
+                if torch.equal(input_ids[i][-len(k) :], k):
+                    self.finished_lengths[i] = input_ids.shape[1]
+                    break
+        return all(length is not None for length in self.finished_lengths)
+
+
+def synthetic_keywords(num_stop_words, vocab_size, seed=0):
+    # Every stop word is encoded with and without a leading period
+    generator = torch.Generator().manual_seed(seed)
+    keywords = []
+    for _ in range(num_stop_words):
+        length = int(torch.randint(2, 7, (1,), generator=generator))
+        keyword = torch.randint(3, vocab_size, (length,), generator=generator)
+        keywords.append(keyword)
+        keywords.append(keyword[1:])
+    return keywords
+
+
+def time_generation(stop_criteria, input_ids, num_tokens):
+    # Checks the stop criteria after every generated token like generate does
+    start = time.perf_counter()
+    for step in range(num_tokens):
+        stop_criteria(input_ids[:, : input_ids.shape[1] - num_tokens + step + 1], None)
+    return (time.perf_counter() - start) / num_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_stop_words", type=int, default=12)
+    parser.add_argument("--vocab_size", type=int, default=32000)
+    parser.add_argument("--prompt_length", type=int, default=2048)
+    parser.add_argument("--num_tokens", type=int, default=512)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    keywords = [
+        k.to(args.device)
+        for k in synthetic_keywords(args.num_stop_words, args.vocab_size)
+    ]
+    for batch_size in [1, 8]:
+        input_ids = torch.randint(
+            3,
+            args.vocab_size,
+            (batch_size, args.prompt_length + args.num_tokens),
+            device=args.device,
+        )
+
+        # Both implementations must agree on which sequences end with a keyword
+        for _ in range(100):
+            sample = input_ids[:, : int(torch.randint(1, 10, (1,)))].clone()
+            k = keywords[int(torch.randint(len(keywords), (1,)))]
+            sample[0, -len(k) :] = k[-sample.shape[1] :]
+            loop = LoopKeywordsStoppingCriteria(keywords, batch_size)
+            loop(sample, None)
+            vectorized = BatchKeywordsStoppingCriteria(keywords, batch_size)
+            vectorized(sample, None)
+            assert loop.finished_lengths == vectorized.finished_lengths
+
+        if batch_size == 1:
+            vectorized = KeywordsStoppingCriteria(keywords)
+        else:
+            vectorized = BatchKeywordsStoppingCriteria(keywords, batch_size)
+        loop_time = time_generation(
+            LoopKeywordsStoppingCriteria(keywords, batch_size),
+            input_ids,
+            args.num_tokens,
+        )
+        vectorized_time = time_generation(vectorized, input_ids, args.num_tokens)
+
+        print(
+            "Batch size {}, {} keywords from {} stop words".format(
+                batch_size, len(keywords), args.num_stop_words
+            )
+        )
+        print(
+            "{:<12} {:8.1f} us per token, {:10.0f} tokens/s".format(
+                "Loop", 1e6 * loop_time, batch_size / loop_time
+            )
+        )
+        print(
+            "{:<12} {:8.1f} us per token, {:10.0f} tokens/s".format(
+                "Vectorized", 1e6 * vectorized_time, batch_size / vectorized_time
+            )
+        )
+        print("Speedup: {:.1f}x".format(loop_time / vectorized_time))
+
+
+if __name__ == "__main__":
+    main()
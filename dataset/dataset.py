@@ -5,6 +5,7 @@ import traceback
 from collections import Counter
 from datetime import timedelta
 
+import numpy as np
 import pandas as pd
 
 from dataset.discharge import (
@@ -20,7 +21,12 @@ from dataset.radiology import (
 from dataset.labs import parse_lab_events, parse_microbio
 from dataset.procedures import extract_procedures
 from dataset.diagnosis import extract_diagnosis_from_diag_df
-from dataset.utils import write_hadm_to_file, print_value_counts
+from dataset.utils import (
+    write_hadm_to_file,
+    print_value_counts,
+    HadmIndex,
+    select_hadm,
+)
 from tools.utils import count_radiology_modality_and_organ_matches
 
 
@@ -126,6 +132,7 @@ def extract_info(
     radiology_report_details_df,
     diag_df,
     procedures_df,
+    output_dir="",
 ):
     # Extract the discharge, history, pe, le and radiology report for hadm_ids
     hadm_info = extract_hadm_info(
@@ -142,48 +149,10 @@ def extract_info(
 
     hadm_info_clean = None
     try:
-        # Fill extracted reports into app_hadm_info
-        # hadm_info = chatgpt_extractor(hadm_info, pathology)
-        # print("--")
-
-        # Remove rad reports where no rad_modality was found
-        hadm_info = sanitize_rad(hadm_info)
-        print("--")
-
-        # Remove mentions of target
-        hadm_info = sanitize_hadm_texts(hadm_info, sanitize_list)
-        print("--")
-
-        # Extract diagnoses
-        for _id in hadm_info:
-            try:
-                hadm_info[_id][
-                    "Discharge Diagnosis"
-                ] = extract_diagnosis_from_discharge(hadm_info[_id]["Discharge"])
-            except Exception as e:
-                print("ID: {}, Error: {}".format(_id, e))
-                hadm_info[_id]["Discharge Diagnosis"] = ""
-        hadm_info = extract_diagnosis_from_diag_df(hadm_info, diag_df)
-
-        # Extract procedures
-        procedures_df_icd9 = procedures_df[procedures_df["icd_version"] == 9]
-        procedures_df_icd10 = procedures_df[procedures_df["icd_version"] == 10]
-        hadm_info = extract_procedures(
-            hadm_info, procedures_df_icd9, procedures_df_icd10
-        )
-
-        # Examine data completeness
-        hadm_info_clean = check_missing(hadm_info, pathology)
-        print("--")
-
-        # Write human readable and pickle files
-        write_hadm_to_file(
-            hadm_info, "{}_hadm_info".format("_".join(pathology.split()))
+        hadm_info = postprocess_hadm_info(
+            hadm_info, sanitize_list, diag_df, procedures_df
         )
-        write_hadm_to_file(
-            hadm_info_clean, "{}_hadm_info_clean".format("_".join(pathology.split()))
-        )
-        print("Finished writing files")
+        hadm_info_clean = write_hadm_info(hadm_info, pathology, output_dir)
 
     except Exception as e:
         print("Error in extracting info:, ", e)
@@ -194,6 +163,55 @@ def extract_info(
     return hadm_info, hadm_info_clean
 
 
+def postprocess_hadm_info(hadm_info, sanitize_list, diag_df, procedures_df):
+    # Fill extracted reports into app_hadm_info
+    # hadm_info = chatgpt_extractor(hadm_info, pathology)
+    # print("--")
+
+    # Remove rad reports where no rad_modality was found
+    hadm_info = sanitize_rad(hadm_info)
+    print("--")
+
+    # Remove mentions of target
+    hadm_info = sanitize_hadm_texts(hadm_info, sanitize_list)
+    print("--")
+
+    # Extract diagnoses
+    for _id in hadm_info:
+        try:
+            hadm_info[_id]["Discharge Diagnosis"] = extract_diagnosis_from_discharge(
+                hadm_info[_id]["Discharge"]
+            )
+        except Exception as e:
+            print("ID: {}, Error: {}".format(_id, e))
+            hadm_info[_id]["Discharge Diagnosis"] = ""
+    hadm_info = extract_diagnosis_from_diag_df(hadm_info, HadmIndex(diag_df))
+
+    # Extract procedures
+    procedures_df_icd9 = HadmIndex(procedures_df[procedures_df["icd_version"] == 9])
+    procedures_df_icd10 = HadmIndex(procedures_df[procedures_df["icd_version"] == 10])
+    hadm_info = extract_procedures(hadm_info, procedures_df_icd9, procedures_df_icd10)
+    return hadm_info
+
+
+def write_hadm_info(hadm_info, pathology, output_dir=""):
+    # Examine data completeness
+    hadm_info_clean = check_missing(hadm_info, pathology)
+    print("--")
+
+    # Write human readable and pickle files
+    write_hadm_to_file(
+        hadm_info, "{}_hadm_info".format("_".join(pathology.split())), output_dir
+    )
+    write_hadm_to_file(
+        hadm_info_clean,
+        "{}_hadm_info_clean".format("_".join(pathology.split())),
+        output_dir,
+    )
+    print("Finished writing files")
+    return hadm_info_clean
+
+
 def create_valuestr_lab(row):
     valuenum = row["valuenum"]
     value = row["value"]
@@ -232,90 +250,133 @@ def create_valuestr_microbio(row):
         return comment
 
 
-def load_data(base_mimic: str = ""):
-    base_hosp = join(base_mimic, "hosp")
-    base_notes = join(base_mimic, "note")
+def create_valuestr_lab_vectorized(lab_events_df):
+    """Column-wise version of create_valuestr_lab. Missing values are expected as NaN, as returned by pd.read_csv."""
+    valuenum = lab_events_df["valuenum"]
+    value = lab_events_df["value"]
+    valueuom = lab_events_df["valueuom"]
+    flag = lab_events_df["flag"]
+    has_uom = valueuom.notna()
 
-    # Load admissions
-    admissions_df = pd.read_csv(join(base_hosp, "admissions.csv"))
+    # Fill in reverse order of priority so that the most preferred source is written last
+    # Finally, return comments if all else fails
+    valuestr = lab_events_df["comments"].astype(object)
 
-    # Load transfers
-    transfers_df = pd.read_csv(join(base_mimic, "hosp", "transfers.csv"))
+    # Check if flag is not NaN (i.e. abnormal)
+    valuestr = valuestr.mask(flag.notna(), flag)
 
-    diagnoses_icd_df = pd.read_csv(join(base_hosp, "diagnoses_icd.csv"))
-    # remove NAN ICD Codes
-    diagnoses_icd_df = diagnoses_icd_df[~diagnoses_icd_df.icd_code.isna()]
+    # Next, try to extract value
+    value_str = value.astype(str)
+    value_str = value_str.mask(has_uom, value_str + " " + valueuom)
+    valuestr = valuestr.mask(value.notna() & (value != "___"), value_str)
+
+    # First try to extract valuenum (Value numeric)
+    valuenum_str = valuenum.astype(str)
+    valuenum_str = valuenum_str.mask(has_uom, valuenum_str + " " + valueuom)
+    valuestr = valuestr.mask(valuenum.notna() & (valuenum != "___"), valuenum_str)
+
+    return valuestr.rename(None)
 
-    # ICD Descriptions
-    icd_descriptions = pd.read_csv(join(base_hosp, "d_icd_diagnoses.csv"))
 
-    # Expand to include names of disease, once for version 9 and once for version 10
-    diag_icd9 = diagnoses_icd_df[diagnoses_icd_df.icd_version == 9]
-    icd_descriptions_9 = icd_descriptions[icd_descriptions.icd_version == 9]
-    diag_icd9 = diag_icd9.merge(
+def create_valuestr_microbio_vectorized(microbiology_df):
+    """Column-wise version of create_valuestr_microbio."""
+    org_name = microbiology_df["org_name"].astype(object)
+
+    # Check if orgname present
+    return org_name.where(org_name.notna(), microbiology_df["comments"]).rename(None)
+
+
+def merge_icd_descriptions(icd_df, icd_descriptions_df):
+    # Expand to include names of codes, once for version 9 and once for version 10
+    icd_df_9 = icd_df[icd_df.icd_version == 9]
+    icd_descriptions_9 = icd_descriptions_df[icd_descriptions_df.icd_version == 9]
+    icd_df_9 = icd_df_9.merge(
         icd_descriptions_9[["icd_code", "long_title"]], on="icd_code", how="left"
     )
 
-    diag_icd10 = diagnoses_icd_df[diagnoses_icd_df.icd_version == 10]
-    icd_descriptions_10 = icd_descriptions[icd_descriptions.icd_version == 10]
-    diag_icd10 = diag_icd10.merge(
+    icd_df_10 = icd_df[icd_df.icd_version == 10]
+    icd_descriptions_10 = icd_descriptions_df[icd_descriptions_df.icd_version == 10]
+    icd_df_10 = icd_df_10.merge(
         icd_descriptions_10[["icd_code", "long_title"]], on="icd_code", how="left"
     )
 
-    diag_icd = pd.concat([diag_icd9, diag_icd10])
+    return pd.concat([icd_df_9, icd_df_10])
 
-    # Load procedures
-    procedures_df = pd.read_csv(join(base_hosp, "procedures_icd.csv"))
 
-    # Load description of procedures and merge
-    procedures_descr_df = pd.read_csv(join(base_hosp, "d_icd_procedures.csv"))
-    procedures_descr_9_df = procedures_descr_df[procedures_descr_df.icd_version == 9]
-    procedures_descr_10_df = procedures_descr_df[procedures_descr_df.icd_version == 10]
-    procedures_9_df = procedures_df[procedures_df.icd_version == 9]
-    procedures_10_df = procedures_df[procedures_df.icd_version == 10]
-    procedures_9_df = procedures_9_df.merge(
-        procedures_descr_9_df[["icd_code", "long_title"]], on="icd_code", how="left"
-    )
-    procedures_10_df = procedures_10_df.merge(
-        procedures_descr_10_df[["icd_code", "long_title"]], on="icd_code", how="left"
-    )
-    procedures_df = pd.concat([procedures_9_df, procedures_10_df])
+def prepare_diagnoses(diagnoses_icd_df, icd_descriptions):
+    # remove NAN ICD Codes
+    diagnoses_icd_df = diagnoses_icd_df[~diagnoses_icd_df.icd_code.isna()]
+    return merge_icd_descriptions(diagnoses_icd_df, icd_descriptions)
 
-    # Load notes
-    discharge_df = pd.read_csv(join(base_notes, "discharge.csv"))
 
-    # Load radiology reports
-    radiology_report_df = pd.read_csv(join(base_notes, "radiology.csv"))
+def prepare_procedures(procedures_df, procedures_descr_df):
+    return merge_icd_descriptions(procedures_df, procedures_descr_df)
 
-    # Load radiology report details
-    radiology_report_details_df = pd.read_csv(join(base_notes, "radiology_detail.csv"))
 
-    # Load microbiology events
-    microbiology_df = pd.read_csv(join(base_hosp, "microbiologyevents.csv"))
+def prepare_microbiology(microbiology_df):
     # Remove canceled tests
-    microbiology_df = microbiology_df[microbiology_df["org_itemid"] != 90760.0]
+    microbiology_df = microbiology_df[microbiology_df["org_itemid"] != 90760.0].copy()
 
-    # Load lab events
-    lab_events_df = pd.read_csv(join(base_hosp, "labevents.csv"))
+    # Create valuestr for microbio
+    microbiology_df["valuestr"] = create_valuestr_microbio_vectorized(microbiology_df)
+
+    # Convert microbiology charttime to datetime
+    microbiology_df["charttime"] = pd.to_datetime(microbiology_df["charttime"])
+    return microbiology_df
 
-    # Load lab event descriptions
-    lab_events_descr_df = pd.read_csv(join(base_hosp, "d_labitems.csv"))
 
+def prepare_lab_events(lab_events_df, lab_events_descr_df):
     # Expand lab events to include descriptions
     lab_events_df = lab_events_df.merge(
         lab_events_descr_df[["itemid", "label"]], on="itemid", how="left"
     )
 
     # Create valuestr from valuenum and valueuom
-    lab_events_df["valuestr"] = lab_events_df.apply(
-        lambda row: create_valuestr_lab(row),
-        axis=1,
+    lab_events_df["valuestr"] = create_valuestr_lab_vectorized(lab_events_df)
+
+    # Convert lab events charrtime to datetime
+    lab_events_df["charttime"] = pd.to_datetime(lab_events_df["charttime"])
+    return lab_events_df
+
+
+def load_data(base_mimic: str = ""):
+    base_hosp = join(base_mimic, "hosp")
+    base_notes = join(base_mimic, "note")
+
+    # Load admissions
+    admissions_df = pd.read_csv(join(base_hosp, "admissions.csv"))
+
+    # Load transfers
+    transfers_df = pd.read_csv(join(base_mimic, "hosp", "transfers.csv"))
+
+    # Load diagnoses and expand to include names of disease
+    diagnoses_icd_df = pd.read_csv(join(base_hosp, "diagnoses_icd.csv"))
+    icd_descriptions = pd.read_csv(join(base_hosp, "d_icd_diagnoses.csv"))
+    diag_icd = prepare_diagnoses(diagnoses_icd_df, icd_descriptions)
+
+    # Load procedures and merge description of procedures
+    procedures_df = pd.read_csv(join(base_hosp, "procedures_icd.csv"))
+    procedures_descr_df = pd.read_csv(join(base_hosp, "d_icd_procedures.csv"))
+    procedures_df = prepare_procedures(procedures_df, procedures_descr_df)
+
+    # Load notes
+    discharge_df = pd.read_csv(join(base_notes, "discharge.csv"))
+
+    # Load radiology reports
+    radiology_report_df = pd.read_csv(join(base_notes, "radiology.csv"))
+
+    # Load radiology report details
+    radiology_report_details_df = pd.read_csv(join(base_notes, "radiology_detail.csv"))
+
+    # Load microbiology events
+    microbiology_df = prepare_microbiology(
+        pd.read_csv(join(base_hosp, "microbiologyevents.csv"))
     )
 
-    # Create valuestr for microbio
-    microbiology_df["valuestr"] = microbiology_df.apply(
-        lambda row: create_valuestr_microbio(row),
-        axis=1,
+    # Load lab events and expand to include descriptions
+    lab_events_descr_df = pd.read_csv(join(base_hosp, "d_labitems.csv"))
+    lab_events_df = prepare_lab_events(
+        pd.read_csv(join(base_hosp, "labevents.csv")), lab_events_descr_df
     )
 
     # Many lab events dont have a hadm_id. If a patient only has one hadm_id we can fill that in for them
@@ -353,10 +414,6 @@ def load_data(base_mimic: str = ""):
 
     # Convert transfers to datetime
     transfers_df["intime"] = pd.to_datetime(transfers_df["intime"])
-    # Convert lab events charrtime to datetime
-    lab_events_df["charttime"] = pd.to_datetime(lab_events_df["charttime"])
-    # Convert microbiology charttime to datetime
-    microbiology_df["charttime"] = pd.to_datetime(microbiology_df["charttime"])
 
     return (
         admissions_df,
@@ -371,6 +428,62 @@ def load_data(base_mimic: str = ""):
     )
 
 
+def admission_windows(disease_ids, transfers_df, hadm_to_subject_id):
+    """Builds the time window [first intime - 1 day, last intime] of every admission in disease_ids.
+
+    The priority of a window is the position of its hadm_id in disease_ids. Events falling into multiple windows
+    are assigned to the window with the lowest priority value.
+    """
+    ids = pd.Series(disease_ids).drop_duplicates()
+    windows = pd.DataFrame(
+        {
+            "window_hadm_id": ids.values,
+            "priority": ids.index,
+            "subject_id": ids.map(hadm_to_subject_id).values,
+        }
+    )
+
+    time_data = transfers_df[transfers_df["hadm_id"].isin(ids)]
+    intimes = time_data.groupby("hadm_id")["intime"]
+    start_time = intimes.min() - timedelta(days=1)
+    # Missing intimes are sorted last, making the window end undefined
+    end_time = intimes.max().where(
+        ~time_data["intime"].isna().groupby(time_data["hadm_id"]).any()
+    )
+    windows["start_time"] = windows["window_hadm_id"].map(start_time)
+    windows["end_time"] = windows["window_hadm_id"].map(end_time)
+
+    return windows.dropna(subset=["subject_id", "start_time", "end_time"])
+
+
+def assign_events_to_windows(events_df, windows):
+    # Only events without hadm_id can be assigned
+    orphan_positions = np.flatnonzero(events_df["hadm_id"].isna().values)
+    orphans = pd.DataFrame(
+        {
+            "event_position": orphan_positions,
+            "subject_id": events_df["subject_id"].values[orphan_positions],
+            "charttime": events_df["charttime"].values[orphan_positions],
+        }
+    )
+
+    candidates = orphans.merge(
+        windows.astype({"subject_id": orphans["subject_id"].dtype}), on="subject_id"
+    )
+    candidates = candidates[
+        (candidates["charttime"] >= candidates["start_time"])
+        & (candidates["charttime"] <= candidates["end_time"])
+    ]
+    assignments = candidates.sort_values("priority", kind="stable").drop_duplicates(
+        "event_position"
+    )
+
+    events_df.iloc[
+        assignments["event_position"].values, events_df.columns.get_loc("hadm_id")
+    ] = assignments["window_hadm_id"].values
+    return events_df
+
+
 def fill_nan_hadm(
     lab_events_df,
     radiology_reports_df,
@@ -379,36 +492,13 @@ def fill_nan_hadm(
     transfers_df,
     hadm_to_subject_id,
 ):
-    for _id in disease_ids:
-        s_id = hadm_to_subject_id[_id]
+    # Events without hadm_id are assigned to the first admission in disease_ids of the same subject where the event
+    # happened between a day before the first and the last transfer
+    windows = admission_windows(disease_ids, transfers_df, hadm_to_subject_id)
 
-        time_data = transfers_df[transfers_df["hadm_id"] == _id].sort_values("intime")
-        start_time = pd.Timestamp(time_data["intime"].values[0])
-        end_time = pd.Timestamp(time_data["intime"].values[-1])
-
-        mask_le = (
-            (lab_events_df["subject_id"] == s_id)
-            & (lab_events_df["charttime"] >= (start_time - timedelta(days=1)))
-            & (lab_events_df["charttime"] <= end_time)
-            & (lab_events_df["hadm_id"].isna())
-        )
-        lab_events_df.loc[mask_le, "hadm_id"] = _id
-
-        mask_rad = (
-            (radiology_reports_df["subject_id"] == s_id)
-            & (radiology_reports_df["charttime"] >= (start_time - timedelta(days=1)))
-            & (radiology_reports_df["charttime"] <= end_time)
-            & (radiology_reports_df["hadm_id"].isna())
-        )
-        radiology_reports_df.loc[mask_rad, "hadm_id"] = _id
-
-        mask_micro = (
-            (microbiology_df["subject_id"] == s_id)
-            & (microbiology_df["charttime"] >= (start_time - timedelta(days=1)))
-            & (microbiology_df["charttime"] <= end_time)
-            & (microbiology_df["hadm_id"].isna())
-        )
-        microbiology_df.loc[mask_micro, "hadm_id"] = _id
+    lab_events_df = assign_events_to_windows(lab_events_df, windows)
+    radiology_reports_df = assign_events_to_windows(radiology_reports_df, windows)
+    microbiology_df = assign_events_to_windows(microbiology_df, windows)
 
     return lab_events_df, radiology_reports_df, microbiology_df
 
@@ -532,6 +622,11 @@ def extract_hadm_info(
         hadm_to_subject_id,
     )
 
+    # Group events by admission once instead of scanning the tables for every admission
+    lab_events_index = HadmIndex(lab_events_df_sf)
+    microbiology_index = HadmIndex(microbiology_df_sf)
+    radiology_report_index = HadmIndex(radiology_report_df_sf)
+
     hadm_info = {}
 
     for _id in disease_ids:
@@ -550,19 +645,14 @@ def extract_hadm_info(
 
             pe = extract_physical_examination(discharge_text)
 
-            le, ref_r_low, ref_r_up = parse_lab_events(lab_events_df_sf, _id)
+            le, ref_r_low, ref_r_up = parse_lab_events(lab_events_index, _id)
 
-            microbio, microbio_spec = parse_microbio(microbiology_df_sf, _id)
+            microbio, microbio_spec = parse_microbio(microbiology_index, _id)
 
-            rad = extract_rad_events(
-                radiology_report_df_sf[radiology_report_df_sf["hadm_id"] == _id][
-                    "text"
-                ].values
-            )
+            radiology_reports = select_hadm(radiology_report_index, _id)
+            rad = extract_rad_events(radiology_reports["text"].values)
 
-            note_ids = radiology_report_df_sf[radiology_report_df_sf["hadm_id"] == _id][
-                "note_id"
-            ].values
+            note_ids = radiology_reports["note_id"].values
 
             note_names = []
             for note_id in note_ids:
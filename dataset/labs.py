@@ -4,6 +4,7 @@ import os
 import pandas as pd
 
 from utils.nlp import extract_short_and_long_name
+from dataset.utils import select_hadm
 from tools.utils import (
     LAB_TEST_MAPPING_ALTERATIONS,
     ADDITIONAL_LAB_TEST_MAPPING,
@@ -13,7 +14,7 @@ from tools.utils import (
 
 
 def parse_lab_events(lab_events_df_sf, _id):
-    filtered_lab_events = lab_events_df_sf[lab_events_df_sf["hadm_id"] == _id]
+    filtered_lab_events = select_hadm(lab_events_df_sf, _id)
     le, ref_r_low, ref_r_up = {}, {}, {}
     if not filtered_lab_events.empty:
         sorted_df = filtered_lab_events.sort_values(by="charttime", ascending=True)
@@ -27,7 +28,7 @@ def parse_lab_events(lab_events_df_sf, _id):
 
 
 def parse_microbio(microbio_df_sf, _id):
-    filtered_microbio_df = microbio_df_sf[microbio_df_sf["hadm_id"] == _id]
+    filtered_microbio_df = select_hadm(microbio_df_sf, _id)
     microbio = {}
     microbio_spec = {}
 
@@ -0,0 +1,274 @@
+import os
+import shutil
+from os.path import join, exists
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+from dataset.dataset import (
+    prepare_diagnoses,
+    prepare_procedures,
+    prepare_microbiology,
+    prepare_lab_events,
+)
+
+
+# Number of hive partitions. Rows are assigned to partition subject_id % NUM_SUBJECT_BUCKETS so that a
+# subject_id filter only ever touches a single directory per subject.
+NUM_SUBJECT_BUCKETS = 64
+
+# Rows read per CSV chunk during conversion. Keeps peak memory bounded for labevents.
+CSV_CHUNKSIZE = 5_000_000
+
+# Column holding the original CSV row number. Used to restore the exact row order of load_data after
+# reading from multiple partitions.
+ROW_ORDER_COLUMN = "row_order"
+PARTITION_COLUMN = "subject_bucket"
+
+# Integer columns that are never missing and thus keep their integer type in the cache. All other integer
+# columns are stored as float64, since a later CSV chunk may contain NaNs where the first one did not.
+NON_NULL_INT_COLUMNS = {
+    "subject_id",
+    "itemid",
+    "labevent_id",
+    "specimen_id",
+    "microevent_id",
+    "micro_specimen_id",
+    "spec_itemid",
+    "test_itemid",
+    "icd_version",
+    "seq_num",
+    "note_seq",
+    "field_ordinal",
+    "transfer_id",
+    ROW_ORDER_COLUMN,
+}
+
+# Tables in which every row belongs to an admission and hadm_id is thus never missing
+ADMISSION_TABLES = {"admissions", "diagnoses_icd", "procedures_icd", "discharge"}
+
+# Free text columns that pandas would otherwise type per chunk (e.g. all numeric in one chunk, mixed in the next)
+STRING_COLUMNS = {
+    "labevents": [
+        "value",
+        "valueuom",
+        "flag",
+        "priority",
+        "comments",
+        "order_provider_id",
+    ],
+    "microbiologyevents": [
+        "spec_type_desc",
+        "test_name",
+        "org_name",
+        "isolate_num",
+        "quantity",
+        "ab_name",
+        "dilution_text",
+        "dilution_comparison",
+        "interpretation",
+        "comments",
+        "order_provider_id",
+    ],
+    "radiology_detail": ["field_name", "field_value"],
+}
+
+# The ICD description merges group rows by icd_version. These small tables are converted in a single chunk to keep
+# the row order of load_data.
+UNCHUNKED_TABLES = {"diagnoses_icd", "procedures_icd"}
+
+# Table name -> (folder, csv file, datetime columns parsed during conversion)
+CACHE_TABLES = {
+    "admissions": ("hosp", "admissions.csv", ["admittime", "dischtime"]),
+    "transfers": ("hosp", "transfers.csv", ["intime"]),
+    "diagnoses_icd": ("hosp", "diagnoses_icd.csv", []),
+    "procedures_icd": ("hosp", "procedures_icd.csv", []),
+    "discharge": ("note", "discharge.csv", []),
+    "radiology": ("note", "radiology.csv", ["charttime"]),
+    "radiology_detail": ("note", "radiology_detail.csv", []),
+    "microbiologyevents": ("hosp", "microbiologyevents.csv", []),
+    "labevents": ("hosp", "labevents.csv", []),
+}
+
+
+def _cache_schema(df, non_null_int_columns):
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in schema:
+        if pa.types.is_null(field.type):
+            # Columns that are empty in the first chunk are text in every MIMIC table
+            field = field.with_type(pa.string())
+        elif pa.types.is_integer(field.type) and field.name not in non_null_int_columns:
+            field = field.with_type(pa.float64())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _write_table(
+    chunks, out_dir, non_null_int_columns, num_buckets=NUM_SUBJECT_BUCKETS
+):
+    if exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    schema = None
+    row_offset = 0
+    for i, chunk in enumerate(chunks):
+        chunk = chunk.reset_index(drop=True)
+        chunk[ROW_ORDER_COLUMN] = range(row_offset, row_offset + len(chunk))
+        row_offset += len(chunk)
+
+        # Sorting by subject keeps the row group statistics tight so that subject_id filters can skip row groups
+        chunk = chunk.sort_values("subject_id", kind="stable")
+        if schema is None:
+            schema = _cache_schema(chunk, non_null_int_columns)
+        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        table = table.append_column(
+            PARTITION_COLUMN,
+            pa.array(chunk["subject_id"].values % num_buckets, type=pa.int32()),
+        )
+
+        ds.write_dataset(
+            table,
+            out_dir,
+            format="parquet",
+            partitioning=ds.partitioning(
+                pa.schema([(PARTITION_COLUMN, pa.int32())]), flavor="hive"
+            ),
+            basename_template=f"part-{i}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    return row_offset
+
+
+def build_parquet_cache(
+    base_mimic: str, cache_dir: str, chunksize: int = CSV_CHUNKSIZE, tables=None
+):
+    """Converts the MIMIC csv files used by load_data into a partitioned parquet cache.
+
+    The lab item and ICD description merges, valuestr creation and datetime parsing of load_data are applied during
+    the conversion, so the cached tables can be used as is.
+
+    Args:
+        base_mimic: Root folder of MIMIC-IV containing the hosp and note folders
+        cache_dir: Folder the parquet tables are written to. Existing tables are overwritten.
+        chunksize: Number of csv rows converted at a time
+        tables: Optional subset of CACHE_TABLES to convert
+    """
+    base_hosp = join(base_mimic, "hosp")
+
+    # Description tables are small and merged into every chunk
+    icd_descriptions = pd.read_csv(join(base_hosp, "d_icd_diagnoses.csv"))
+    procedures_descr_df = pd.read_csv(join(base_hosp, "d_icd_procedures.csv"))
+    lab_events_descr_df = pd.read_csv(join(base_hosp, "d_labitems.csv"))
+    prepare = {
+        "diagnoses_icd": lambda df: prepare_diagnoses(df, icd_descriptions),
+        "procedures_icd": lambda df: prepare_procedures(df, procedures_descr_df),
+        "microbiologyevents": prepare_microbiology,
+        "labevents": lambda df: prepare_lab_events(df, lab_events_descr_df),
+    }
+
+    for table in tables or CACHE_TABLES:
+        folder, filename, datetime_columns = CACHE_TABLES[table]
+
+        def chunks():
+            csv_path = join(base_mimic, folder, filename)
+            dtype = {c: str for c in STRING_COLUMNS.get(table, [])}
+            if table in UNCHUNKED_TABLES:
+                reader = [pd.read_csv(csv_path, dtype=dtype)]
+            else:
+                reader = pd.read_csv(csv_path, chunksize=chunksize, dtype=dtype)
+            for chunk in reader:
+                if table in prepare:
+                    chunk = prepare[table](chunk)
+                for column in datetime_columns:
+                    chunk[column] = pd.to_datetime(chunk[column])
+                yield chunk
+
+        non_null_int_columns = set(NON_NULL_INT_COLUMNS)
+        if table in ADMISSION_TABLES:
+            non_null_int_columns.add("hadm_id")
+        num_rows = _write_table(chunks(), join(cache_dir, table), non_null_int_columns)
+        print("Cached {} rows of {}".format(num_rows, table))
+
+
+def load_table(cache_dir, table, columns=None, subject_ids=None, hadm_ids=None):
+    """Loads a table from the parquet cache using memory mapping.
+
+    Args:
+        cache_dir: Folder created by build_parquet_cache
+        table: Name of the table as in CACHE_TABLES
+        columns: Optional list of columns to read. All columns are read if None.
+        subject_ids: Optional iterable of subject_ids. Only rows of these subjects are read.
+        hadm_ids: Optional iterable of hadm_ids. Only rows of these admissions are read.
+
+    Returns:
+        DataFrame with the rows in the same order as the original csv
+    """
+    dataset = ds.dataset(
+        join(cache_dir, table),
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([(PARTITION_COLUMN, pa.int32())]), flavor="hive"
+        ),
+        filesystem=pafs.LocalFileSystem(use_mmap=True),
+    )
+
+    filter = None
+    if subject_ids is not None:
+        subject_ids = sorted({int(s) for s in subject_ids})
+        buckets = sorted({s % NUM_SUBJECT_BUCKETS for s in subject_ids})
+        filter = ds.field(PARTITION_COLUMN).isin(buckets) & ds.field("subject_id").isin(
+            pa.array(subject_ids, type=dataset.schema.field("subject_id").type)
+        )
+    if hadm_ids is not None:
+        hadm_type = dataset.schema.field("hadm_id").type
+        hadm_filter = ds.field("hadm_id").isin(
+            pa.array([int(h) for h in hadm_ids]).cast(hadm_type)
+        )
+        filter = hadm_filter if filter is None else filter & hadm_filter
+
+    read_columns = None
+    if columns is not None:
+        read_columns = list(columns) + [ROW_ORDER_COLUMN]
+    df = dataset.to_table(columns=read_columns, filter=filter).to_pandas()
+
+    df = df.sort_values(ROW_ORDER_COLUMN, kind="stable").reset_index(drop=True)
+    return df.drop(columns=[ROW_ORDER_COLUMN, PARTITION_COLUMN], errors="ignore")
+
+
+def load_data_from_cache(cache_dir: str, hadm_ids=None, subject_ids=None):
+    """Drop-in replacement for load_data that reads from the parquet cache.
+
+    If hadm_ids are given, all tables are restricted to the subjects of these admissions. Event tables are filtered
+    by subject and not by admission, so that events without a hadm_id can still be assigned in fill_nan_hadm.
+
+    Returns:
+        Same tuple as load_data
+    """
+    if hadm_ids is not None:
+        admissions = load_table(
+            cache_dir,
+            "admissions",
+            columns=["hadm_id", "subject_id"],
+            hadm_ids=hadm_ids,
+        )
+        subject_ids = set(admissions["subject_id"]) | set(subject_ids or [])
+
+    def load(table):
+        return load_table(cache_dir, table, subject_ids=subject_ids)
+
+    return (
+        load("admissions"),
+        load("transfers"),
+        load("diagnoses_icd"),
+        load("procedures_icd"),
+        load("discharge"),
+        load("radiology"),
+        load("radiology_detail"),
+        load("labevents"),
+        load("microbiologyevents"),
+    )
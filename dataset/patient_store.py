@@ -0,0 +1,137 @@
+import os
+import pickle
+import sqlite3
+import sys
+from collections.abc import Mapping
+from os.path import join, exists
+
+from dataset.utils import load_hadm_from_file
+
+# Number of ids per query when fetching multiple patients. Stays below the SQLite parameter limit.
+QUERY_CHUNK_SIZE = 500
+
+
+class PatientStore(Mapping):
+    """
+    Read-only, dict-like view of a patient file written with write_patient_store.
+
+    Patients are stored as individually pickled records in a SQLite table indexed by hadm_id. Only the patients that
+    are accessed are read and unpickled, so a process working on a few patients does not need to load the whole file.
+
+    Args:
+        path (str): Path to the .db file
+
+    Example:
+        hadm_info_clean = PatientStore("appendicitis_hadm_info_first_diag.db")
+        for _id in hadm_info_clean:  # iterates in stored order without loading patients
+            patient = hadm_info_clean[_id]
+    """
+
+    def __init__(self, path):
+        if not exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # SQLite connections must not be shared across forked processes, so every process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def __getstate__(self):
+        return {"path": self.path, "_connection": None, "_pid": None}
+
+    def __getitem__(self, _id):
+        row = self.connection.execute(
+            "SELECT data FROM patients WHERE hadm_id = ?", (int(_id),)
+        ).fetchone()
+        if row is None:
+            raise KeyError(_id)
+        return pickle.loads(row[0])
+
+    def __contains__(self, _id):
+        try:
+            _id = int(_id)
+        except (TypeError, ValueError):
+            return False
+        row = self.connection.execute(
+            "SELECT 1 FROM patients WHERE hadm_id = ?", (_id,)
+        ).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        rows = self.connection.execute(
+            "SELECT hadm_id FROM patients ORDER BY position"
+        ).fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def get_many(self, ids):
+        """Returns a dict of the requested patients in the order of ids. Ids not in the store are skipped."""
+        ids = [int(_id) for _id in ids]
+        patients = {}
+        for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+            chunk = ids[i : i + QUERY_CHUNK_SIZE]
+            rows = self.connection.execute(
+                "SELECT hadm_id, data FROM patients WHERE hadm_id IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            ).fetchall()
+            for hadm_id, data in rows:
+                patients[hadm_id] = pickle.loads(data)
+        return {_id: patients[_id] for _id in ids if _id in patients}
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def write_patient_store(hadm_info, path):
+    """Writes a hadm_info dict to a PatientStore file, keeping the order of the dict."""
+    if exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE patients (hadm_id INTEGER PRIMARY KEY, position INTEGER NOT NULL, data BLOB NOT NULL)"
+        )
+        connection.executemany(
+            "INSERT INTO patients VALUES (?, ?, ?)",
+            (
+                (int(_id), position, pickle.dumps(patient))
+                for position, (_id, patient) in enumerate(hadm_info.items())
+            ),
+        )
+        connection.execute("CREATE INDEX patients_position ON patients (position)")
+    connection.close()
+
+
+def convert_hadm_file_to_store(filename, base_mimic=""):
+    """Converts a pickle written with write_hadm_to_file into a PatientStore next to it."""
+    hadm_info = load_hadm_from_file(filename, base_mimic=base_mimic)
+    write_patient_store(hadm_info, join(base_mimic, filename + ".db"))
+
+
+def load_patients(filename, base_mimic=""):
+    """Opens the PatientStore of a patient file if it exists and falls back to loading the whole pickle otherwise."""
+    store_path = join(base_mimic, filename + ".db")
+    if exists(store_path):
+        return PatientStore(store_path)
+    return load_hadm_from_file(filename, base_mimic=base_mimic)
+
+
+if __name__ == "__main__":
+    # python -m dataset.patient_store <base_mimic> <filename> [<filename> ...]
+    for filename in sys.argv[2:]:
+        convert_hadm_file_to_store(filename, base_mimic=sys.argv[1])
+        print("Converted {}".format(filename))
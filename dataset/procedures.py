@@ -1,5 +1,6 @@
 import re
 from icd.procedure_mappings import icd_converter, uniqueify_lists
+from dataset.utils import select_hadm
 
 
 def extract_procedure_from_discharge_summary(discharge_summary):
@@ -45,26 +46,20 @@ def extract_procedures(hadm_info, procedures_df_icd9, procedures_df_icd10):
             print("No procedures found for {}".format(_id))
         hadm_info[_id]["Procedures Discharge"] = discharge_procedures
 
-        procedures_icd9 = procedures_df_icd9[procedures_df_icd9["hadm_id"] == _id][
-            "icd_code"
-        ].values
+        procedures_icd9_df = select_hadm(procedures_df_icd9, _id)
+        procedures_icd9 = procedures_icd9_df["icd_code"].values
         hadm_info[_id]["Procedures ICD9"] = procedures_icd9.tolist()
         hadm_info[_id]["Procedures ICD9"] = [int(p) for p in procedures_icd9]
 
-        procedures_str = procedures_df_icd9[procedures_df_icd9["hadm_id"] == _id][
-            "long_title"
-        ].values
+        procedures_str = procedures_icd9_df["long_title"].values
         hadm_info[_id]["Procedures ICD9 Title"] = procedures_str.tolist()
 
-        procedures_icd10 = procedures_df_icd10[procedures_df_icd10["hadm_id"] == _id][
-            "icd_code"
-        ].values
+        procedures_icd10_df = select_hadm(procedures_df_icd10, _id)
+        procedures_icd10 = procedures_icd10_df["icd_code"].values
         hadm_info[_id]["Procedures ICD10"] = procedures_icd10.tolist()
         hadm_info[_id]["Procedures ICD10"] = [str(p) for p in procedures_icd10]
 
-        procedures_str = procedures_df_icd10[procedures_df_icd10["hadm_id"] == _id][
-            "long_title"
-        ].values
+        procedures_str = procedures_icd10_df["long_title"].values
         hadm_info[_id]["Procedures ICD10 Title"] = procedures_str.tolist()
     return hadm_info
 
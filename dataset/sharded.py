@@ -0,0 +1,134 @@
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from dataset.dataset import extract_hadm_info, postprocess_hadm_info, write_hadm_info
+from dataset.parquet_cache import load_data_from_cache, load_table
+
+
+def shard_hadm_ids(hadm_ids, hadm_to_subject_id, num_shards):
+    """Splits hadm_ids into shards such that all admissions of a subject end up in the same shard.
+
+    Events without a hadm_id are assigned to one of the admissions of their subject (see fill_nan_hadm), so the
+    admissions of a subject can not be processed independently. The order of hadm_ids is kept within every shard.
+    """
+    subject_to_shard = {}
+    shards = [[] for _ in range(num_shards)]
+    for _id in hadm_ids:
+        subject_id = hadm_to_subject_id.get(_id)
+        if subject_id not in subject_to_shard:
+            subject_to_shard[subject_id] = len(subject_to_shard) % num_shards
+        shards[subject_to_shard[subject_id]].append(_id)
+    return [shard for shard in shards if len(shard)]
+
+
+def extract_shard(cache_dir, hadm_ids, sanitize_list):
+    """Extracts and post-processes the hadm_info of one shard, reading only its subjects from the cache.
+
+    Errors in the post-processing are caught as in extract_info. The extracted hadm_info is then returned as is and
+    the second return value is False.
+    """
+    (
+        admissions_df,
+        transfers_df,
+        diag_df,
+        procedures_df,
+        discharge_df,
+        radiology_report_df,
+        radiology_report_details_df,
+        lab_events_df,
+        microbiology_df,
+    ) = load_data_from_cache(cache_dir, hadm_ids=hadm_ids)
+
+    hadm_info = extract_hadm_info(
+        hadm_ids,
+        discharge_df,
+        admissions_df,
+        transfers_df,
+        lab_events_df,
+        microbiology_df,
+        radiology_report_df,
+        radiology_report_details_df,
+    )
+    try:
+        hadm_info = postprocess_hadm_info(
+            hadm_info, sanitize_list, diag_df, procedures_df
+        )
+    except Exception as e:
+        print("Error in extracting info:, ", e)
+        traceback.print_exc()
+        return hadm_info, False
+    return hadm_info, True
+
+
+def extract_info_sharded(
+    hadm_ids,
+    pathology,
+    sanitize_list,
+    cache_dir,
+    num_workers=os.cpu_count(),
+    shards_per_worker=4,
+    output_dir="",
+):
+    """Sharded version of extract_info that processes the cohort in a pool of worker processes.
+
+    Every worker reads the tables of its shard from the memory-mapped parquet cache created by build_parquet_cache.
+    The per-shard results are merged in the order of hadm_ids, so the written files do not depend on num_workers.
+
+    Args:
+        hadm_ids: Admissions of the cohort
+        pathology: Name of the pathology used for the output files and the completeness check
+        sanitize_list: Disease names to remove from the texts
+        cache_dir: Folder of the parquet cache
+        num_workers: Number of worker processes. Runs in the current process if 1.
+        shards_per_worker: Number of shards per worker, to balance the load between workers
+        output_dir: Folder the hadm_info pickles are written to
+
+    Returns:
+        hadm_info and hadm_info_clean, as extract_info. If the post-processing of a shard failed, no files are written
+        and hadm_info_clean is None.
+    """
+    hadm_ids = list(hadm_ids)
+    admissions = load_table(
+        cache_dir, "admissions", columns=["hadm_id", "subject_id"], hadm_ids=hadm_ids
+    )
+    hadm_to_subject_id = admissions.set_index("hadm_id")["subject_id"].to_dict()
+    shards = shard_hadm_ids(
+        hadm_ids, hadm_to_subject_id, max(1, num_workers * shards_per_worker)
+    )
+    print(
+        "Extracting {} hadm_ids in {} shards with {} workers".format(
+            len(hadm_ids), len(shards), num_workers
+        )
+    )
+
+    shard_infos = []
+    if num_workers <= 1:
+        for shard in shards:
+            shard_infos.append(extract_shard(cache_dir, shard, sanitize_list))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(extract_shard, cache_dir, shard, sanitize_list)
+                for shard in shards
+            ]
+            shard_infos = [future.result() for future in futures]
+
+    # Merge in the order of hadm_ids to be independent of the sharding
+    merged = {}
+    for shard_info, _ in shard_infos:
+        merged.update(shard_info)
+    hadm_info = {_id: merged[_id] for _id in hadm_ids if _id in merged}
+    print("--")
+
+    hadm_info_clean = None
+    if not all(postprocessed for _, postprocessed in shard_infos):
+        return hadm_info, hadm_info_clean
+
+    try:
+        hadm_info_clean = write_hadm_info(hadm_info, pathology, output_dir)
+    except Exception as e:
+        print("Error in extracting info:, ", e)
+        traceback.print_exc()
+
+    return hadm_info, hadm_info_clean
@@ -2,6 +2,8 @@ from os.path import join
 import pickle
 import re
 
+import numpy as np
+
 
 def regex_extracter(text, regex):
     """
@@ -31,6 +33,38 @@ def last_substring_index(larger_string, substring):
     return last_index
 
 
+class HadmIndex:
+    """
+    Groups the rows of a DataFrame by hadm_id once, so that the rows of a single admission can be selected in
+    time proportional to the number of rows of that admission instead of the size of the table.
+
+    Args:
+        df (pd.DataFrame): DataFrame with a hadm_id column
+
+    Example:
+        index = HadmIndex(lab_events_df)
+        index.get(_id)  # same rows as lab_events_df[lab_events_df["hadm_id"] == _id]
+    """
+
+    def __init__(self, df, key="hadm_id"):
+        # Stable sort keeps the original row order within every admission. Missing ids are sorted last.
+        order = np.argsort(df[key].values, kind="stable")
+        self.df = df.iloc[order]
+        self.keys = self.df[key].values
+
+    def get(self, _id):
+        start = np.searchsorted(self.keys, _id, side="left")
+        end = np.searchsorted(self.keys, _id, side="right")
+        return self.df.iloc[start:end]
+
+
+def select_hadm(df, _id):
+    """Returns the rows of an admission from a DataFrame or a HadmIndex."""
+    if isinstance(df, HadmIndex):
+        return df.get(_id)
+    return df[df["hadm_id"] == _id]
+
+
 # Write fields as csv with $ separator
 def write_hadm_to_file(hadm_info, filename, base_mimic=""):
     # Write pickle for easy loading
@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from os.path import basename
+
+import pandas as pd
+from torch import Tensor
+
+from dataset.patient_store import load_patients
+from utils.results_log import read_results, RESULTS_LOG_SUFFIX
+from run import load_evaluator
+
+# Number of patients sent to a worker at once
+EVALUATION_CHUNK_SIZE = 64
+
+
+def patient_reference(patient):
+    """Reference tuple of _evaluate_agent_trajectory: discharge diagnosis, ICD diagnoses and procedures."""
+    return (
+        patient["Discharge Diagnosis"],
+        patient["ICD Diagnosis"],
+        patient["Procedures ICD9"],
+        patient["Procedures ICD10"],
+        patient["Procedures Discharge"],
+    )
+
+
+def evaluate_patient(pathology, result, reference):
+    """Scores the result of one patient with a new evaluator, so no scores or answers carry over between patients.
+    Results of run_full_info.py are the plain output of the model and have no trajectory.
+    """
+    evaluator = load_evaluator(pathology)
+    if isinstance(result, str):
+        result = {"input": "", "output": result, "intermediate_steps": []}
+    return evaluator._evaluate_agent_trajectory(
+        prediction=result["output"],
+        input=result["input"],
+        agent_trajectory=result["intermediate_steps"],
+        reference=reference,
+    )
+
+
+def evaluate_chunk(pathology, chunk):
+    return [
+        (_id, evaluate_patient(pathology, result, reference))
+        for _id, result, reference in chunk
+    ]
+
+
+def _column_value(value):
+    # Parquet columns need a single type, so nested answers (e.g. the correct lab tests per category) are stored as json
+    if isinstance(value, Tensor):
+        value = value.tolist()
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value, default=str)
+
+
+def evaluation_table(evaluations):
+    """One row per patient with a column for every score and answer, e.g. "scores.Diagnosis" and "answers.Treatment"."""
+    rows = []
+    for _id, evaluation in evaluations:
+        row = {"hadm_id": _id}
+        for field in ["scores", "answers"]:
+            for name, value in evaluation[field].items():
+                row[f"{field}.{name}"] = _column_value(value)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def stream_chunks(results_path, patients, chunk_size=EVALUATION_CHUNK_SIZE):
+    """Reads the results file record by record and yields chunks of (_id, result, reference)."""
+    chunk = []
+    for _id, result in read_results(results_path):
+        chunk.append((_id, result, patient_reference(patients[_id])))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_chunks(jobs, patients_by_pathology, chunk_size=EVALUATION_CHUNK_SIZE):
+    """Yields (results_path, pathology, chunk) for every chunk of every run, followed by (results_path, pathology, None)
+    once all chunks of a run were yielded."""
+    for results_path, run_pathology in jobs:
+        for chunk in stream_chunks(
+            results_path, patients_by_pathology[run_pathology], chunk_size
+        ):
+            yield results_path, run_pathology, chunk
+        yield results_path, run_pathology, None
+
+
+def evaluation_path(results_path):
+    for suffix in [RESULTS_LOG_SUFFIX, "_results.pkl"]:
+        results_path = results_path.replace(suffix, "")
+    return results_path + "_eval.parquet"
+
+
+def evaluate_runs(
+    results_paths,
+    base_mimic="",
+    pathology=None,
+    num_workers=os.cpu_count(),
+    chunk_size=EVALUATION_CHUNK_SIZE,
+    max_in_flight=None,
+):
+    """Scores all patients of several results files in one pool of worker processes and writes a table per file.
+
+    The results files are read chunk by chunk while the workers evaluate the previous chunks. At most max_in_flight
+    chunks are submitted and not yet collected, so only these and the rows of the current file are held in memory.
+
+    Args:
+        results_paths: Results logs written by run.py or run_sharded.py, or results pickles of earlier runs and of
+            run_full_info.py
+        base_mimic: Folder of the patient files (or patient stores) the references are read from
+        pathology: Pathology of all runs. By default taken from the start of the name of each results file.
+        num_workers: Number of worker processes. Runs in the current process if 1.
+        chunk_size: Number of patients sent to a worker at once
+        max_in_flight: Number of chunks submitted to the pool and not yet collected. Defaults to twice num_workers.
+
+    Returns:
+        Paths of the written tables, in the order of results_paths
+    """
+    patients_by_pathology = {}
+    jobs = []
+    for results_path in results_paths:
+        run_pathology = pathology or basename(results_path).split("_")[0]
+        if run_pathology not in patients_by_pathology:
+            patients_by_pathology[run_pathology] = load_patients(
+                f"{run_pathology}_hadm_info_first_diag", base_mimic=base_mimic
+            )
+        jobs.append((results_path, run_pathology))
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+
+    output_paths = []
+    evaluations = []
+
+    def collect(results_path, rows):
+        # Chunks are collected in the order they were submitted, so None marks the end of the current file
+        if isinstance(rows, Future):
+            rows = rows.result()
+        if rows is not None:
+            evaluations.extend(rows)
+            return
+        output_path = evaluation_path(results_path)
+        evaluation_table(evaluations).to_parquet(output_path, index=False)
+        output_paths.append(output_path)
+        print("Evaluated {} patients of {}".format(len(evaluations), results_path))
+        evaluations.clear()
+
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        # Chunks of the next file are submitted while the rows of the previous file are collected, so the pool
+        # stays busy across files
+        in_flight = deque()
+        for results_path, run_pathology, chunk in run_chunks(
+            jobs, patients_by_pathology, chunk_size
+        ):
+            if chunk is None:
+                rows = None
+            elif executor is None:
+                rows = evaluate_chunk(run_pathology, chunk)
+            else:
+                rows = executor.submit(evaluate_chunk, run_pathology, chunk)
+            in_flight.append((results_path, rows))
+            while len(in_flight) > max_in_flight:
+                collect(*in_flight.popleft())
+        while in_flight:
+            collect(*in_flight.popleft())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return output_paths
+
+
+if __name__ == "__main__":
+    # python evaluate.py <results.jsonl.zst> [<results.pkl> ...] --base_mimic <base_mimic>
+    parser = argparse.ArgumentParser(
+        description="Scores the results files of runs and writes a <run_name>_eval.parquet table next to each."
+    )
+    parser.add_argument("results_paths", nargs="+")
+    parser.add_argument("--base_mimic", default="")
+    parser.add_argument("--pathology", default=None)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk_size", type=int, default=EVALUATION_CHUNK_SIZE)
+    parser.add_argument("--max_in_flight", type=int, default=None)
+    cli_args = parser.parse_args()
+
+    start = time.perf_counter()
+    evaluate_runs(
+        cli_args.results_paths,
+        base_mimic=cli_args.base_mimic,
+        pathology=cli_args.pathology,
+        num_workers=cli_args.num_workers,
+        chunk_size=cli_args.chunk_size,
+        max_in_flight=cli_args.max_in_flight,
+    )
+    print("Finished in {:.1f}s".format(time.perf_counter() - start))
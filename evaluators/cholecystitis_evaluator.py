@@ -1,7 +1,7 @@
 from evaluators.pathology_evaluator import PathologyEvaluator
 from tools.utils import ADDITIONAL_LAB_TEST_MAPPING, INFLAMMATION_LAB_TESTS
 from utils.nlp import (
-    keyword_positive,
+    keywords_positive,
     procedure_checker,
     treatment_alternative_procedure_checker,
 )
@@ -127,15 +127,16 @@ class CholecystitisEvaluator(PathologyEvaluator):
         ):
             self.answers["Treatment Requested"]["Cholecystectomy"] = True
 
+        # Check all treatment keywords against a single parse of the treatment
+        fluid, analgesic, pain, antibiotic = keywords_positive(
+            self.answers["Treatment"], ["fluid", "analgesi", "pain", "antibiotic"]
+        )
+
         ### SUPPORT ###
-        if (
-            keyword_positive(self.answers["Treatment"], "fluid")
-            or keyword_positive(self.answers["Treatment"], "analgesi")
-            or keyword_positive(self.answers["Treatment"], "pain")
-        ):
+        if fluid or analgesic or pain:
             self.answers["Treatment Requested"]["Support"] = True
 
         ### ANTIBIOTICS ###
         # TODO: Check antibiotics against medications table
-        if keyword_positive(self.answers["Treatment"], "antibiotic"):
+        if antibiotic:
             self.answers["Treatment Requested"]["Antibiotics"] = True
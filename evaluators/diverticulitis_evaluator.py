@@ -3,7 +3,7 @@
 from evaluators.pathology_evaluator import PathologyEvaluator
 from utils.nlp import (
     procedure_checker,
-    keyword_positive,
+    keywords_positive,
     treatment_alternative_procedure_checker,
 )
 from tools.utils import ADDITIONAL_LAB_TEST_MAPPING, INFLAMMATION_LAB_TESTS
@@ -152,23 +152,25 @@ class DiverticulitisEvaluator(PathologyEvaluator):
             return True
 
     def score_treatment(self) -> None:
+        # Check all treatment keywords against a single parse of the treatment
+        colonoscopy, antibiotic, fluid, analgesic, pain = keywords_positive(
+            self.answers["Treatment"],
+            ["colonoscopy", "antibiotic", "fluid", "analgesi", "pain"],
+        )
+
         ### COLONOSCOPY ###
         # TODO: Must be done AFTER curation to check for cancer. During acute pathology can lead to perforation and is AGAINST the guidelines. Temporal order difficult to check automatically. Currently confirmed manually
         # if self.check_colonoscopy_time_order():
-        if keyword_positive(self.answers["Treatment"], "colonoscopy"):
+        if colonoscopy:
             self.answers["Treatment Requested"]["Colonoscopy"] = True
 
         ### ANTIBIOTICS ###
         # TODO: Check antibiotics against medications table
-        if keyword_positive(self.answers["Treatment"], "antibiotic"):
+        if antibiotic:
             self.answers["Treatment Requested"]["Antibiotics"] = True
 
         ### SUPPORT ###
-        if (
-            keyword_positive(self.answers["Treatment"], "fluid")
-            or keyword_positive(self.answers["Treatment"], "analgesi")
-            or keyword_positive(self.answers["Treatment"], "pain")
-        ):
+        if fluid or analgesic or pain:
             self.answers["Treatment Requested"]["Support"] = True
 
         ### DRAINAGE ###
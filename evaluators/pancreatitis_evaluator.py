@@ -2,7 +2,7 @@ from evaluators.pathology_evaluator import PathologyEvaluator
 from utils.nlp import (
     diagnosis_checker,
     procedure_checker,
-    keyword_positive,
+    keywords_positive,
     treatment_alternative_procedure_checker,
 )
 from tools.utils import ADDITIONAL_LAB_TEST_MAPPING, INFLAMMATION_LAB_TESTS
@@ -126,15 +126,17 @@ class PancreatitisEvaluator(PathologyEvaluator):
         return False
 
     def score_treatment(self) -> None:
+        # Check all treatment keywords against a single parse of the treatment
+        fluid, analgesic, pain, monitor = keywords_positive(
+            self.answers["Treatment"], ["fluid", "analgesi", "pain", "monitor"]
+        )
+
         ### SUPPORT ###
         if (
-            keyword_positive(self.answers["Treatment"], "fluid")
-            and (
-                keyword_positive(self.answers["Treatment"], "analgesi")
-                or keyword_positive(self.answers["Treatment"], "pain")
-            )
-            # and keyword_positive(self.answers["Treatment"], "nutrition")
-            and keyword_positive(self.answers["Treatment"], "monitor")
+            fluid
+            and (analgesic or pain)
+            # and nutrition
+            and monitor
         ):
             self.answers["Treatment Requested"]["Support"] = True
 
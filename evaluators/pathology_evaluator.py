@@ -11,6 +11,55 @@ from utils.nlp import keyword_positive, remove_punctuation
 from agents.DiagnosisWorkflowParser import InvalidActionError
 from models.utils import calculate_log_prob_confidence
 
+DIAGNOSIS_REGEX = re.compile(
+    r"(Final )?Diagnosis:([\s\S]*?)(?=[\.\n].*Treatment.*:|$)", flags=re.IGNORECASE
+)
+INTRO_SENTENCE_REGEX = re.compile(r"^Based on.*:\n\n")
+# Sections after the diagnosis that are cut off, in the order they are removed
+EXTRA_SECTIONS = [
+    "rationale",
+    "note",
+    "recommendation",
+    "explanation",
+    "finding",
+    "other.*diagnos.*include",
+    "other.*diagnos.*considered(?: were)?",
+    "management",
+    "action",
+    "plan",
+    "reasoning",
+    "assessment",
+    "justification",
+    "tests",
+    "additional diagnoses",
+    "notification",
+    "impression",
+    "background",
+    "additional findings include",
+]
+EXTRA_SECTION_REGEXES = [
+    re.compile(rf"{section}[s]?:", flags=re.IGNORECASE | re.DOTALL)
+    for section in EXTRA_SECTIONS
+]
+# Matches wherever any of the sections does. The lookahead lets re skip positions that can not start a section
+EXTRA_SECTIONS_REGEX = re.compile(
+    rf"(?=[{''.join(sorted(set(section[0] for section in EXTRA_SECTIONS)))}])"
+    rf"(?:{'|'.join(EXTRA_SECTIONS)})[s]?:",
+    flags=re.IGNORECASE | re.DOTALL,
+)
+NUMBERED_LIST_REGEX = re.compile(r"^1\.(.*)", flags=re.MULTILINE)
+NUMBERED_LIST_EXPLANATION_REGEX = re.compile(r"[-:].*")
+STAR_LIST_REGEX = re.compile(r"^\*(.*)", flags=re.MULTILINE)
+STAR_LIST_EXPLANATION_REGEX = re.compile(r"[-:] .*")
+DOUBLE_NEWLINE_REGEX = re.compile(r"\n\n.*")
+# Both start with .*? and so match at the start if they match anywhere. They are matched instead of searched, which
+# would try every other start position after a failed match
+DIAGNOSIS_SENTENCE_REGEX = re.compile(
+    r".*?diagnosis[^.\n]*?\bis\b(.*?)[.\n]", flags=re.DOTALL
+)
+PATIENT_HAS_REGEX = re.compile(r".*?patient has", flags=re.DOTALL)
+MULTIPLE_DIAGNOSES_REGEX = re.compile(r"[,.\n]|(?:\s*\b(?:and|or|vs[.]?)\b\s*)")
+
 
 class PathologyEvaluator(AgentTrajectoryEvaluator):
     """Evaluate the trajectory according to clinical diagnosis guidelines of <PATHOLOGY>."""
@@ -45,6 +94,7 @@ class PathologyEvaluator(AgentTrajectoryEvaluator):
             "Invalid Tools": 0,
             "Rounds": 0,
         }
+        self.diagnosis_parsing_trace = []
 
     def _evaluate_agent_trajectory(
         self,
@@ -122,106 +172,91 @@ class PathologyEvaluator(AgentTrajectoryEvaluator):
 
     def parse_diagnosis(self, prediction: str) -> str:
         """Takes prediction string and parses it for diagnosis. Checks how well the LLM held itself to the desired format.
+        The custom parsing rules that had to be applied are recorded in self.diagnosis_parsing_trace.
 
         Args:
             prediction (str): The prediction string.
         """
-        custom_parsing = False
-        regex = r"(Final )?Diagnosis:([\s\S]*?)(?=[\.\n].*Treatment.*:|$)"
-        match = re.search(regex, prediction, flags=re.IGNORECASE)
+        self.diagnosis_parsing_trace = []
+        trace = self.diagnosis_parsing_trace
+        match = DIAGNOSIS_REGEX.search(prediction)
         if match:
             # Instructions were to write Final Diagnosis. If not followed, penalize
             if not match.group(1):
-                custom_parsing = True
+                trace.append("missing final")
 
             diagnosis = match.group(2).strip()
 
             # Llama 2 Chat has an intro sentence we want to remove
             modify_check = diagnosis
-            diagnosis = re.sub(r"^Based on.*:\n\n", "", diagnosis)
+            diagnosis = INTRO_SENTENCE_REGEX.sub("", diagnosis)
             if modify_check != diagnosis:
-                custom_parsing = True
+                trace.append("intro sentence")
 
             # Delete extra sections so they are not parsed as diagnosis accidentally
-            modify_check = diagnosis
-            for section in [
-                "rationale",
-                "note",
-                "recommendation",
-                "explanation",
-                "finding",
-                "other.*diagnos.*include",
-                "other.*diagnos.*considered(?: were)?",
-                "management",
-                "action",
-                "plan",
-                "reasoning",
-                "assessment",
-                "justification",
-                "tests",
-                "additional diagnoses",
-                "notification",
-                "impression",
-                "background",
-                "additional findings include",
-            ]:
-                diagnosis = re.sub(
-                    rf"{section}[s]?:.*", "", diagnosis, flags=re.IGNORECASE | re.DOTALL
-                )
-            if modify_check != diagnosis:
-                custom_parsing = True
+            section = ":" in diagnosis and EXTRA_SECTIONS_REGEX.search(diagnosis)
+            if section:
+                trace.append("extra sections")
+                # Removing the sections one after the other cuts at the first section, unless the text of the first
+                # section contains another section that is removed before it
+                overlap = EXTRA_SECTIONS_REGEX.search(diagnosis, section.start() + 1)
+                if overlap is None or overlap.start() >= section.end():
+                    diagnosis = diagnosis[: section.start()]
+                else:
+                    for section_regex in EXTRA_SECTION_REGEXES:
+                        section = section_regex.search(diagnosis)
+                        if section:
+                            diagnosis = diagnosis[: section.start()]
 
             # Check for lists with numbers. Extract the first entry
             modify_check = diagnosis
-            match = re.search(r"^1\.(.*)", diagnosis, flags=re.MULTILINE)
+            match = NUMBERED_LIST_REGEX.search(diagnosis)
             if match:
                 diagnosis = match.group(1).strip()
             if modify_check != diagnosis:
-                custom_parsing = True
+                trace.append("numbered list")
                 # Remove unwanted explanations
-                diagnosis = re.sub(r"[-:].*", "", diagnosis)
+                diagnosis = NUMBERED_LIST_EXPLANATION_REGEX.sub("", diagnosis)
 
             # Check for lists using stars. Extract the first entry
             modify_check = diagnosis
-            match = re.search(r"^\*(.*)", diagnosis, flags=re.MULTILINE)
+            match = STAR_LIST_REGEX.search(diagnosis)
             if match:
                 diagnosis = match.group(1).strip()
             if modify_check != diagnosis:
-                custom_parsing = True
+                trace.append("star list")
                 # Remove unwanted explanations
-                diagnosis = re.sub(r"[-:] .*", "", diagnosis)
+                diagnosis = STAR_LIST_EXPLANATION_REGEX.sub("", diagnosis)
 
             # Llama 2 Chat often does a double newline with an explanation after the diagnosis
             modify_check = diagnosis
-            diagnosis = re.sub(r"\n\n.*", "", diagnosis)
+            diagnosis = DOUBLE_NEWLINE_REGEX.sub("", diagnosis)
             if modify_check != diagnosis:
-                custom_parsing = True
+                trace.append("double newline")
 
             # Check for diagnosis contained in the sentence
             modify_check = diagnosis
-            match = re.search(
-                r".*?diagnosis[^.\n]*?\bis\b(.*?)[.\n]", diagnosis, flags=re.DOTALL
-            )
+            match = DIAGNOSIS_SENTENCE_REGEX.match(diagnosis)
             if match:
                 diagnosis = match.group(1).strip()
             if modify_check != diagnosis:
-                custom_parsing = True
+                trace.append("diagnosis sentence")
 
             # Check for diagnosis contained in the sentence
             modify_check = diagnosis
-            diagnosis = re.sub(
-                r".*?patient has", "", diagnosis, count=1, flags=re.DOTALL
-            )
+            match = PATIENT_HAS_REGEX.match(diagnosis)
+            if match:
+                diagnosis = diagnosis[match.end() :]
             if modify_check != diagnosis:
-                custom_parsing = True
+                trace.append("patient has")
 
             # Check for multiple diagnoses.
-            diagnoses = re.split(r"[,.\n]|(?:\s*\b(?:and|or|vs[.]?)\b\s*)", diagnosis)
+            diagnoses = MULTIPLE_DIAGNOSES_REGEX.split(diagnosis)
             diagnoses = [d for d in diagnoses if d != ""]
 
             # Instructions were to just write a single diagnosis. If not followed, penalize
             if len(diagnoses) > 1:
-                custom_parsing = True
+                trace.append("multiple diagnoses")
 
             # We do not allow for more than two diagnoses. Indicated great uncertainty and task was to provide a single diagnosis
             # if len(diagnoses) > 2 or len(diagnoses) == 0:
@@ -231,7 +266,7 @@ class PathologyEvaluator(AgentTrajectoryEvaluator):
             else:
                 diagnosis = diagnoses[0]
 
-            if custom_parsing:
+            if trace:
                 self.scores["Diagnosis Parsing"] = 1
 
             self.answers["Diagnosis"] = diagnosis.strip()
@@ -7,6 +7,82 @@ from exllamav2 import (
 from exllamav2.generator import ExLlamaV2Sampler
 import torch
 import random
+from loguru import logger
+
+
+class GreedySampler:
+    """
+    Greedy sampling on the device of the logits. Meant to give the same tokens and probabilities as
+    ExLlamaV2Sampler.sample with top_k 1, but only the chosen tokens and their probabilities are copied to the CPU instead of all logits.
+    The repetition penalty is applied to the tokens seen so far only, whose positions are kept in a buffer for all
+    tokens of the generation.
+
+    Args:
+        gen_settings (ExLlamaV2Sampler.Settings): Greedy sampler settings, see supports
+        max_length (int): Length of the prompt and all tokens to generate
+    """
+
+    def __init__(self, gen_settings, max_length):
+        self.gen_settings = gen_settings
+        self.max_length = max_length
+        self.seen_tokens = None
+
+    @staticmethod
+    def supports(gen_settings):
+        return (
+            gen_settings.top_k == 1
+            and not gen_settings.filters
+            and not gen_settings.mirostat
+            and gen_settings.token_bias is None
+            and gen_settings.token_repetition_range == -1
+            and gen_settings.token_repetition_decay == 0
+        )
+
+    def _begin(self, logits, sequence_ids):
+        batch_size, vocab_size = logits.shape
+        self.rows = torch.arange(batch_size)
+        self.seen_tokens = torch.zeros((batch_size, vocab_size), dtype=torch.bool)
+        self.seen_tokens.scatter_(1, sequence_ids, True)
+        positions = self.seen_tokens.view(-1).nonzero()[:, 0]
+        self.seen_positions = torch.empty(
+            batch_size * self.max_length, dtype=torch.long, device=logits.device
+        )
+        self.seen_positions[: len(positions)] = positions.to(logits.device)
+        self.num_seen = len(positions)
+
+    def sample(self, logits, sequence_ids, collect_probabilities=True):
+        # The repetition penalty is applied in place, so the logits are always copied
+        logits = logits[:, -1, :].to(torch.float, copy=True)
+        if self.seen_tokens is None:
+            self._begin(logits, sequence_ids)
+
+        penalty = self.gen_settings.token_repetition_penalty
+        if penalty != 1.0:
+            flat_logits = logits.view(-1)
+            positions = self.seen_positions[: self.num_seen]
+            seen_logits = flat_logits[positions]
+            flat_logits[positions] = torch.where(
+                seen_logits > 0, seen_logits / penalty, seen_logits * penalty
+            )
+
+        # The sampler never picks token 0
+        token = logits[:, 1:].argmax(dim=-1, keepdim=True) + 1
+        token_cpu = token.cpu()
+
+        new = ~self.seen_tokens[self.rows, token_cpu[:, 0]]
+        if new.any():
+            rows, new_tokens = self.rows[new], token_cpu[new, 0]
+            self.seen_tokens[rows, new_tokens] = True
+            positions = rows * logits.shape[-1] + new_tokens
+            self.seen_positions[
+                self.num_seen : self.num_seen + len(positions)
+            ] = positions.to(logits.device)
+            self.num_seen += len(positions)
+
+        if not collect_probabilities:
+            return token_cpu, None
+        probabilities = torch.softmax(logits / self.gen_settings.temperature, dim=-1)
+        return token_cpu, probabilities.gather(1, token).cpu()
 
 
 class ExLlamaV2BaseGenerator:
@@ -18,10 +94,19 @@ class ExLlamaV2BaseGenerator:
 
     sequence_ids: torch.tensor = None
 
+    # Reuse the cached keys and values of the previous sequence for the common prefix of the next prompt
+    reuse_cache: bool = True
+
+    # Sample greedy settings with GreedySampler instead of ExLlamaV2Sampler.sample
+    greedy_sampling: bool = False
+
     def __init__(self, model, cache, tokenizer):
         self.model = model
         self.cache = cache
         self.tokenizer = tokenizer
+        self.cache_loras = None
+        # Number of reused and processed prompt tokens of the last prefill
+        self.last_prefill = (0, 0)
 
     # For testing purposes, run a forward pass to make sure CUDA is fully initialized
 
@@ -45,6 +130,7 @@ class ExLlamaV2BaseGenerator:
         decode_special_tokens=False,
         loras=None,
         stop_criteria=None,
+        collect_probabilities=True,
     ):
         # Accept LoRA or list of LoRAs
         if loras is not None and isinstance(loras, ExLlamaV2Lora):
@@ -87,29 +173,44 @@ class ExLlamaV2BaseGenerator:
             else None
         )
 
-        # Generate tokens
+        # Generate tokens into buffers preallocated for the prompt and all new tokens
+
+        prompt_length = self.sequence_ids.shape[-1]
+        sequence_ids = torch.empty(
+            (batch_size, prompt_length + num_tokens), dtype=torch.long
+        )
+        sequence_ids[:, :prompt_length] = self.sequence_ids
+        probabilities_sequence = (
+            torch.empty((batch_size, num_tokens)) if collect_probabilities else None
+        )
+        greedy_sampler = None
+        if self.greedy_sampling and GreedySampler.supports(gen_settings):
+            greedy_sampler = GreedySampler(gen_settings, prompt_length + num_tokens)
 
-        probabilities_sequence = torch.tensor([[]])
+        num_generated = 0
         for _ in range(num_tokens):
-            logits = (
-                self.model.forward(
-                    self.sequence_ids[:, -1:], self.cache, input_mask=mask, loras=loras
-                )
-                .float()
-                .cpu()
-            )
-            token, probabilities, eos = ExLlamaV2Sampler.sample(
-                logits,
-                gen_settings,
-                self.sequence_ids,
-                random.random(),
-                self.tokenizer,
-                prefix_token=unhealed_token,
-            )
-            self.sequence_ids = torch.cat([self.sequence_ids, token], dim=1)
-            probabilities_sequence = torch.cat(
-                [probabilities_sequence, probabilities], dim=1
+            logits = self.model.forward(
+                self.sequence_ids[:, -1:], self.cache, input_mask=mask, loras=loras
             )
+            if greedy_sampler is not None and unhealed_token is None:
+                token, probabilities = greedy_sampler.sample(
+                    logits, self.sequence_ids, collect_probabilities
+                )
+                eos = False
+            else:
+                token, probabilities, eos = ExLlamaV2Sampler.sample(
+                    logits.float().cpu(),
+                    gen_settings,
+                    self.sequence_ids,
+                    random.random(),
+                    self.tokenizer,
+                    prefix_token=unhealed_token,
+                )
+            sequence_ids[:, prompt_length + num_generated] = token[:, 0]
+            if collect_probabilities:
+                probabilities_sequence[:, num_generated] = probabilities[:, 0]
+            num_generated += 1
+            self.sequence_ids = sequence_ids[:, : prompt_length + num_generated]
             gen_settings.feed_filters(token)
 
             # Check for stop tokens
@@ -120,6 +221,8 @@ class ExLlamaV2BaseGenerator:
             if eos:
                 break
 
+        if collect_probabilities:
+            probabilities_sequence = probabilities_sequence[:, :num_generated]
         return self.sequence_ids, probabilities_sequence
 
         # Decode
@@ -132,15 +235,41 @@ class ExLlamaV2BaseGenerator:
             return text[0]
         return text
 
+    def cached_prefix_length(self, input_ids, mask=None, loras=None):
+        """Returns the number of leading tokens of input_ids whose keys and values are already in the cache."""
+        if (
+            not self.reuse_cache
+            or self.sequence_ids is None
+            or mask is not None
+            or input_ids.shape[0] != 1
+            or self.sequence_ids.shape[0] != 1
+            or loras != self.cache_loras
+        ):
+            return 0
+
+        # The cache holds the previous sequence up to current_seq_len. The last token of the prompt is always processed
+        cached_ids = self.sequence_ids[0, : self.cache.current_seq_len]
+        new_ids = input_ids[0, :-1]
+        length = min(cached_ids.shape[-1], new_ids.shape[-1])
+        mismatches = (cached_ids[:length] != new_ids[:length]).nonzero()
+        return mismatches[0].item() if len(mismatches) else length
+
     def _gen_begin_base(self, input_ids, mask=None, loras=None):
-        self.cache.current_seq_len = 0
+        reused = self.cached_prefix_length(input_ids, mask, loras)
+        self.cache.current_seq_len = reused
         self.model.forward(
-            input_ids[:, :-1],
+            input_ids[:, reused:-1],
             self.cache,
             input_mask=mask,
             preprocess_only=True,
             loras=loras,
         )
+        self.cache_loras = loras
+
+        self.last_prefill = (reused, input_ids.shape[-1] - 1 - reused)
+        logger.info(
+            f"Prefill: reused {self.last_prefill[0]} cached tokens, processed {self.last_prefill[1]} new tokens"
+        )
 
         self.sequence_ids = input_ids.clone()
         self.sequence_ids = input_ids
@@ -1,6 +1,6 @@
 import os
 from os.path import join
-from typing import Any, List, Mapping, Dict
+from typing import Any, List, Mapping, Dict, Optional
 
 import torch
 import openai
@@ -9,15 +9,33 @@ from tenacity import (
     stop_after_attempt,
     wait_random_exponential,
 )
-from transformers import GenerationConfig, StoppingCriteriaList
+from transformers import GenerationConfig, StoppingCriteriaList, LogitsProcessorList
 from auto_gptq import exllama_set_max_input_length
 from langchain.llms.base import LLM
+from langchain.schema import Generation, LLMResult
 from exllamav2.generator import ExLlamaV2Sampler
 import tiktoken
 
-from models.utils import create_stop_criteria, create_stop_criteria_exllama
+from models.utils import (
+    create_stop_criteria,
+    create_stop_criteria_exllama,
+    BatchKeywordsStoppingCriteria,
+    PaddedRepetitionPenaltyLogitsProcessor,
+)
 from agents.agent import STOP_WORDS
-from utils.nlp import extract_sections
+from models.openai_async import AsyncOpenAIEngine
+from utils.nlp import extract_sections, calculate_num_tokens
+
+# Defaults of the transformers generation arguments of _call, which are part of the response cache key
+HF_GENERATION_DEFAULTS = dict(
+    do_sample=True,
+    temperature=0.01,
+    top_k=1,
+    top_p=0.95,
+    num_beams=1,
+    repetition_penalty=1.2,
+    length_penalty=1.0,
+)
 
 
 class CustomLLM(LLM):
@@ -33,8 +51,20 @@ class CustomLLM(LLM):
     tokenizer: Any
     seed: int
     self_consistency: bool = False
+    batch_size: int = 1
+    batch_generator: Any = None
+    collect_probabilities: bool = True
+    greedy_sampling: bool = False
+    prefix_ids: Any = None
+    prefix_past_key_values: Any = None
 
     openai_api_key: str = None
+    openai_api_base: str = None
+    openai_max_concurrency: int = 8
+    openai_requests_per_minute: int = None
+    openai_tokens_per_minute: int = None
+    openai_engine: Any = None
+    response_cache: Any = None
     tags: Dict[str, str] = None
 
     @property
@@ -69,6 +99,17 @@ class CustomLLM(LLM):
         elif self.openai_api_key:
             self.tokenizer = tiktoken.encoding_for_model(self.model_name)
             openai.api_key = self.openai_api_key
+            self.openai_engine = AsyncOpenAIEngine(
+                api_key=self.openai_api_key,
+                model_name=self.model_name,
+                api_base=self.openai_api_base,
+                max_concurrency=self.openai_max_concurrency,
+                requests_per_minute=self.openai_requests_per_minute,
+                tokens_per_minute=self.openai_tokens_per_minute,
+                count_tokens=lambda messages: calculate_num_tokens(
+                    self.tokenizer, [m["content"] for m in messages]
+                ),
+            )
             return
         elif (
             self.model_name
@@ -108,7 +149,15 @@ class CustomLLM(LLM):
                 self.generator = ExLlamaV2BaseGenerator(
                     self.model, cache, self.tokenizer
                 )
+                self.generator.greedy_sampling = self.greedy_sampling
                 self.generator.warmup()
+                if self.batch_size > 1:
+                    # Batched generation needs a cache with one row per prompt
+                    batch_cache = ExLlamaV2Cache(self.model, batch_size=self.batch_size)
+                    self.batch_generator = ExLlamaV2BaseGenerator(
+                        self.model, batch_cache, self.tokenizer
+                    )
+                    self.batch_generator.greedy_sampling = self.greedy_sampling
 
             else:
                 from transformers import LlamaTokenizer, LlamaForCausalLM
@@ -260,6 +309,43 @@ class CustomLLM(LLM):
         repetition_penalty=1.2,
         length_penalty=1.0,
         **kwargs,
+    ) -> str:
+        generation_kwargs = dict(
+            do_sample=do_sample,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            num_beams=num_beams,
+            repetition_penalty=repetition_penalty,
+            length_penalty=length_penalty,
+            **kwargs,
+        )
+        cache_key = self.response_cache_key(prompt, stop, generation_kwargs)
+        if cache_key is not None:
+            entry = self.response_cache.get(
+                cache_key, require_probabilities=self.requires_probabilities()
+            )
+            if entry is not None:
+                output, self.probabilities = entry
+                return output
+
+        output = self._generate_uncached(prompt, stop, **generation_kwargs)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, output, self.probabilities)
+        return output
+
+    def _generate_uncached(
+        self,
+        prompt: str,
+        stop: List[str],
+        do_sample=True,
+        temperature=0.01,
+        top_k=1,
+        top_p=0.95,
+        num_beams=1,
+        repetition_penalty=1.2,
+        length_penalty=1.0,
+        **kwargs,
     ) -> str:
         self.probabilities = None
         if self.model_name == "Human":
@@ -271,14 +357,17 @@ class CustomLLM(LLM):
                 self.tags,
             )
 
-            response = self.completion_with_backoff(
-                model=self.model_name,
-                messages=messages,
-                stop=STOP_WORDS,
-                temperature=0.0,
-                seed=self.seed,
-            )
-            output = response["choices"][0]["message"]["content"]
+            if self.openai_engine is not None:
+                output = self.openai_engine.complete(
+                    messages, **self.openai_parameters()
+                )
+            else:
+                response = self.completion_with_backoff(
+                    model=self.model_name,
+                    messages=messages,
+                    **self.openai_parameters(),
+                )
+                output = response["choices"][0]["message"]["content"]
         elif self.exllama:
             with torch.inference_mode():
                 ids = self.tokenizer.encode(prompt, encode_special_tokens=True)
@@ -306,6 +395,7 @@ class CustomLLM(LLM):
                     encode_special_tokens=True,
                     decode_special_tokens=False,
                     stop_criteria=stop_criteria,
+                    collect_probabilities=self.collect_probabilities,
                 )
 
                 output_tokens = self.remove_input_tokens(output_tokens, ids)
@@ -338,6 +428,12 @@ class CustomLLM(LLM):
                 stop, self.tokenizer, self.model.device
             )
 
+            # Start from the keys and values of the cached prefix if the prompt begins with it
+            past_key_values = self.prefix_cache_for(input_ids)
+            cache_kwargs = {}
+            if past_key_values is not None:
+                cache_kwargs["past_key_values"] = past_key_values
+
             with torch.no_grad():
                 generation_output = self.model.generate(
                     input_ids=input_ids,
@@ -346,6 +442,7 @@ class CustomLLM(LLM):
                     return_dict_in_generate=True,
                     output_scores=True,
                     max_length=self.max_context_length,
+                    **cache_kwargs,
                 )
 
             s = generation_output.sequences
@@ -354,12 +451,356 @@ class CustomLLM(LLM):
                 0
             ]
 
+        return self.clean_output(output, stop)
+
+    def cache_prefix(self, prefix: str) -> int:
+        """Computes the keys and values of a prefix that is shared by all prompts of a run, e.g. the system prompt
+        and fewshot examples, so that they are not recomputed for every patient. Prompts reuse the cache up to the
+        first token in which they differ from the prefix. Only decoder models loaded with transformers are supported,
+        for all other models nothing is cached.
+
+        Args:
+            prefix (str): Static start of the prompts
+
+        Returns:
+            int: Number of cached tokens
+        """
+        self.prefix_ids = None
+        self.prefix_past_key_values = None
+        if (
+            self.model_name == "Human"
+            or self.openai_api_key
+            or self.exllama
+            or self.model.config.is_encoder_decoder
+        ):
+            return 0
+
+        prefix_ids = self.tokenizer(
+            prefix,
+            return_tensors="pt",
+            max_length=self.max_context_length,
+            truncation=True,
+            padding=False,
+        )["input_ids"].to(self.model.device)
+        # generate masks padding tokens in the prompt, so the prefix is only cached up to the first one
+        if self.tokenizer.pad_token_id is not None:
+            padding = (prefix_ids[0] == self.tokenizer.pad_token_id).nonzero()
+            if len(padding):
+                prefix_ids = prefix_ids[:, : padding[0].item()]
+        if prefix_ids.shape[1] == 0:
+            return 0
+
+        with torch.no_grad():
+            past_key_values = self.model(
+                input_ids=prefix_ids, use_cache=True
+            ).past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+
+        self.prefix_ids = prefix_ids
+        self.prefix_past_key_values = past_key_values
+        return prefix_ids.shape[1]
+
+    def prefix_cache_for(self, input_ids: torch.Tensor):
+        """Returns the cached keys and values of the longest common prefix of input_ids and the cached prefix.
+
+        At least the last token of input_ids is left to be processed. Generation never modifies the returned tensors
+        in place, so the cached prefix stays valid for all following prompts.
+        """
+        if self.prefix_past_key_values is None or input_ids.shape[0] != 1:
+            return None
+
+        length = min(self.prefix_ids.shape[1], input_ids.shape[1] - 1)
+        mismatches = (
+            self.prefix_ids[0, :length]
+            != input_ids[0, :length].to(self.prefix_ids.device)
+        ).nonzero()
+        if len(mismatches):
+            length = mismatches[0].item()
+        if length == 0:
+            return None
+
+        return tuple(
+            tuple(tensor[:, :, :length] for tensor in layer)
+            for layer in self.prefix_past_key_values
+        )
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        """Generates the prompts of LLM.generate, e.g. from LLMChain.apply, with generate_batch."""
+        if len(prompts) == 1 or kwargs:
+            return super()._generate(
+                prompts, stop=stop, run_manager=run_manager, **kwargs
+            )
+        outputs = self.generate_batch(prompts, stop or [])
+        return LLMResult(generations=[[Generation(text=output)] for output in outputs])
+
+    def response_cache_key(
+        self, prompt: str, stop: List[str], generation_kwargs: Dict[str, Any] = None
+    ) -> Optional[str]:
+        """Returns the key of a prompt in the response cache, or None if its output must not be cached because there
+        is no cache, the output is sampled or it is typed in by a human."""
+        if (
+            self.response_cache is None
+            or self.self_consistency
+            or self.model_name == "Human"
+        ):
+            return None
+
+        if self.openai_api_key:
+            settings = self.openai_parameters()
+        elif self.exllama:
+            # _call and generate_batch always decode greedily with healed tokens
+            settings = {"sampler": "greedy", "seed": self.seed, "token_healing": True}
+        else:
+            settings = {**HF_GENERATION_DEFAULTS, **(generation_kwargs or {})}
+            settings["truncation_side"] = self.tokenizer.truncation_side
+        settings["max_context_length"] = self.max_context_length
+        return self.response_cache.key(self.model_name, prompt, stop, settings)
+
+    def requires_probabilities(self) -> bool:
+        # Only the exllama generator returns the probabilities of the output tokens
+        return self.exllama and self.collect_probabilities
+
+    def openai_parameters(self) -> Dict[str, Any]:
+        return {"stop": STOP_WORDS, "temperature": 0.0, "seed": self.seed}
+
+    def clean_output(self, output: str, stop: List[str]) -> str:
         # Remove observations strings from output if generated
         for stop_word in STOP_WORDS + stop:
             output = output.replace(stop_word, "")
 
         return output.strip()
 
+    def generate_batch(self, prompts: List[str], stop: List[str]) -> List[str]:
+        """Generates the outputs of multiple prompts in batches of batch_size prompts.
+
+        Prompts are left-padded and generated together. Every prompt stops at its own stop words and the batch ends
+        once all prompts have stopped. Under greedy decoding the outputs are the same as calling the model for every
+        prompt. Prompts that did not stop within the token budget of the longest prompt of their batch are generated
+        on their own afterwards. Prompts to OpenAI models are all sent at once and the engine limits how many are in
+        flight. The Human model always runs prompt by prompt. Probabilities are not collected.
+
+        Args:
+            prompts (List[str]): The prompts to generate outputs for
+            stop (List[str]): Stop words
+
+        Returns:
+            List[str]: One output per prompt
+        """
+        keys = [self.response_cache_key(prompt, stop) for prompt in prompts]
+        outputs = [None] * len(prompts)
+        for i, key in enumerate(keys):
+            if key is not None:
+                # Batches never collect probabilities
+                entry = self.response_cache.get(key)
+                if entry is not None:
+                    outputs[i] = entry[0]
+
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            generated = self._generate_batch([prompts[i] for i in missing], stop)
+            for i, output in zip(missing, generated):
+                outputs[i] = output
+                if keys[i] is not None:
+                    self.response_cache.put(keys[i], output)
+        self.probabilities = None
+        return outputs
+
+    def _generate_batch(self, prompts: List[str], stop: List[str]) -> List[str]:
+        if self.openai_api_key and self.openai_engine is not None:
+            self.probabilities = None
+            outputs = self.openai_engine.complete_all(
+                [extract_sections(prompt, self.tags) for prompt in prompts],
+                **self.openai_parameters(),
+            )
+            return [self.clean_output(output, stop) for output in outputs]
+        if self.model_name == "Human" or self.openai_api_key or self.batch_size <= 1:
+            return [self._generate_uncached(prompt, stop) for prompt in prompts]
+
+        self.probabilities = None
+        outputs = []
+        for i in range(0, len(prompts), self.batch_size):
+            batch = prompts[i : i + self.batch_size]
+            if len(batch) == 1:
+                outputs.append(self._generate_uncached(batch[0], stop))
+                continue
+            if self.exllama:
+                batch_outputs = self._generate_batch_exllama(batch, stop)
+            else:
+                batch_outputs = self._generate_batch_hf(batch, stop)
+            for prompt, output in zip(batch, batch_outputs):
+                if output is None:
+                    outputs.append(self._generate_uncached(prompt, stop))
+                else:
+                    outputs.append(self.clean_output(output, stop))
+        return outputs
+
+    def _generate_batch_exllama(self, prompts: List[str], stop: List[str]):
+        with torch.inference_mode():
+            ids = [
+                self.tokenizer.encode(prompt, encode_special_tokens=True)
+                for prompt in prompts
+            ]
+            lengths = [prompt_ids.shape[-1] for prompt_ids in ids]
+            num_tokens = self.max_context_length - max(lengths)
+            if num_tokens < 1:
+                return [None] * len(prompts)
+
+            settings = ExLlamaV2Sampler.Settings()
+            if self.self_consistency:
+                settings = settings.clone()
+                settings.temperature = 0.7
+                seed = None
+            else:
+                settings = settings.greedy_clone()
+                seed = self.seed
+
+            stop_criteria = BatchKeywordsStoppingCriteria(
+                create_stop_criteria_exllama(
+                    stop, self.tokenizer.eos_token_id, self.tokenizer
+                ).keywords,
+                len(prompts),
+            )
+
+            output_tokens, _ = self.batch_generator.generate_simple(
+                prompts,
+                gen_settings=settings,
+                num_tokens=num_tokens,
+                seed=seed,
+                token_healing=True,
+                encode_special_tokens=True,
+                decode_special_tokens=False,
+                stop_criteria=stop_criteria,
+                collect_probabilities=False,
+            )
+
+            outputs = []
+            padded_length = max(lengths)
+            generated = output_tokens.shape[-1] - padded_length
+            for i, (prompt_ids, length) in enumerate(zip(ids, lengths)):
+                finished_length = stop_criteria.finished_lengths[i]
+                if finished_length is None:
+                    # Ran out of the shared budget before its own budget was used up
+                    if length + generated < self.max_context_length:
+                        outputs.append(None)
+                        continue
+                    finished_length = output_tokens.shape[-1]
+                row_tokens = output_tokens[
+                    i : i + 1, padded_length - length : finished_length
+                ]
+                row_tokens = self.remove_input_tokens(row_tokens, prompt_ids)
+                outputs.append(
+                    self.tokenizer.decode(row_tokens, decode_special_tokens=False)[0]
+                )
+            return outputs
+
+    def _generate_batch_hf(
+        self,
+        prompts: List[str],
+        stop: List[str],
+        do_sample=True,
+        temperature=0.01,
+        top_k=1,
+        top_p=0.95,
+        num_beams=1,
+        repetition_penalty=1.2,
+        length_penalty=1.0,
+    ):
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+
+        # Tokenize every prompt as in _call and pad on the left
+        ids = [
+            self.tokenizer(
+                prompt,
+                max_length=self.max_context_length,
+                truncation=True,
+                padding=False,
+            )["input_ids"]
+            for prompt in prompts
+        ]
+        lengths = [len(prompt_ids) for prompt_ids in ids]
+        padded_length = max(lengths)
+        if padded_length >= self.max_context_length:
+            return [None] * len(prompts)
+        input_ids = torch.full((len(ids), padded_length), pad_token_id)
+        attention_mask = torch.zeros((len(ids), padded_length), dtype=torch.long)
+        for i, prompt_ids in enumerate(ids):
+            input_ids[i, padded_length - len(prompt_ids) :] = torch.tensor(prompt_ids)
+            attention_mask[i, padded_length - len(prompt_ids) :] = 1
+        pad_lengths = padded_length - torch.tensor(lengths)
+
+        generation_config = GenerationConfig(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_beams=num_beams,
+            do_sample=do_sample,
+            # Applied by PaddedRepetitionPenaltyLogitsProcessor instead
+            repetition_penalty=1.0,
+            length_penalty=length_penalty,
+            pad_token_id=pad_token_id,
+        )
+
+        stop_criteria = BatchKeywordsStoppingCriteria(
+            create_stop_criteria(stop, self.tokenizer, self.model.device).keywords,
+            len(prompts),
+        )
+
+        with torch.no_grad():
+            generation_output = self.model.generate(
+                input_ids=input_ids.to(self.model.device),
+                attention_mask=attention_mask.to(self.model.device),
+                generation_config=generation_config,
+                logits_processor=LogitsProcessorList(
+                    [
+                        PaddedRepetitionPenaltyLogitsProcessor(
+                            repetition_penalty, pad_lengths
+                        )
+                    ]
+                ),
+                stopping_criteria=StoppingCriteriaList([stop_criteria]),
+                return_dict_in_generate=True,
+                max_length=self.max_context_length,
+            )
+
+        # Sequences that generated an eos token are finished and padded by generate
+        eos_token_id = self.model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = []
+        elif isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+
+        s = generation_output.sequences
+        generated = s.shape[1] - padded_length
+        outputs = []
+        for i, length in enumerate(lengths):
+            finished_length = stop_criteria.finished_lengths[i]
+            for j, token in enumerate(s[i, padded_length:].tolist()):
+                if token in eos_token_id:
+                    if finished_length is None or padded_length + j < finished_length:
+                        finished_length = padded_length + j + 1
+                    break
+            if finished_length is None:
+                # Ran out of the shared budget before its own budget was used up
+                if length + generated < self.max_context_length:
+                    outputs.append(None)
+                    continue
+                finished_length = s.shape[1]
+            outputs.append(
+                self.tokenizer.decode(
+                    s[i, padded_length:finished_length], skip_special_tokens=True
+                )
+            )
+        return outputs
+
     @property
     def _identifying_params(self) -> Mapping[str, Any]:
         """Get the identifying parameters."""
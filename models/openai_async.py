@@ -0,0 +1,233 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+from loguru import logger
+
+# Status codes after which a request is sent again
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class OpenAIRequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"OpenAI request failed with status {status}: {message}")
+        self.status = status
+
+
+class RateLimiter:
+    """
+    Token buckets for the requests and tokens per minute of an API key. Both buckets start full and refill
+    continuously. A request waits until both buckets hold enough for it. A limit of None is not enforced.
+
+    Args:
+        requests_per_minute (int): Maximum number of requests per minute
+        tokens_per_minute (int): Maximum number of prompt and completion tokens per minute
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.limits)
+        self.clock = clock
+        self.last_refill = clock()
+        self.blocked_until = 0.0
+        self.lock = None
+
+    def _refill(self):
+        now = self.clock()
+        for name, limit in self.limits.items():
+            if limit:
+                self.available[name] = min(
+                    limit, self.available[name] + (now - self.last_refill) * limit / 60
+                )
+        self.last_refill = now
+
+    def _wait_time(self, needed: Dict[str, float]) -> float:
+        wait = self.blocked_until - self.clock()
+        for name, amount in needed.items():
+            limit = self.limits[name]
+            if limit:
+                wait = max(wait, (amount - self.available[name]) * 60 / limit)
+        return wait
+
+    async def acquire(self, num_tokens: int = 0):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # Requests are admitted in order, so a large request is not starved by smaller ones
+        async with self.lock:
+            needed = {"requests": 1, "tokens": num_tokens}
+            # A single request may use up a whole minute of tokens
+            if self.limits["tokens"]:
+                needed["tokens"] = min(num_tokens, self.limits["tokens"])
+            while True:
+                self._refill()
+                wait = self._wait_time(needed)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            for name, amount in needed.items():
+                if self.limits[name]:
+                    self.available[name] -= amount
+
+    def consume(self, num_tokens: int):
+        """Charges tokens that were only known after the request, i.e. the completion tokens."""
+        if self.limits["tokens"]:
+            self._refill()
+            self.available["tokens"] -= num_tokens
+
+    def block(self, seconds: float):
+        """Holds back all requests, e.g. for the retry-after time the API returned."""
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+
+class AsyncOpenAIEngine:
+    """
+    Sends chat completion requests to an OpenAI compatible API concurrently. At most max_concurrency requests are in
+    flight, and the requests and tokens per minute are rate limited. Failed requests are retried after the
+    retry-after time the API returns, or after an exponential backoff.
+
+    The engine runs its own event loop in a background thread, so complete and complete_all can be called from any
+    thread and all threads share the concurrency and rate limits.
+
+    Example:
+        engine = AsyncOpenAIEngine(api_key, "gpt-4", max_concurrency=16, tokens_per_minute=300000)
+        outputs = engine.complete_all([[{"role": "user", "content": "..."}], ...], temperature=0.0)
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        api_base: Optional[str] = None,
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        count_tokens: Optional[Callable[[List[Dict[str, str]]], int]] = None,
+        max_retries: int = 10,
+        min_wait: float = 1,
+        max_wait: float = 60,
+        timeout: float = 600,
+    ):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.url = (api_base or "https://api.openai.com/v1").rstrip(
+            "/"
+        ) + "/chat/completions"
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        # Rough estimate of four characters per token if no tokenizer is given
+        self.count_tokens = count_tokens or (
+            lambda messages: sum(len(m["content"]) for m in messages) // 4
+        )
+        self.max_retries = max_retries
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def _run(self, coroutine):
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, daemon=True
+                )
+                self._thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _backoff(self, attempt: int) -> float:
+        # Same as tenacity's wait_random_exponential
+        return max(
+            self.min_wait,
+            random.uniform(0, min(self.max_wait, self.min_wait * 2**attempt)),
+        )
+
+    @staticmethod
+    def _retry_after(headers) -> Optional[float]:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            try:
+                return float(headers["retry-after"])
+            except ValueError:
+                return None
+        return None
+
+    async def acomplete(self, messages: List[Dict[str, str]], **params) -> str:
+        """Returns the content of the first choice. Must be awaited in the loop of the engine."""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        body = {"model": self.model_name, "messages": messages, **params}
+        num_tokens = self.count_tokens(messages) + params.get("max_tokens", 0)
+        for attempt in range(self.max_retries):
+            async with self._semaphore:
+                await self.rate_limiter.acquire(num_tokens)
+                try:
+                    async with self._session.post(self.url, json=body) as response:
+                        text = await response.text()
+                        status = response.status
+                        retry_after = self._retry_after(response.headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    status, text, retry_after = None, str(e), None
+
+            if status == 200:
+                result = json.loads(text)
+                usage = result.get("usage", {})
+                self.rate_limiter.consume(usage.get("completion_tokens", 0))
+                return result["choices"][0]["message"]["content"]
+            if status is not None and status not in RETRY_STATUSES:
+                raise OpenAIRequestError(status, text)
+
+            wait = retry_after if retry_after is not None else self._backoff(attempt)
+            if status == 429:
+                self.rate_limiter.block(wait)
+            logger.warning(
+                f"OpenAI request failed with status {status}, retrying in {wait:.1f}s: {text[:200]}"
+            )
+            await asyncio.sleep(wait)
+        raise OpenAIRequestError(status, text)
+
+    async def acomplete_all(
+        self, messages_list: List[List[Dict[str, str]]], **params
+    ) -> List[str]:
+        return await asyncio.gather(
+            *[self.acomplete(messages, **params) for messages in messages_list]
+        )
+
+    def complete(self, messages: List[Dict[str, str]], **params) -> str:
+        return self._run(self.acomplete(messages, **params))
+
+    def complete_all(
+        self, messages_list: List[List[Dict[str, str]]], **params
+    ) -> List[str]:
+        """Sends all requests concurrently and returns the outputs in the order of messages_list."""
+        return self._run(self.acomplete_all(messages_list, **params))
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._session is not None:
+            self._run(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._session = None
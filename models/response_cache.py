@@ -0,0 +1,100 @@
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class ResponseCache:
+    """
+    Disk-backed cache of model outputs, keyed on the model, the full prompt, the stop words and the decoding settings.
+
+    Greedy decoding with a fixed seed always produces the same output for the same prompt, so runs that are repeated
+    after a crash or that share turns with an earlier run read their outputs from the cache instead of generating them
+    again. Entries are stored in a SQLite table, so several processes and threads can share one cache file.
+
+    Args:
+        path (str): Path to the .db file. It is created if it does not exist.
+
+    Example:
+        cache = ResponseCache("responses.db")
+        key = cache.key("gpt-4", prompt, stop, {"temperature": 0.0, "seed": 2023})
+        entry = cache.get(key)
+        if entry is None:
+            cache.put(key, output)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._connection:
+            # Lets readers in other processes continue while one process writes
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, output TEXT NOT NULL, probabilities BLOB)"
+            )
+
+    @staticmethod
+    def key(
+        model_name: str, prompt: str, stop: List[str], settings: Dict[str, Any]
+    ) -> str:
+        """Returns the sha256 hash of everything that determines the output of a greedy generation."""
+        data = json.dumps(
+            {
+                "model_name": model_name,
+                "prompt": prompt,
+                "stop": list(stop),
+                "settings": settings,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(
+        self, key: str, require_probabilities: bool = False
+    ) -> Optional[Tuple[str, Any]]:
+        """Returns the cached output and probabilities, or None if the key is not cached. With require_probabilities,
+        outputs that were cached without their probabilities count as not cached."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT output, probabilities FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (require_probabilities and row[1] is None):
+                self.misses += 1
+                return None
+            self.hits += 1
+        output, probabilities = row
+        if probabilities is not None:
+            probabilities = pickle.loads(probabilities)
+        return output, probabilities
+
+    def put(self, key: str, output: str, probabilities: Any = None):
+        if probabilities is not None:
+            probabilities = pickle.dumps(probabilities)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, output, probabilities),
+            )
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
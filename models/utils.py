@@ -1,6 +1,6 @@
 from typing import List
 import torch
-from transformers import StoppingCriteria
+from transformers import StoppingCriteria, LogitsProcessor
 
 
 def calculate_prob_confidence(probs: torch.Tensor):
@@ -46,13 +46,102 @@ def create_stop_criteria_exllama(
 
 
 class KeywordsStoppingCriteria(StoppingCriteria):
-    def __init__(self, keywords: torch.Tensor):
+    """
+    Stops the generation once a sequence ends with one of the keywords. The keywords are right aligned in a padded
+    tensor, so that all of them are checked against the last tokens of every sequence in a single comparison.
+
+    Args:
+        keywords (List[torch.Tensor]): Token ids of the keywords
+    """
+
+    def __init__(self, keywords: List[torch.Tensor]):
         self.keywords = keywords
 
+        # Duplicates, e.g. words encoded the same with and without a leading period, only need to be checked once
+        unique_keywords = list(
+            {tuple(k.tolist()): k for k in keywords if len(k) > 0}.keys()
+        )
+        self.max_length = max((len(k) for k in unique_keywords), default=0)
+        self.keyword_ids = torch.full(
+            (len(unique_keywords), self.max_length), -1, dtype=torch.long
+        )
+        self.keyword_mask = torch.zeros(
+            (len(unique_keywords), self.max_length), dtype=torch.bool
+        )
+        for i, k in enumerate(unique_keywords):
+            self.keyword_ids[i, self.max_length - len(k) :] = torch.tensor(k)
+            self.keyword_mask[i, self.max_length - len(k) :] = True
+
+    def matches(self, input_ids: torch.LongTensor) -> torch.BoolTensor:
+        """Returns for every sequence of the batch whether it ends with one of the keywords."""
+        if self.max_length == 0:
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool)
+        if self.keyword_ids.device != input_ids.device:
+            self.keyword_ids = self.keyword_ids.to(input_ids.device)
+            self.keyword_mask = self.keyword_mask.to(input_ids.device)
+
+        last_tokens = input_ids[:, -self.max_length :]
+        # Sequences shorter than the longest keyword are padded with -1, which matches no token
+        if last_tokens.shape[1] < self.max_length:
+            last_tokens = torch.nn.functional.pad(
+                last_tokens, (self.max_length - last_tokens.shape[1], 0), value=-1
+            )
+        matches = (last_tokens[:, None, :] == self.keyword_ids[None, :, :]) | ~(
+            self.keyword_mask[None, :, :]
+        )
+        return matches.all(dim=2).any(dim=1).cpu()
+
     def __call__(
         self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
     ) -> bool:
-        for k in self.keywords:
-            if torch.equal(input_ids[0][-len(k) :], k):
-                return True
-        return False
+        return bool(self.matches(input_ids).all())
+
+
+class BatchKeywordsStoppingCriteria(KeywordsStoppingCriteria):
+    """
+    Keyword stopping criteria for a batch of sequences. Records the length at which every sequence hit a keyword and
+    only stops the generation once all sequences have finished. Sequences that finished early are cut at
+    finished_lengths afterwards.
+    """
+
+    def __init__(self, keywords: List[torch.Tensor], batch_size: int):
+        super().__init__(keywords)
+        self.finished = torch.zeros(batch_size, dtype=torch.bool)
+        self.finished_lengths = [None] * batch_size
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> bool:
+        newly_finished = self.matches(input_ids) & ~self.finished
+        for i in newly_finished.nonzero()[:, 0].tolist():
+            self.finished_lengths[i] = input_ids.shape[1]
+        self.finished |= newly_finished
+        return bool(self.finished.all())
+
+
+class PaddedRepetitionPenaltyLogitsProcessor(LogitsProcessor):
+    """
+    Repetition penalty as in transformers' RepetitionPenaltyLogitsProcessor that ignores the left padding of a batch.
+    Otherwise the padding token, which is often the eos token, would be penalized for padded sequences only.
+
+    Args:
+        penalty (float): Repetition penalty
+        pad_lengths (torch.Tensor): Number of padding tokens at the start of every sequence
+    """
+
+    def __init__(self, penalty: float, pad_lengths: torch.Tensor):
+        self.penalty = penalty
+        self.pad_lengths = pad_lengths
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        positions = torch.arange(input_ids.shape[1], device=input_ids.device)
+        is_padding = positions[None, :] < self.pad_lengths.to(input_ids.device)[:, None]
+        # Replace padding by the last token of the sequence, which is penalized anyway
+        input_ids = torch.where(is_padding, input_ids[:, -1:], input_ids)
+
+        score = torch.gather(scores, 1, input_ids)
+        score = torch.where(score < 0, score * self.penalty, score / self.penalty)
+        scores.scatter_(1, input_ids, score)
+        return scores
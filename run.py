@@ -3,6 +3,7 @@ from os.path import join
 import random
 from datetime import datetime
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -12,14 +13,16 @@ from omegaconf import DictConfig
 from loguru import logger
 import langchain
 
-from dataset.utils import load_hadm_from_file
-from utils.logging import append_to_pickle_file
+from dataset.patient_store import load_patients
+from utils.results_log import ResultsLog, RESULTS_LOG_SUFFIX
+from utils.nlp import static_prompt_prefix
 from evaluators.appendicitis_evaluator import AppendicitisEvaluator
 from evaluators.cholecystitis_evaluator import CholecystitisEvaluator
 from evaluators.diverticulitis_evaluator import DiverticulitisEvaluator
 from evaluators.pancreatitis_evaluator import PancreatitisEvaluator
 from models.models import CustomLLM
-from agents.agent import build_agent_executor_ZeroShot
+from models.response_cache import ResponseCache
+from agents.agent import AgentExecutorFactory
 
 
 def load_evaluator(pathology):
@@ -37,8 +40,7 @@ def load_evaluator(pathology):
     return evaluator
 
 
-@hydra.main(config_path="./configs", config_name="config", version_base=None)
-def run(args: DictConfig):
+def set_seeds(args):
     if not args.self_consistency:
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = True
@@ -46,12 +48,9 @@ def run(args: DictConfig):
         random.seed(args.seed)
         np.random.seed(args.seed)
 
-    # Load patient data
-    hadm_info_clean = load_hadm_from_file(
-        f"{args.pathology}_hadm_info_first_diag", base_mimic=args.base_mimic
-    )
 
-    tags = {
+def create_tags(args):
+    return {
         "system_tag_start": args.system_tag_start,
         "user_tag_start": args.user_tag_start,
         "ai_tag_start": args.ai_tag_start,
@@ -60,22 +59,39 @@ def run(args: DictConfig):
         "ai_tag_end": args.ai_tag_end,
     }
 
+
+def load_llm(args, tags):
     # Load desired model
     llm = CustomLLM(
         model_name=args.model_name,
         openai_api_key=args.openai_api_key,
+        openai_api_base=args.openai_api_base,
+        openai_max_concurrency=args.openai_max_concurrency,
+        openai_requests_per_minute=args.openai_requests_per_minute,
+        openai_tokens_per_minute=args.openai_tokens_per_minute,
         tags=tags,
         max_context_length=args.max_context_length,
         exllama=args.exllama,
         seed=args.seed,
         self_consistency=args.self_consistency,
+        # Summaries of observations are generated in batches of this size
+        batch_size=args.summary_batch_size,
+        greedy_sampling=args.greedy_sampling,
+        # The agent never saves the probabilities of its outputs
+        collect_probabilities=False,
     )
     llm.load_model(args.base_models)
+    # Greedy outputs of earlier runs are read from the cache instead of being generated again
+    if args.response_cache_path:
+        llm.response_cache = ResponseCache(args.response_cache_path)
+    return llm
+
 
+def create_run_name(args):
     date_time = datetime.fromtimestamp(time.time())
     str_date = date_time.strftime("%d-%m-%Y_%H:%M:%S")
-    args.model_name = args.model_name.replace("/", "_")
-    run_name = f"{args.pathology}_{args.agent}_{args.model_name}_{str_date}"
+    model_name = args.model_name.replace("/", "_")
+    run_name = f"{args.pathology}_{args.agent}_{model_name}_{str_date}"
     if args.fewshot:
         run_name += "_FEWSHOT"
     if args.include_ref_range:
@@ -94,12 +110,98 @@ def run(args: DictConfig):
         run_name += "_NOSUMMARY"
     if args.run_descr:
         run_name += str(args.run_descr)
+    return run_name
+
+
+def create_agent_executor_factory(args, llm, tags, log_path):
+    # Load the lab test mapping and build the prompt and output parser once for all patients
+    start = time.perf_counter()
+    agent_executor_factory = AgentExecutorFactory(
+        llm=llm,
+        lab_test_mapping_path=args.lab_test_mapping_path,
+        logfile=log_path,
+        max_context_length=args.max_context_length,
+        tags=tags,
+        include_ref_range=args.include_ref_range,
+        bin_lab_results=args.bin_lab_results,
+        include_tool_use_examples=args.include_tool_use_examples,
+        provide_diagnostic_criteria=args.provide_diagnostic_criteria,
+        summarize=args.summarize,
+        model_stop_words=args.stop_words,
+        summary_cache_path=args.summary_cache_path,
+    )
+    logger.info(f"Built agent executor factory in {time.perf_counter() - start:.3f}s")
+
+    # The system prompt and tool descriptions are the same for every patient, so their keys and values are computed once
+    if args.prefix_cache:
+        start = time.perf_counter()
+        num_tokens = llm.cache_prefix(
+            static_prompt_prefix(
+                agent_executor_factory.prompt, "input", agent_scratchpad=""
+            )
+        )
+        logger.info(
+            f"Cached {num_tokens} prefix tokens in {time.perf_counter() - start:.3f}s"
+        )
+    return agent_executor_factory
+
+
+def select_patient_ids(hadm_info_clean, args):
+    """Returns the ids of the patients to run in the order of the patient file, starting at args.first_patient."""
+    patient_ids = []
+    first_patient_seen = False
+    for _id in hadm_info_clean.keys():
+        if args.first_patient and not first_patient_seen:
+            if _id == args.first_patient:
+                first_patient_seen = True
+            else:
+                continue
+        patient_ids.append(_id)
+    return patient_ids
+
+
+def run_patients(
+    patient_ids, hadm_info_clean, agent_executor_factory, results_log, batch_size
+):
+    if batch_size > 1:
+        # Up to batch_size agents run at once. Their requests share the concurrency and rate limits of the OpenAI engine
+        with ThreadPoolExecutor(max_workers=batch_size) as executor:
+            for _ in executor.map(
+                lambda _id: run_patient(
+                    _id, hadm_info_clean, agent_executor_factory, results_log
+                ),
+                patient_ids,
+            ):
+                pass
+    else:
+        for _id in patient_ids:
+            run_patient(_id, hadm_info_clean, agent_executor_factory, results_log)
+
+
+@hydra.main(config_path="./configs", config_name="config", version_base=None)
+def run(args: DictConfig):
+    set_seeds(args)
+
+    if args.batch_size > 1 and not args.openai_api_key:
+        raise ValueError(
+            "Running multiple patients at once is only supported for OpenAI models."
+        )
+
+    # Load patient data. Patients are read lazily if the data was converted to a patient store
+    hadm_info_clean = load_patients(
+        f"{args.pathology}_hadm_info_first_diag", base_mimic=args.base_mimic
+    )
+
+    tags = create_tags(args)
+    llm = load_llm(args, tags)
+
+    run_name = create_run_name(args)
     run_dir = join(args.local_logging_dir, run_name)
 
     os.makedirs(run_dir, exist_ok=True)
 
     # Setup logfile and logpickle
-    results_log_path = join(run_dir, f"{run_name}_results.pkl")
+    results_log_path = join(run_dir, f"{run_name}{RESULTS_LOG_SUFFIX}")
     eval_log_path = join(run_dir, f"{run_name}_eval.pkl")
     log_path = join(run_dir, f"{run_name}.log")
     logger.add(log_path, enqueue=True, backtrace=True, diagnose=True)
@@ -108,38 +210,49 @@ def run(args: DictConfig):
     # Set langsmith project name
     # os.environ["LANGCHAIN_PROJECT"] = run_name
 
+    agent_executor_factory = create_agent_executor_factory(args, llm, tags, log_path)
+
     # Predict for all patients
-    first_patient_seen = False
-    for _id in hadm_info_clean.keys():
-        if args.first_patient and not first_patient_seen:
-            if _id == args.first_patient:
-                first_patient_seen = True
-            else:
-                continue
+    patient_ids = select_patient_ids(hadm_info_clean, args)
+    run_patients(
+        patient_ids,
+        hadm_info_clean,
+        agent_executor_factory,
+        ResultsLog(results_log_path),
+        args.batch_size,
+    )
 
-        logger.info(f"Processing patient: {_id}")
-
-        # Build
-        agent_executor = build_agent_executor_ZeroShot(
-            patient=hadm_info_clean[_id],
-            llm=llm,
-            lab_test_mapping_path=args.lab_test_mapping_path,
-            logfile=log_path,
-            max_context_length=args.max_context_length,
-            tags=tags,
-            include_ref_range=args.include_ref_range,
-            bin_lab_results=args.bin_lab_results,
-            include_tool_use_examples=args.include_tool_use_examples,
-            provide_diagnostic_criteria=args.provide_diagnostic_criteria,
-            summarize=args.summarize,
-            model_stop_words=args.stop_words,
-        )
+    if llm.response_cache is not None:
+        logger.info(f"Response cache: {llm.response_cache.stats()}")
 
-        # Run
-        result = agent_executor(
-            {"input": hadm_info_clean[_id]["Patient History"].strip()}
-        )
-        append_to_pickle_file(results_log_path, {_id: result})
+
+def run_patient(_id, hadm_info_clean, agent_executor_factory, results_log):
+    logger.info(f"Processing patient: {_id}")
+    patient = hadm_info_clean[_id]
+
+    # Build
+    start = time.perf_counter()
+    agent_executor = agent_executor_factory.build(patient)
+    build_seconds = time.perf_counter() - start
+    logger.info(f"Built agent executor for patient {_id} in {build_seconds:.3f}s")
+
+    # Run
+    start = time.perf_counter()
+    token_usage = agent_executor.agent.token_usage
+    result = agent_executor(
+        {"input": patient["Patient History"].strip()}, callbacks=[token_usage]
+    )
+    run_seconds = time.perf_counter() - start
+    tokenizer_stats = agent_executor.agent.token_counter.statistics()
+    logger.info(f"Token usage of patient {_id}: {token_usage.usage()}")
+    logger.info(f"Token counter statistics of patient {_id}: {tokenizer_stats}")
+    results_log.append(
+        _id,
+        result,
+        token_usage=token_usage.usage(),
+        tokenizer_stats=tokenizer_stats,
+        timings={"build": build_seconds, "run": run_seconds},
+    )
 
 
 if __name__ == "__main__":
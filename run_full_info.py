@@ -7,6 +7,7 @@ from datetime import datetime
 import time
 import pickle
 import fcntl
+import functools
 
 import numpy as np
 import hydra
@@ -17,14 +18,23 @@ from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
 from thefuzz import process
 
-from utils.nlp import calculate_num_tokens, truncate_text, create_lab_test_string
-from dataset.utils import load_hadm_from_file
+from utils.nlp import (
+    calculate_num_tokens,
+    truncate_text,
+    create_lab_test_string,
+    static_prompt_prefix,
+    TokenCounter,
+    prompt_segments,
+)
+from tools.utils import ItemidLookup
+from dataset.patient_store import load_patients
 from utils.logging import append_to_pickle_file
 from evaluators.appendicitis_evaluator import AppendicitisEvaluator
 from evaluators.cholecystitis_evaluator import CholecystitisEvaluator
 from evaluators.diverticulitis_evaluator import DiverticulitisEvaluator
 from evaluators.pancreatitis_evaluator import PancreatitisEvaluator
 from models.models import CustomLLM
+from models.response_cache import ResponseCache
 from agents.prompts import (
     FULL_INFO_TEMPLATE,
     FULL_INFO_TEMPLATE_SECTION,
@@ -107,13 +117,22 @@ def run(args: DictConfig):
     llm = CustomLLM(
         model_name=args.model_name,
         openai_api_key=args.openai_api_key,
+        openai_api_base=args.openai_api_base,
+        openai_max_concurrency=args.openai_max_concurrency,
+        openai_requests_per_minute=args.openai_requests_per_minute,
+        openai_tokens_per_minute=args.openai_tokens_per_minute,
         tags=tags,
         max_context_length=args.max_context_length,
         exllama=args.exllama,
         seed=args.seed,
         self_consistency=args.self_consistency,
+        batch_size=args.batch_size,
+        greedy_sampling=args.greedy_sampling,
     )
     llm.load_model(args.base_models)
+    # Greedy outputs of earlier runs are read from the cache instead of being generated again
+    if args.response_cache_path:
+        llm.response_cache = ResponseCache(args.response_cache_path)
 
     if args.confirm_diagnosis:
         diag_crit_writer = CustomLLM(
@@ -174,6 +193,17 @@ def run(args: DictConfig):
     else:
         raise NotImplementedError
 
+    if args.batch_size > 1 and (
+        args.prompt_template == "COT"
+        or args.confirm_diagnosis
+        or args.save_probabilities
+    ):
+        raise ValueError(
+            "Batched generation does not support COT prompts, diagnosis confirmation or saving probabilities."
+        )
+    # Probabilities are only copied from the generator if they are saved
+    llm.collect_probabilities = args.save_probabilities
+
     prompt = PromptTemplate(
         template=prompt_template,
         input_variables=["input", "fewshot_examples", "diagnostic_criteria"],
@@ -247,11 +277,26 @@ def run(args: DictConfig):
     # Load lab test mapping
     with open(args.lab_test_mapping_path, "rb") as f:
         lab_test_mapping_df = pickle.load(f)
+    itemid_lookup = ItemidLookup(lab_test_mapping_df)
+
+    # The system prompt and fewshot examples are the same for every patient, so their keys and values are computed once
+    if args.prefix_cache:
+        prefix = static_prompt_prefix(
+            prompt,
+            "input",
+            fewshot_examples=create_fewshot_examples(tags, args),
+            diagnostic_criteria="",
+        )
+        start = time.perf_counter()
+        num_tokens = llm.cache_prefix(prefix)
+        logger.info(
+            f"Cached {num_tokens} prefix tokens in {time.perf_counter() - start:.3f}s"
+        )
 
-    # Load patient data
+    # Load patient data. Patients are read lazily if the data was converted to a patient store
     # for patho in ["appendicitis", "cholecystitis", "diverticulitis", "pancreatitis"]:
     patho = args.pathology
-    hadm_info_clean = load_hadm_from_file(
+    hadm_info_clean = load_patients(
         f"{patho}_hadm_info_first_diag", base_mimic=args.base_mimic
     )
 
@@ -261,7 +306,11 @@ def run(args: DictConfig):
         with open(args.patient_list_path, "rb") as f:
             patient_list = pickle.load(f)
 
+    # Token counts of the prompt template and fewshot examples are shared by all patients
+    token_counter = TokenCounter(llm.tokenizer)
+
     first_patient_seen = False
+    batch = []
     for _id in patient_list:
         if args.first_patient and not first_patient_seen:
             if _id == args.first_patient:
@@ -271,109 +320,38 @@ def run(args: DictConfig):
         logger.info(f"Processing patient: {_id}")
         hadm = hadm_info_clean[_id]
 
-        # Fewshot
-        fewshot_examples = ""
-        if args.fewshot:
-            if args.include_ref_range:
-                fewshot_examples += FI_FEWSHOT_TEMPLATE_COPD_RR.format(
-                    user_tag_start=tags["user_tag_start"],
-                    user_tag_end=tags["user_tag_end"],
-                    ai_tag_start=tags["ai_tag_start"],
-                    ai_tag_end=tags["ai_tag_end"],
-                )
-                fewshot_examples += FI_FEWSHOT_TEMPLATE_PNEUMONIA_RR.format(
-                    user_tag_start=tags["user_tag_start"],
-                    user_tag_end=tags["user_tag_end"],
-                    ai_tag_start=tags["ai_tag_start"],
-                    ai_tag_end=tags["ai_tag_end"],
-                )
-            else:
-                fewshot_examples += FI_FEWSHOT_TEMPLATE_COPD.format(
-                    user_tag_start=tags["user_tag_start"],
-                    user_tag_end=tags["user_tag_end"],
-                    ai_tag_start=tags["ai_tag_start"],
-                    ai_tag_end=tags["ai_tag_end"],
-                )
-                fewshot_examples += FI_FEWSHOT_TEMPLATE_PNEUMONIA.format(
-                    user_tag_start=tags["user_tag_start"],
-                    user_tag_end=tags["user_tag_end"],
-                    ai_tag_start=tags["ai_tag_start"],
-                    ai_tag_end=tags["ai_tag_end"],
-                )
-
-        # Diagnostic Criteria
-        diagnostic_criteria = []
-        if args.diagnostic_criteria:
-            char_to_criteria = {
-                "a": DIAGNOSTIC_CRITERIA_APPENDICITIS,
-                "c": DIAGNOSTIC_CRITERIA_CHOLECYSTITIS,
-                "d": DIAGNOSTIC_CRITERIA_DIVERTICULITIS,
-                "p": DIAGNOSTIC_CRITERIA_PANCREATITIS,
-            }
-            for char in args.diagnostic_criteria:
-                diagnostic_criteria.append(char_to_criteria[char])
-        diagnostic_criteria = "\n".join(diagnostic_criteria)
-
-        # Eval
-        evaluator = load_evaluator(
-            args.pathology
-        )  # Reload every time to ensure no state is carried over
-
-        input = ""
-        rad_reports = ""
-
-        input = add_patient_history(input, hadm, args.abbreviated)
-
-        char_to_func = {
-            "p": "include_physical_examination",
-            "l": "include_laboratory_tests",
-            "i": "include_imaging",
-        }
-
-        # Read desired order from mapping and args.order and then execute and parse result
-        for char in args.order:
-            func = char_to_func[char]
-            # Must be within for loop to use updated input variable
-            mapping_functions = {
-                "include_imaging": (add_rad_reports, [input, hadm]),
-                "include_physical_examination": (
-                    add_physical_examination,
-                    [input, hadm, args.abbreviated],
-                ),
-                "include_laboratory_tests": (
-                    add_laboratory_tests,
-                    [input, hadm, evaluator, lab_test_mapping_df, args],
-                ),
-            }
-
-            function, input_params = mapping_functions[func]
-            result = function(*input_params)
-
-            if isinstance(result, tuple):
-                input, rad_reports = result
-            else:
-                input = result
-
-        # Escape previous curly brackets to avoid issues with format later
-        input = input.replace("{", "{{").replace("}", "}}")
-        # This we want to leave for future formatting
-        input = input.replace("{{rad_reports}}", "{rad_reports}")
-
-        input, fewshot_examples, rad_reports = control_context_length(
-            input,
+        input, fewshot_examples, diagnostic_criteria, rad_reports = create_input(
+            hadm,
+            _id,
+            hadm_info_clean,
+            itemid_lookup,
             prompt_template,
-            fewshot_examples,
-            args.include_ref_range,
-            rad_reports,
             llm,
-            args,
             tags,
-            _id,
-            hadm_info_clean,
-            diagnostic_criteria,
-            args.summarize,
+            args,
+            token_counter=token_counter,
+        )
+        logger.info(
+            f"Token counts of patient {_id}: {token_counter.reset_statistics()}"
         )
 
+        # Collect the prompts of a window of patients and generate them as one batch
+        if args.batch_size > 1:
+            batch.append(
+                (
+                    _id,
+                    prompt.format(
+                        input=input.format(rad_reports=rad_reports),
+                        fewshot_examples=fewshot_examples,
+                        diagnostic_criteria=diagnostic_criteria,
+                    ),
+                )
+            )
+            if len(batch) == args.batch_size:
+                predict_batch(batch, llm, results_log_path)
+                batch = []
+            continue
+
         result = chain.predict(
             input=input.format(rad_reports=rad_reports),
             fewshot_examples=fewshot_examples,
@@ -486,6 +464,142 @@ def run(args: DictConfig):
         else:
             append_to_pickle_file(results_log_path, {_id: result})
 
+    if batch:
+        predict_batch(batch, llm, results_log_path)
+
+    if llm.response_cache is not None:
+        logger.info(f"Response cache: {llm.response_cache.stats()}")
+
+
+def create_input(
+    hadm,
+    _id,
+    hadm_info_clean,
+    itemid_lookup,
+    prompt_template,
+    llm,
+    tags,
+    args,
+    token_counter=None,
+):
+    fewshot_examples = create_fewshot_examples(tags, args)
+
+    # Diagnostic Criteria
+    diagnostic_criteria = []
+    if args.diagnostic_criteria:
+        char_to_criteria = {
+            "a": DIAGNOSTIC_CRITERIA_APPENDICITIS,
+            "c": DIAGNOSTIC_CRITERIA_CHOLECYSTITIS,
+            "d": DIAGNOSTIC_CRITERIA_DIVERTICULITIS,
+            "p": DIAGNOSTIC_CRITERIA_PANCREATITIS,
+        }
+        for char in args.diagnostic_criteria:
+            diagnostic_criteria.append(char_to_criteria[char])
+    diagnostic_criteria = "\n".join(diagnostic_criteria)
+
+    # Eval
+    evaluator = load_evaluator(
+        args.pathology
+    )  # Reload every time to ensure no state is carried over
+
+    input = ""
+    rad_reports = ""
+
+    input = add_patient_history(input, hadm, args.abbreviated)
+
+    char_to_func = {
+        "p": "include_physical_examination",
+        "l": "include_laboratory_tests",
+        "i": "include_imaging",
+    }
+
+    # Read desired order from mapping and args.order and then execute and parse result
+    for char in args.order:
+        func = char_to_func[char]
+        # Must be within for loop to use updated input variable
+        mapping_functions = {
+            "include_imaging": (add_rad_reports, [input, hadm]),
+            "include_physical_examination": (
+                add_physical_examination,
+                [input, hadm, args.abbreviated],
+            ),
+            "include_laboratory_tests": (
+                add_laboratory_tests,
+                [input, hadm, evaluator, itemid_lookup, args],
+            ),
+        }
+
+        function, input_params = mapping_functions[func]
+        result = function(*input_params)
+
+        if isinstance(result, tuple):
+            input, rad_reports = result
+        else:
+            input = result
+
+    # Escape previous curly brackets to avoid issues with format later
+    input = input.replace("{", "{{").replace("}", "}}")
+    # This we want to leave for future formatting
+    input = input.replace("{{rad_reports}}", "{rad_reports}")
+
+    input, fewshot_examples, rad_reports = control_context_length(
+        input,
+        prompt_template,
+        fewshot_examples,
+        args.include_ref_range,
+        rad_reports,
+        llm,
+        args,
+        tags,
+        _id,
+        hadm_info_clean,
+        diagnostic_criteria,
+        args.summarize,
+        token_counter=token_counter,
+    )
+
+    return input, fewshot_examples, diagnostic_criteria, rad_reports
+
+
+def create_fewshot_examples(tags, args):
+    fewshot_examples = ""
+    if args.fewshot:
+        if args.include_ref_range:
+            fewshot_examples += FI_FEWSHOT_TEMPLATE_COPD_RR.format(
+                user_tag_start=tags["user_tag_start"],
+                user_tag_end=tags["user_tag_end"],
+                ai_tag_start=tags["ai_tag_start"],
+                ai_tag_end=tags["ai_tag_end"],
+            )
+            fewshot_examples += FI_FEWSHOT_TEMPLATE_PNEUMONIA_RR.format(
+                user_tag_start=tags["user_tag_start"],
+                user_tag_end=tags["user_tag_end"],
+                ai_tag_start=tags["ai_tag_start"],
+                ai_tag_end=tags["ai_tag_end"],
+            )
+        else:
+            fewshot_examples += FI_FEWSHOT_TEMPLATE_COPD.format(
+                user_tag_start=tags["user_tag_start"],
+                user_tag_end=tags["user_tag_end"],
+                ai_tag_start=tags["ai_tag_start"],
+                ai_tag_end=tags["ai_tag_end"],
+            )
+            fewshot_examples += FI_FEWSHOT_TEMPLATE_PNEUMONIA.format(
+                user_tag_start=tags["user_tag_start"],
+                user_tag_end=tags["user_tag_end"],
+                ai_tag_start=tags["ai_tag_start"],
+                ai_tag_end=tags["ai_tag_end"],
+            )
+    return fewshot_examples
+
+
+def predict_batch(batch, llm, results_log_path):
+    ids = [_id for _id, _ in batch]
+    logger.info(f"Generating batch of patients: {ids}")
+    results = llm.generate_batch([prompt for _, prompt in batch], stop=STOP_WORDS)
+    for _id, result in zip(ids, results):
+        append_to_pickle_file(results_log_path, {_id: result})
+
 
 def write_diagnostic_criteria(pathology, diag_crit_writer):
     global STOP_WORDS
@@ -545,7 +659,7 @@ def add_physical_examination(input, hadm, abbreviated=True):
     return input
 
 
-def add_laboratory_tests(input, hadm, evaluator, lab_test_mapping_df, args):
+def add_laboratory_tests(input, hadm, evaluator, itemid_lookup, args):
     input += "\n\n@@@ LABORATORY RESULTS @@@\n"
     # input += "\n\nLABORATORY RESULTS\n"
     if args.include_ref_range:
@@ -567,7 +681,7 @@ def add_laboratory_tests(input, hadm, evaluator, lab_test_mapping_df, args):
         if test in hadm["Laboratory Tests"].keys():
             input += create_lab_test_string(
                 test,
-                lab_test_mapping_df,
+                itemid_lookup,
                 hadm,
                 include_ref_range=args.include_ref_range,
                 bin_lab_results=args.bin_lab_results,
@@ -602,8 +716,11 @@ def control_context_length(
     hadm_info_clean,
     diagnostic_criteria,
     summarize,
+    token_counter=None,
 ):
     global STOP_WORDS
+    if token_counter is None:
+        token_counter = TokenCounter(llm.tokenizer)
     max_context_length = args.max_context_length
     final_diagnosis_tokens = 25
     summarize_prompt = PromptTemplate(
@@ -617,23 +734,29 @@ def control_context_length(
             "ai_tag_start": tags["ai_tag_start"],
         },
     )
-    prompt_tokens = calculate_num_tokens(
-        llm.tokenizer,
-        [
-            prompt_template.format(
-                input=input.format(rad_reports=rad_reports),
+
+    # The prompt is counted in segments, so the static template, the fewshot examples and the patient information are
+    # only tokenized once and trying the variants below only tokenizes the text that changed
+    def prompt_segments_for(fewshot_examples, rad_reports):
+        return prompt_segments(
+            functools.partial(
+                prompt_template.format,
                 system_tag_start=tags["system_tag_start"],
                 system_tag_end=tags["system_tag_end"],
                 user_tag_start=tags["user_tag_start"],
                 user_tag_end=tags["user_tag_end"],
                 ai_tag_start=tags["ai_tag_start"],
-                fewshot_examples=fewshot_examples,
-                diagnostic_criteria=diagnostic_criteria,
             ),
-        ],
-    )
+            input=prompt_segments(input.format, rad_reports=rad_reports),
+            fewshot_examples=fewshot_examples,
+            diagnostic_criteria=diagnostic_criteria,
+        )
+
     # Check if our prompt would exceed the max context length and lead to truncation
-    if prompt_tokens > max_context_length:
+    too_long = token_counter.exceeds(
+        prompt_segments_for(fewshot_examples, rad_reports), max_context_length
+    )
+    if too_long:
         # If fewshot can try taking some of the examples away
         if args.fewshot:
             # logger.warning(
@@ -654,59 +777,24 @@ def control_context_length(
                     ai_tag_start=tags["ai_tag_start"],
                     ai_tag_end=tags["ai_tag_end"],
                 )
-            prompt_tokens = calculate_num_tokens(
-                llm.tokenizer,
-                [
-                    prompt_template.format(
-                        input=input.format(rad_reports=rad_reports),
-                        system_tag_start=tags["system_tag_start"],
-                        system_tag_end=tags["system_tag_end"],
-                        user_tag_start=tags["user_tag_start"],
-                        user_tag_end=tags["user_tag_end"],
-                        ai_tag_start=tags["ai_tag_start"],
-                        fewshot_examples=fewshot_examples,
-                        diagnostic_criteria=diagnostic_criteria,
-                    ),
-                ],
+            too_long = token_counter.exceeds(
+                prompt_segments_for(fewshot_examples, rad_reports), max_context_length
             )
 
             # If we're still too long, completely remove examples
-            if prompt_tokens > max_context_length:
+            if too_long:
                 # logger.warning(
                 #    "Prompt is still too long. Removing all fewshot examples."
                 # )
                 fewshot_examples = ""
-                prompt_tokens = calculate_num_tokens(
-                    llm.tokenizer,
-                    [
-                        prompt_template.format(
-                            input=input.format(rad_reports=rad_reports),
-                            system_tag_start=tags["system_tag_start"],
-                            system_tag_end=tags["system_tag_end"],
-                            user_tag_start=tags["user_tag_start"],
-                            user_tag_end=tags["user_tag_end"],
-                            ai_tag_start=tags["ai_tag_start"],
-                            fewshot_examples=fewshot_examples,
-                            diagnostic_criteria=diagnostic_criteria,
-                        ),
-                    ],
+                too_long = token_counter.exceeds(
+                    prompt_segments_for(fewshot_examples, rad_reports),
+                    max_context_length,
                 )
 
         # Before we start summarizing rad we should take a look if we are already over the context length
-        prompt_tokens_no_rad = calculate_num_tokens(
-            llm.tokenizer,
-            [
-                prompt_template.format(
-                    input=input.format(rad_reports=""),
-                    system_tag_start=tags["system_tag_start"],
-                    system_tag_end=tags["system_tag_end"],
-                    user_tag_start=tags["user_tag_start"],
-                    user_tag_end=tags["user_tag_end"],
-                    ai_tag_start=tags["ai_tag_start"],
-                    fewshot_examples=fewshot_examples,
-                    diagnostic_criteria=diagnostic_criteria,
-                )
-            ],
+        prompt_tokens_no_rad = token_counter.count(
+            "".join(prompt_segments_for(fewshot_examples, ""))
         )
         max_new_tokens = max_context_length - prompt_tokens_no_rad
         if max_new_tokens < final_diagnosis_tokens:
@@ -728,7 +816,7 @@ def control_context_length(
             return input, fewshot_examples, rad_reports
 
         # If we're still too long, then case is just longer than max context length and we need to summarize imaging results
-        if prompt_tokens > max_context_length:
+        if too_long:
             if summarize:
                 seen_modalities = set()
                 rad_reports = ""
@@ -744,44 +832,27 @@ def control_context_length(
                         )
                         rad_reports += f"\n {summary}"
                         seen_modalities.add(rad["Modality"])
-                prompt_tokens = calculate_num_tokens(
-                    llm.tokenizer,
-                    [
-                        prompt_template.format(
-                            input=input.format(rad_reports=rad_reports),
-                            system_tag_start=tags["system_tag_start"],
-                            system_tag_end=tags["system_tag_end"],
-                            user_tag_start=tags["user_tag_start"],
-                            user_tag_end=tags["user_tag_end"],
-                            ai_tag_start=tags["ai_tag_start"],
-                            fewshot_examples=fewshot_examples,
-                            diagnostic_criteria=diagnostic_criteria,
-                        ),
-                    ],
+                too_long = token_counter.exceeds(
+                    prompt_segments_for(fewshot_examples, rad_reports),
+                    max_context_length,
                 )
 
             # If we are still too long, summarize the summary and enforce max characters
-            if prompt_tokens > max_context_length:
+            if too_long:
                 if summarize:
                     summarize_chain = LLMChain(llm=llm, prompt=summarize_prompt)
                     # Make sure that the length of rad_reports summary prompt is less than max_context_length
-                    prompt_tokens_summary = calculate_num_tokens(
-                        llm.tokenizer,
-                        [
-                            summarize_prompt.format(
-                                observation="",
-                                system_tag_start=tags["system_tag_start"],
-                                system_tag_end=tags["system_tag_end"],
-                                user_tag_start=tags["user_tag_start"],
-                                user_tag_end=tags["user_tag_end"],
-                                ai_tag_start=tags["ai_tag_start"],
-                            )
-                        ],
-                    )
-                    prompt_tokens_rad = calculate_num_tokens(
-                        llm.tokenizer,
-                        [rad_reports],
+                    prompt_tokens_summary = token_counter.count(
+                        summarize_prompt.format(
+                            observation="",
+                            system_tag_start=tags["system_tag_start"],
+                            system_tag_end=tags["system_tag_end"],
+                            user_tag_start=tags["user_tag_start"],
+                            user_tag_end=tags["user_tag_end"],
+                            ai_tag_start=tags["ai_tag_start"],
+                        )
                     )
+                    prompt_tokens_rad = token_counter.count(rad_reports)
                     if prompt_tokens_summary + prompt_tokens_rad > max_context_length:
                         rad_reports = truncate_text(
                             llm.tokenizer,
@@ -0,0 +1,183 @@
+import os
+from os.path import join
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import hydra
+from omegaconf import DictConfig
+from loguru import logger
+import langchain
+
+from dataset.patient_store import load_patients
+from utils.results_log import ResultsLog, RESULTS_LOG_SUFFIX
+from run import (
+    create_agent_executor_factory,
+    create_run_name,
+    create_tags,
+    load_llm,
+    run_patients,
+    select_patient_ids,
+    set_seeds,
+)
+
+
+def shard_patient_ids(patient_ids, num_shards):
+    """Splits patient_ids round robin into num_shards disjoint shards. The split only depends on the order of
+    patient_ids, so a restarted run assigns every patient to the same worker again."""
+    return [patient_ids[i::num_shards] for i in range(num_shards)]
+
+
+def shard_rate_limit(limit, num_shards):
+    """Share of a per minute limit of one worker. Never 0, which the rate limiter would treat as no limit at all, so
+    limits smaller than num_shards allow one request or token per minute to every worker.
+    """
+    if not limit:
+        return limit
+    return max(1, limit // num_shards)
+
+
+def shard_results_path(run_dir, run_name, shard_index, num_shards):
+    return join(
+        run_dir,
+        f"{run_name}_shard{shard_index}of{num_shards}{RESULTS_LOG_SUFFIX}",
+    )
+
+
+def run_shard(
+    args, run_dir, run_name, patient_ids, shard_index, num_shards, llm_factory
+):
+    """Runs the agent on the patients of one shard with its own model replica and writes their results to a separate
+    results log. Returns the number of patients and the seconds spent on them."""
+    # Must be set before the model is loaded, i.e. before CUDA is initialized in this process
+    if args.worker_devices:
+        devices = list(args.worker_devices)
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(devices[shard_index % len(devices)])
+    # All workers share the limits of one API key
+    if num_shards > 1:
+        args.openai_requests_per_minute = shard_rate_limit(
+            args.openai_requests_per_minute, num_shards
+        )
+        args.openai_tokens_per_minute = shard_rate_limit(
+            args.openai_tokens_per_minute, num_shards
+        )
+
+    set_seeds(args)
+    log_path = join(run_dir, f"{run_name}_shard{shard_index}of{num_shards}.log")
+    handler_id = logger.add(log_path, enqueue=True, backtrace=True, diagnose=True)
+    langchain.debug = True
+    try:
+        hadm_info_clean = load_patients(
+            f"{args.pathology}_hadm_info_first_diag", base_mimic=args.base_mimic
+        )
+        tags = create_tags(args)
+        llm = llm_factory(args, tags)
+        agent_executor_factory = create_agent_executor_factory(
+            args, llm, tags, log_path
+        )
+
+        start = time.perf_counter()
+        run_patients(
+            patient_ids,
+            hadm_info_clean,
+            agent_executor_factory,
+            ResultsLog(shard_results_path(run_dir, run_name, shard_index, num_shards)),
+            args.batch_size,
+        )
+        seconds = time.perf_counter() - start
+
+        if getattr(llm, "response_cache", None) is not None:
+            logger.info(f"Response cache: {llm.response_cache.stats()}")
+    finally:
+        logger.remove(handler_id)
+    return len(patient_ids), seconds
+
+
+def merge_shard_results(shard_paths, results_log_path, patient_ids):
+    """Writes the results of all shards to results_log_path in the order of patient_ids, so the merged file does not
+    depend on the number of workers. Returns the number of merged patients."""
+    shards = [ResultsLog(path) for path in shard_paths]
+    results = ResultsLog(results_log_path)
+
+    num_merged = 0
+    for _id in patient_ids:
+        for shard in shards:
+            if _id in shard:
+                # Records are copied as they are, including the token counts and timings of the worker
+                results.append_record(shard[_id])
+                num_merged += 1
+                break
+    return num_merged
+
+
+def run_sharded(args, llm_factory=load_llm):
+    """Sharded version of run that processes the patients in num_workers worker processes.
+
+    Every worker loads its own model replica, on the GPUs given for it in worker_devices, or uses the API of the
+    model. The patients are split into disjoint shards and each worker writes its results to its own results log.
+    Afterwards the shard results are merged into the results file of the run.
+
+    Args:
+        args: Config of run.py and additionally num_workers and worker_devices
+        llm_factory: Called with args and the role tags in every worker to load its model
+
+    Returns:
+        Path to the merged results file
+    """
+    if args.batch_size > 1 and not args.openai_api_key:
+        raise ValueError(
+            "Running multiple patients at once is only supported for OpenAI models."
+        )
+    num_workers = max(1, args.num_workers)
+
+    hadm_info_clean = load_patients(
+        f"{args.pathology}_hadm_info_first_diag", base_mimic=args.base_mimic
+    )
+    patient_ids = select_patient_ids(hadm_info_clean, args)
+    shards = shard_patient_ids(patient_ids, num_workers)
+
+    run_name = create_run_name(args)
+    run_dir = join(args.local_logging_dir, run_name)
+    os.makedirs(run_dir, exist_ok=True)
+    results_log_path = join(run_dir, f"{run_name}{RESULTS_LOG_SUFFIX}")
+    logger.info(f"Running {len(patient_ids)} patients with {num_workers} workers")
+
+    shard_args = [
+        (args, run_dir, run_name, shard, i, num_workers, llm_factory)
+        for i, shard in enumerate(shards)
+    ]
+    if num_workers == 1:
+        shard_stats = [run_shard(*shard_args[0])]
+    else:
+        # CUDA can not be used in forked processes
+        with ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [executor.submit(run_shard, *a) for a in shard_args]
+            shard_stats = [future.result() for future in futures]
+
+    for i, (num_patients, seconds) in enumerate(shard_stats):
+        logger.info(
+            f"Worker {i}: {num_patients} patients in {seconds:.1f}s, "
+            f"{num_patients * 3600 / seconds if seconds else 0.0:.1f} patients/hour"
+        )
+
+    num_merged = merge_shard_results(
+        [
+            shard_results_path(run_dir, run_name, i, num_workers)
+            for i in range(num_workers)
+        ],
+        results_log_path,
+        patient_ids,
+    )
+    logger.info(f"Merged the results of {num_merged} patients into {results_log_path}")
+    return results_log_path
+
+
+@hydra.main(config_path="./configs", config_name="config", version_base=None)
+def main(args: DictConfig):
+    run_sharded(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
+import os
 import unittest
 import pickle
+import tempfile
 from unittest.mock import patch
 from typing import Any
 
-from agents.agent import TextSummaryCache, CustomZeroShotAgent
+from agents.agent import TextSummaryCache, CustomZeroShotAgent, AgentExecutorFactory
 from langchain.schema import AgentAction
 from langchain.chains import LLMChain
 from langchain.llms.fake import FakeListLLM
@@ -14,6 +16,8 @@ from transformers import LlamaTokenizer
 from tools.utils import action_input_pretty_printer
 from agents.DiagnosisWorkflowParser import DiagnosisWorkflowParser
 from utils.nlp import truncate_text
+from tests.DummyData import patient_x, lab_test_mapping_x
+from tests.DummyLLM import tiny_llama_tokenizer
 
 
 class FakeLLM(LLM):
@@ -846,5 +850,297 @@ Thought:"""
         self.assertEqual(summary, expected_output)
 
 
+class TestTextSummaryCache(unittest.TestCase):
+    def test_text_summary_cache_on_disk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "summaries.db")
+            TextSummaryCache(path, namespace="model").add_summary("text", "summary")
+
+            self.assertEqual(
+                TextSummaryCache(path, namespace="model").get_summary("text"),
+                "summary",
+            )
+            # Summaries of other models are not shared
+            self.assertIsNone(
+                TextSummaryCache(path, namespace="other").get_summary("text")
+            )
+
+
+class WhitespaceTokenizer:
+    def encode(self, text):
+        return text.split()
+
+
+class TestAgentExecutorFactory(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        lab_test_mapping_path = os.path.join(self.tmp.name, "lab_test_mapping.pkl")
+        with open(lab_test_mapping_path, "wb") as f:
+            pickle.dump(lab_test_mapping_x, f)
+        llm = FakeLLM()
+        llm.load_model(
+            responses=["Final Diagnosis: Appendicitis"],
+            tokenizer=WhitespaceTokenizer(),
+        )
+        self.factory = AgentExecutorFactory(
+            llm=llm,
+            lab_test_mapping_path=lab_test_mapping_path,
+            logfile=None,
+            max_context_length=4096,
+            tags={
+                "user_tag_start": " USER: ",
+                "ai_tag_start": " ASSISTANT: ",
+                "user_tag_end": "</s>",
+                "ai_tag_end": "</s>",
+                "system_tag_start": "",
+                "system_tag_end": "",
+            },
+            include_ref_range=False,
+            bin_lab_results=False,
+            include_tool_use_examples=True,
+            provide_diagnostic_criteria=True,
+            summarize=True,
+            model_stop_words=["</s>"],
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_build_binds_patient(self):
+        other_patient = dict(patient_x, **{"Physical Examination": "Other patient"})
+        executor = self.factory.build(patient_x)
+        other_executor = self.factory.build(other_patient)
+
+        self.assertEqual(
+            [tool.name for tool in executor.tools],
+            [
+                "Physical Examination",
+                "Laboratory Tests",
+                "Imaging",
+                "Diagnostic Criteria",
+            ],
+        )
+        self.assertEqual(
+            executor.tools[0].run({"action_input": None}),
+            f"Physical Examination:\n{patient_x['Physical Examination']}\n",
+        )
+        self.assertEqual(
+            other_executor.tools[0].run({"action_input": None}),
+            "Physical Examination:\nOther patient\n",
+        )
+        self.assertEqual(executor.agent.allowed_tools, self.factory.tool_names)
+        self.assertEqual(
+            executor.agent.llm_chain.prompt.partial_variables["ai_tag_start"],
+            " ASSISTANT: ",
+        )
+
+    def test_no_state_shared_between_patients(self):
+        executor = self.factory.build(patient_x)
+        executor.tools[2].already_requested_scans["Abdomen CT"] = 1
+        executor.agent.observation_summary_cache.add_summary("text", "summary")
+
+        other_executor = self.factory.build(patient_x)
+        self.assertEqual(other_executor.tools[2].already_requested_scans, {})
+        self.assertIsNone(
+            other_executor.agent.observation_summary_cache.get_summary("text")
+        )
+
+    def test_scratchpad_token_counting(self):
+        agent = self.factory.build(patient_x).agent
+        self.assertIsNot(
+            agent.token_counter, self.factory.build(patient_x).agent.token_counter
+        )
+
+        intermediate_steps = []
+        for i in range(4):
+            intermediate_steps.append(
+                (
+                    AgentAction(
+                        tool="Physical Examination",
+                        tool_input={"action_input": None},
+                        log=f"Thought {i}\nAction: Physical Examination",
+                    ),
+                    f"Observation {i}",
+                )
+            )
+            agent.token_counter.reset_statistics()
+            thoughts, _ = agent._construct_scratchpad(
+                intermediate_steps, input="Patient history"
+            )
+            # After the first turn only the action and observation of the newest step are tokenized
+            if i:
+                self.assertEqual(agent.token_counter.tokenizer_calls, 2)
+        self.assertTrue(thoughts.startswith(" Thought 0\nAction: Physical Examination"))
+
+    def test_summaries_generated_at_once(self):
+        agent = self.factory.build(patient_x).agent
+        agent.observation_summary_cache.add_summary("Cached", "Cached summary")
+        intermediate_steps = [
+            (
+                AgentAction(
+                    tool="Physical Examination",
+                    tool_input={"action_input": None},
+                    log="",
+                ),
+                observation,
+            )
+            for observation in ["First", "Cached", "Second", "First"]
+        ]
+        llm = agent.llm_chain.llm
+        llm.model = FakeListLLM(responses=["First summary", "Second summary"])
+        # Observations are truncated with the tokenizer before they are summarized
+        llm.tokenizer = tiny_llama_tokenizer()
+        with patch.object(FakeLLM, "_generate", wraps=llm._generate) as _generate:
+            summary = agent._summarize_steps(intermediate_steps)
+
+        # The uncached observations are summarized once each in a single call
+        _generate.assert_called_once()
+        self.assertEqual(len(_generate.call_args.args[0]), 2)
+        self.assertEqual(
+            summary,
+            "\n".join(
+                [
+                    "A summary of information I know thus far:",
+                    "Action: Physical Examination",
+                    "Observation: First summary",
+                    "Action: Physical Examination",
+                    "Observation: Cached summary",
+                    "Action: Physical Examination",
+                    "Observation: Second summary",
+                    "Action: Physical Examination",
+                    "Observation: First summary",
+                    "Thought:",
+                ]
+            ),
+        )
+
+    def test_empty_summary_cached(self):
+        agent = self.factory.build(patient_x).agent
+        agent.observation_summary_cache.add_summary("Empty", "")
+        intermediate_steps = [
+            (
+                AgentAction(
+                    tool="Physical Examination",
+                    tool_input={"action_input": None},
+                    log="",
+                ),
+                "Empty",
+            )
+        ]
+        llm = agent.llm_chain.llm
+        with patch.object(FakeLLM, "_generate", wraps=llm._generate) as _generate:
+            summary = agent._summarize_steps(intermediate_steps)
+
+        # An empty summary is a cached summary and is not generated again
+        _generate.assert_not_called()
+        self.assertIn("Observation: \n", summary)
+
+    def summary_cache_factory(self, llm=None, tags=None, max_context_length=4096):
+        return AgentExecutorFactory(
+            llm=llm or self.factory.llm_chain.llm,
+            lab_test_mapping_path=os.path.join(self.tmp.name, "lab_test_mapping.pkl"),
+            logfile=None,
+            max_context_length=max_context_length,
+            tags=tags or self.factory.tags,
+            include_ref_range=False,
+            bin_lab_results=False,
+            include_tool_use_examples=False,
+            provide_diagnostic_criteria=False,
+            summarize=True,
+            model_stop_words=[],
+            summary_cache_path=os.path.join(self.tmp.name, "summaries.db"),
+        )
+
+    def test_summary_cache_shared_between_patients(self):
+        factory = self.summary_cache_factory()
+        factory.build(patient_x).agent.observation_summary_cache.add_summary(
+            "text", "summary"
+        )
+        self.assertEqual(
+            factory.build(patient_x).agent.observation_summary_cache.get_summary(
+                "text"
+            ),
+            "summary",
+        )
+
+    def test_summary_cache_namespace(self):
+        self.summary_cache_factory().summary_cache.add_summary("text", "summary")
+        self.assertEqual(
+            self.summary_cache_factory().summary_cache.get_summary("text"), "summary"
+        )
+
+        # Summaries made with other tags or truncated to another length are not shared
+        tags = {**self.factory.tags, "user_tag_start": " USER:: "}
+        self.assertIsNone(
+            self.summary_cache_factory(tags=tags).summary_cache.get_summary("text")
+        )
+        self.assertIsNone(
+            self.summary_cache_factory(
+                max_context_length=2048
+            ).summary_cache.get_summary("text")
+        )
+
+    def test_sampled_summaries_not_persisted(self):
+        class SamplingLLM(FakeLLM):
+            self_consistency: bool = True
+
+        llm = SamplingLLM()
+        llm.load_model(responses=["summary"], tokenizer=WhitespaceTokenizer())
+        factory = self.summary_cache_factory(llm=llm)
+        self.assertIsNone(factory.summary_cache)
+        # Every agent keeps its summaries in memory only
+        agent = factory.build(patient_x).agent
+        agent.observation_summary_cache.add_summary("text", "summary")
+        self.assertIsNone(
+            factory.build(patient_x).agent.observation_summary_cache.get_summary("text")
+        )
+
+    def test_run(self):
+        result = self.factory.build(patient_x)(
+            {"input": patient_x["Patient History"].strip()}
+        )
+        self.assertEqual(result["output"], "Final Diagnosis: Appendicitis")
+
+    def test_token_usage(self):
+        agent_executor = self.factory.build(patient_x)
+        token_usage = agent_executor.agent.token_usage
+        agent_executor(
+            {"input": patient_x["Patient History"].strip()}, callbacks=[token_usage]
+        )
+        prompt = self.factory.prompt.format(
+            input=patient_x["Patient History"].strip(), agent_scratchpad=""
+        )
+        self.assertEqual(
+            token_usage.usage(),
+            {
+                "llm_calls": 1,
+                "prompt_tokens": len(prompt.split()),
+                "completion_tokens": 3,
+            },
+        )
+        # Every patient has its own counts
+        self.assertEqual(self.factory.build(patient_x).agent.token_usage.llm_calls, 0)
+
+    def test_token_usage_of_summaries(self):
+        agent = self.factory.build(patient_x).agent
+        llm = agent.llm_chain.llm
+        llm.model = FakeListLLM(responses=["Short summary"])
+        # Observations are truncated with the tokenizer before they are summarized
+        llm.tokenizer = tiny_llama_tokenizer()
+        intermediate_steps = [
+            (
+                AgentAction(
+                    tool="Physical Examination",
+                    tool_input={"action_input": None},
+                    log="",
+                ),
+                "Long observation",
+            )
+        ]
+        agent._summarize_steps(intermediate_steps)
+        self.assertEqual(agent.token_usage.llm_calls, 1)
+        self.assertEqual(agent.token_usage.completion_tokens, 2)
+
+
 if __name__ == "__main__":
     unittest.main()
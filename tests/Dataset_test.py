@@ -1,5 +1,49 @@
+import tempfile
 import unittest
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
 from dataset.discharge import extract_diagnosis_from_discharge
+from dataset.dataset import (
+    create_valuestr_lab,
+    create_valuestr_microbio,
+    create_valuestr_lab_vectorized,
+    create_valuestr_microbio_vectorized,
+    fill_nan_hadm,
+    load_data,
+)
+from dataset.utils import HadmIndex, select_hadm
+from tests.DummyMimic import write_dummy_mimic
+
+
+def fill_nan_hadm_loop(
+    lab_events_df,
+    radiology_reports_df,
+    microbiology_df,
+    disease_ids,
+    transfers_df,
+    hadm_to_subject_id,
+):
+    # Reference implementation masking the full tables once per admission
+    for _id in disease_ids:
+        s_id = hadm_to_subject_id[_id]
+
+        time_data = transfers_df[transfers_df["hadm_id"] == _id].sort_values("intime")
+        start_time = pd.Timestamp(time_data["intime"].values[0])
+        end_time = pd.Timestamp(time_data["intime"].values[-1])
+
+        for df in [lab_events_df, radiology_reports_df, microbiology_df]:
+            mask = (
+                (df["subject_id"] == s_id)
+                & (df["charttime"] >= (start_time - timedelta(days=1)))
+                & (df["charttime"] <= end_time)
+                & (df["hadm_id"].isna())
+            )
+            df.loc[mask, "hadm_id"] = _id
+
+    return lab_events_df, radiology_reports_df, microbiology_df
 
 
 class TestDataset(unittest.TestCase):
@@ -144,6 +188,116 @@ Acute Pancreatitis
 Gastroesophageal Reflux Disease"""
         self.assertEqual(output, expected)
 
+    def test_create_valuestr_lab_vectorized(self):
+        rng = np.random.default_rng(0)
+        n = 2000
+        valuenum = rng.choice([1e-05, 5.0, 0.1, 1 / 3, 123456.789, 1e16, -2.5], size=n)
+        valuenum[rng.random(n) < 0.4] = np.nan
+        lab_events_df = pd.DataFrame(
+            {
+                "valuenum": valuenum,
+                "value": rng.choice(
+                    np.array(["POS", "___", "<0.1", "7", np.nan], dtype=object), size=n
+                ),
+                "valueuom": rng.choice(
+                    np.array(["mg/dL", "K/uL", np.nan], dtype=object), size=n
+                ),
+                "flag": rng.choice(
+                    np.array(["abnormal", np.nan], dtype=object), size=n
+                ),
+                "comments": rng.choice(
+                    np.array(["___", "HEMOLYZED", np.nan], dtype=object), size=n
+                ),
+            }
+        )
+        # Sample a slice with a non-default index as done when filtering the full table
+        lab_events_df = lab_events_df.sample(500, random_state=0)
+
+        expected = lab_events_df.apply(lambda row: create_valuestr_lab(row), axis=1)
+        output = create_valuestr_lab_vectorized(lab_events_df)
+        pd.testing.assert_series_equal(output, expected, check_dtype=False)
+
+    def test_create_valuestr_microbio_vectorized(self):
+        rng = np.random.default_rng(0)
+        n = 500
+        microbiology_df = pd.DataFrame(
+            {
+                "org_name": rng.choice(
+                    np.array(["ESCHERICHIA COLI", np.nan], dtype=object), size=n
+                ),
+                "comments": rng.choice(
+                    np.array(["No growth.", "___", np.nan], dtype=object), size=n
+                ),
+            }
+        )
+
+        expected = microbiology_df.apply(
+            lambda row: create_valuestr_microbio(row), axis=1
+        )
+        output = create_valuestr_microbio_vectorized(microbiology_df)
+        pd.testing.assert_series_equal(output, expected, check_dtype=False)
+
+    def test_fill_nan_hadm(self):
+        with tempfile.TemporaryDirectory() as base_mimic:
+            write_dummy_mimic(base_mimic, num_subjects=40)
+            (
+                admissions_df,
+                transfers_df,
+                _,
+                _,
+                _,
+                radiology_report_df,
+                _,
+                lab_events_df,
+                microbiology_df,
+            ) = load_data(base_mimic)
+        radiology_report_df["charttime"] = pd.to_datetime(
+            radiology_report_df["charttime"]
+        )
+        hadm_to_subject_id = (
+            admissions_df[["hadm_id", "subject_id"]]
+            .set_index("hadm_id")
+            .to_dict()["subject_id"]
+        )
+        # Shuffled order, since earlier admissions take precedence for overlapping windows
+        disease_ids = list(admissions_df["hadm_id"].sample(frac=0.8, random_state=0))
+        events = [lab_events_df, radiology_report_df, microbiology_df]
+        self.assertTrue(all(df["hadm_id"].isna().any() for df in events))
+
+        expected = fill_nan_hadm_loop(
+            *[df.copy() for df in events],
+            disease_ids,
+            transfers_df,
+            hadm_to_subject_id,
+        )
+        output = fill_nan_hadm(
+            *[df.copy() for df in events],
+            disease_ids,
+            transfers_df,
+            hadm_to_subject_id,
+        )
+        for output_df, expected_df, df in zip(output, expected, events):
+            self.assertGreater(
+                expected_df["hadm_id"].notna().sum(), df["hadm_id"].notna().sum()
+            )
+            pd.testing.assert_frame_equal(output_df, expected_df)
+
+    def test_hadm_index(self):
+        rng = np.random.default_rng(0)
+        hadm_ids = rng.choice([20000001.0, 20000002.0, 20000003.0, np.nan], size=200)
+        df = pd.DataFrame(
+            {"hadm_id": hadm_ids, "value": np.arange(200)},
+            index=rng.permutation(200) + 1000,
+        )
+        index = HadmIndex(df)
+        for _id in [20000001, 20000002, 20000003, 20000004]:
+            pd.testing.assert_frame_equal(
+                select_hadm(index, _id), df[df["hadm_id"] == _id]
+            )
+            pd.testing.assert_frame_equal(
+                select_hadm(df, _id), df[df["hadm_id"] == _id]
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -4,10 +4,14 @@ import pickle
 from langchain.schema import AgentFinish
 
 from agents.DiagnosisWorkflowParser import InvalidActionError
-from agents.DiagnosisWorkflowParser import DiagnosisWorkflowParser
+from agents.DiagnosisWorkflowParser import (
+    DiagnosisWorkflowParser,
+    lab_test_name_matcher,
+)
 from agents.AgentAction import AgentAction
-from utils.nlp import extract_keywords_nltk
+from utils.nlp import extract_keywords_nltk, stop_word_sets
 from tools.utils import ADDITIONAL_LAB_TEST_MAPPING
+from tests.DummyData import lab_test_mapping_x
 
 import logging
 
@@ -752,5 +756,39 @@ class TestDiagnosisWorkflowParser(unittest.TestCase):
         self.assertEqual(self.parser.action_input, expected_output)
 
 
+class TestDiagnosisWorkflowParserState(unittest.TestCase):
+    def test_lookups_built_at_construction(self):
+        parser = DiagnosisWorkflowParser(lab_test_mapping_df=lab_test_mapping_x)
+        self.assertIsNotNone(parser.lab_test_matcher)
+        self.assertEqual(
+            parser.lab_test_name_matcher.count("White Blood Cells and Lipase"),
+            {"names": 2},
+        )
+
+        # Matchers built by the agent executor factory are shared
+        name_matcher = lab_test_name_matcher(lab_test_mapping_x)
+        parser = DiagnosisWorkflowParser(
+            lab_test_mapping_df=lab_test_mapping_x,
+            lab_test_matcher=parser.lab_test_matcher,
+            lab_test_name_matcher=name_matcher,
+        )
+        self.assertIs(parser.lab_test_name_matcher, name_matcher)
+
+    def test_parse_lab_tests_reuses_stop_words(self):
+        parser = DiagnosisWorkflowParser(lab_test_mapping_df=lab_test_mapping_x)
+        stop_word_sets()
+        misses = stop_word_sets.cache_info().misses
+        for _ in range(2):
+            output = parser.parse(
+                "Action: Laboratory Tests\nAction Input: Order the White Blood Cells and a Creatinine level"
+            )
+            # Creatinine is expanded to the blood and urine tests
+            self.assertEqual(
+                output[0].tool_input["action_input"], [51301, 50912, 51082]
+            )
+            self.assertEqual(output[0].custom_parsings, 2)
+        self.assertEqual(stop_word_sets.cache_info().misses, misses)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,3 +1,6 @@
+import numpy as np
+import pandas as pd
+
 patient_x = {
     "Patient History": " ___ presents with 4 days of RLQ pain. Says symptoms started after heavy dinner. Reports decreased appetite and chills.  Past Medical History: PMH: none  PSH: none  ___: none    Social History: ___ Family History: Fam Hx: no history of Crohn's or UC. Grandfather with ___ types of cancers otherwise no hx of malignancy    ",
     "Physical Examination": " Temp: 97.8 HR: 44 BP: 104/69 RR: 17 100% Ra Gen: NAD HEENT: non icteric, atraumatic CV: RRR no m,r,g RESP: CTABL Abd: soft, non tender, non distended, incisions c/d/i Ext: wwpx4, palpable distal pulses",
@@ -27,3 +30,72 @@ patient_x = {
     "Procedures ICD10": [],
     "Procedures ICD10 Title": [],
 }
+
+
+def _lab_test(label, itemid, fluid, corresponding_ids=None):
+    return {
+        "label": label,
+        "itemid": itemid,
+        "fluid": fluid,
+        "corresponding_ids": corresponding_ids or [itemid],
+    }
+
+
+# Small lab test mapping with the structure of lab_test_mapping.pkl
+lab_test_mapping_x = pd.DataFrame(
+    [
+        _lab_test("Alanine Aminotransferase (ALT)", 50861, "Blood"),
+        _lab_test("Asparate Aminotransferase (AST)", 50878, "Blood"),
+        _lab_test("Alkaline Phosphatase", 50863, "Blood"),
+        _lab_test("Bilirubin, Total", 50885, "Blood"),
+        _lab_test("Albumin", 50862, "Blood"),
+        _lab_test("Creatinine", 50912, "Blood", [50912, 51082]),
+        _lab_test("Creatinine", 51082, "Urine", [50912, 51082]),
+        _lab_test("Urea Nitrogen", 51006, "Blood"),
+        _lab_test("Sodium", 50983, "Blood", [50983, 51100]),
+        _lab_test("Sodium", 51100, "Urine", [50983, 51100]),
+        _lab_test("Potassium", 50971, "Blood"),
+        _lab_test("Chloride", 50902, "Blood"),
+        _lab_test("Bicarbonate", 50882, "Blood"),
+        _lab_test("Glucose", 50931, "Blood", [50931, 51084]),
+        _lab_test("Glucose", 51084, "Urine", [50931, 51084]),
+        _lab_test("Lipase", 50956, "Blood"),
+        _lab_test("Amylase", 50867, "Blood"),
+        _lab_test("C-Reactive Protein", 50889, "Blood"),
+        _lab_test("Lactate", 50813, "Blood"),
+        _lab_test("White Blood Cells", 51301, "Blood"),
+        _lab_test("Red Blood Cells", 51279, "Blood"),
+        _lab_test("Hemoglobin", 51222, "Blood"),
+        _lab_test("Hematocrit", 51221, "Blood"),
+        _lab_test("Platelet Count", 51265, "Blood"),
+        _lab_test("pH", 50820, "Blood", [50820, 51491]),
+        _lab_test("pH", 51491, "Urine", [50820, 51491]),
+        _lab_test("Ketone", 51484, "Urine"),
+        _lab_test("Leukocytes", 51486, "Urine"),
+        _lab_test("Blood Culture, Routine", 90201, np.nan),
+        _lab_test("URINE CULTURE", 90039, np.nan),
+        _lab_test(
+            "Complete Blood Count (CBC)",
+            np.nan,
+            np.nan,
+            [51301, 51279, 51222, 51221, 51265],
+        ),
+        _lab_test(
+            "Liver Function Panel (LFP)",
+            np.nan,
+            np.nan,
+            [50861, 50878, 50863, 50885, 50862],
+        ),
+        _lab_test(
+            "Renal Function Panel (RFP)",
+            np.nan,
+            np.nan,
+            [50912, 51082, 51006, 50983, 51100, 50971, 50902, 50882],
+        ),
+        _lab_test("ALT", 50861, "Blood"),
+        _lab_test("Alanine Aminotransferase", 50861, "Blood"),
+        _lab_test("AST", 50878, "Blood"),
+        _lab_test("WBC", 51301, "Blood"),
+        _lab_test("CBC", np.nan, np.nan, [51301, 51279, 51222, 51221, 51265]),
+    ]
+)
@@ -0,0 +1,54 @@
+import string
+
+import torch
+from tokenizers import Tokenizer, models, decoders, processors
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from models.models import CustomLLM
+
+
+def tiny_llama_tokenizer():
+    """Character level tokenizer with the special tokens of Llama."""
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for char in string.printable:
+        vocab.setdefault(char, len(vocab))
+    tokenizer = Tokenizer(models.BPE(vocab, [], unk_token="<unk>"))
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", 1)]
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        pad_token="<unk>",
+    )
+
+
+def tiny_llama(seed=0):
+    """Randomly initialized Llama model that is small enough for the tests to run on the CPU."""
+    tokenizer = tiny_llama_tokenizer()
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=512,
+    )
+    model = LlamaForCausalLM(config).eval()
+    return model, tokenizer
+
+
+def tiny_custom_llm(max_context_length=96, batch_size=1, seed=0):
+    model, tokenizer = tiny_llama(seed)
+    return CustomLLM(
+        model_name="tiny-llama",
+        max_context_length=max_context_length,
+        batch_size=batch_size,
+        seed=seed,
+        model=model,
+        tokenizer=tokenizer,
+    )
@@ -0,0 +1,214 @@
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+
+def write_dummy_mimic(base_mimic, num_subjects=20, seed=0):
+    """Writes a small, randomly generated MIMIC-IV folder with all csv files used by load_data."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(join(base_mimic, "hosp"), exist_ok=True)
+    os.makedirs(join(base_mimic, "note"), exist_ok=True)
+
+    def write(df, folder, name):
+        df.to_csv(join(base_mimic, folder, name), index=False)
+
+    subject_ids = 10000000 + np.arange(num_subjects) * 7
+    admissions = []
+    transfers = []
+    for s_id in subject_ids:
+        start = pd.Timestamp("2150-01-01") + pd.Timedelta(
+            days=int(rng.integers(0, 300))
+        )
+        for _ in range(int(rng.integers(1, 4))):
+            hadm_id = 20000000 + len(admissions)
+            end = start + pd.Timedelta(days=int(rng.integers(1, 6)))
+            admissions.append(
+                {
+                    "subject_id": s_id,
+                    "hadm_id": hadm_id,
+                    "admittime": start,
+                    "dischtime": end,
+                }
+            )
+            for t in range(int(rng.integers(1, 4))):
+                transfers.append(
+                    {
+                        "subject_id": s_id,
+                        "hadm_id": hadm_id,
+                        "transfer_id": 30000000 + len(transfers),
+                        "eventtype": "admit" if t == 0 else "transfer",
+                        "careunit": "Emergency Department",
+                        "intime": start + pd.Timedelta(hours=12 * t),
+                        "outtime": start + pd.Timedelta(hours=12 * t + 6),
+                    }
+                )
+            start = end + pd.Timedelta(days=int(rng.integers(1, 30)))
+    admissions = pd.DataFrame(admissions)
+    write(admissions, "hosp", "admissions.csv")
+    write(pd.DataFrame(transfers), "hosp", "transfers.csv")
+
+    d_icd = pd.DataFrame(
+        {
+            "icd_code": ["5409", "K3580", "5770", "K8590"],
+            "icd_version": [9, 10, 9, 10],
+            "long_title": [
+                "Acute appendicitis without mention of peritonitis",
+                "Other and unspecified acute appendicitis",
+                "Acute pancreatitis",
+                "Acute pancreatitis without necrosis or infection, unspecified",
+            ],
+        }
+    )
+    write(d_icd, "hosp", "d_icd_diagnoses.csv")
+    diag_rows = d_icd.sample(len(admissions), replace=True, random_state=seed)
+    diagnoses = pd.DataFrame(
+        {
+            "subject_id": admissions["subject_id"].values,
+            "hadm_id": admissions["hadm_id"].values,
+            "seq_num": 1,
+            "icd_code": diag_rows["icd_code"].values,
+            "icd_version": diag_rows["icd_version"].values,
+        }
+    )
+    write(diagnoses, "hosp", "diagnoses_icd.csv")
+
+    d_icd_procedures = pd.DataFrame(
+        {
+            "icd_code": ["4701", "0DTJ4ZZ"],
+            "icd_version": [9, 10],
+            "long_title": [
+                "Laparoscopic appendectomy",
+                "Resection of Appendix, Percutaneous Endoscopic Approach",
+            ],
+        }
+    )
+    write(d_icd_procedures, "hosp", "d_icd_procedures.csv")
+    proc_rows = d_icd_procedures.sample(
+        len(admissions), replace=True, random_state=seed
+    )
+    procedures = pd.DataFrame(
+        {
+            "subject_id": admissions["subject_id"].values,
+            "hadm_id": admissions["hadm_id"].values,
+            "seq_num": 1,
+            "chartdate": admissions["admittime"].dt.date.values,
+            "icd_code": proc_rows["icd_code"].values,
+            "icd_version": proc_rows["icd_version"].values,
+        }
+    )
+    write(procedures, "hosp", "procedures_icd.csv")
+
+    discharge = pd.DataFrame(
+        {
+            "note_id": [f"{s}-DS-{i}" for i, s in enumerate(admissions["subject_id"])],
+            "subject_id": admissions["subject_id"].values,
+            "hadm_id": admissions["hadm_id"].values,
+            "note_type": "DS",
+            "note_seq": 1,
+            "charttime": admissions["dischtime"].values,
+            "text": [
+                "Chief Complaint:\nabdominal pain\n \nHistory of Present Illness:\nPain for {} days.\n".format(
+                    i
+                )
+                for i in range(len(admissions))
+            ],
+        }
+    )
+    write(discharge, "note", "discharge.csv")
+
+    # Events are drawn around admissions and a third of them have no hadm_id
+    def event_times_and_ids(n):
+        rows = admissions.sample(n, replace=True, random_state=int(rng.integers(1e6)))
+        times = rows["admittime"] + pd.to_timedelta(
+            rng.integers(-36, 72, size=n), unit="h"
+        )
+        hadm_ids = rows["hadm_id"].astype(float).values
+        hadm_ids[rng.random(n) < 0.33] = np.nan
+        return rows["subject_id"].values, hadm_ids, times.values
+
+    n_rad = 40
+    subjects, hadm_ids, times = event_times_and_ids(n_rad)
+    radiology = pd.DataFrame(
+        {
+            "note_id": [f"{s}-RR-{i}" for i, s in enumerate(subjects)],
+            "subject_id": subjects,
+            "hadm_id": hadm_ids,
+            "note_type": "RR",
+            "note_seq": np.arange(n_rad),
+            "charttime": times,
+            "text": ["CT ABDOMEN: Inflamed appendix." for _ in range(n_rad)],
+        }
+    )
+    write(radiology, "note", "radiology.csv")
+    radiology_detail = pd.DataFrame(
+        {
+            "note_id": radiology["note_id"].values,
+            "subject_id": subjects,
+            "field_name": "exam_name",
+            "field_value": "CT ABD & PELVIS WITH CONTRAST",
+            "field_ordinal": 1,
+        }
+    )
+    write(radiology_detail, "note", "radiology_detail.csv")
+
+    d_labitems = pd.DataFrame(
+        {
+            "itemid": [50861, 50862, 51301, 50912],
+            "label": [
+                "Alanine Aminotransferase (ALT)",
+                "Albumin",
+                "White Blood Cells",
+                "Creatinine",
+            ],
+            "fluid": ["Blood", "Blood", "Blood", "Blood"],
+            "category": "Chemistry",
+        }
+    )
+    write(d_labitems, "hosp", "d_labitems.csv")
+    n_lab = 400
+    subjects, hadm_ids, times = event_times_and_ids(n_lab)
+    valuenum = np.round(rng.normal(10, 3, size=n_lab), 1)
+    valuenum[rng.random(n_lab) < 0.2] = np.nan
+    value = np.where(np.isnan(valuenum), "___", valuenum.astype(str)).astype(object)
+    value[rng.random(n_lab) < 0.1] = None
+    labevents = pd.DataFrame(
+        {
+            "labevent_id": np.arange(n_lab),
+            "subject_id": subjects,
+            "hadm_id": hadm_ids,
+            "specimen_id": rng.integers(1, 1000, size=n_lab),
+            "itemid": rng.choice(d_labitems["itemid"].values, size=n_lab),
+            "charttime": times,
+            "value": value,
+            "valuenum": valuenum,
+            "valueuom": rng.choice(["K/uL", "mg/dL", None], size=n_lab),
+            "ref_range_lower": 4.0,
+            "ref_range_upper": 11.0,
+            "flag": rng.choice(["abnormal", None], size=n_lab),
+            "priority": "STAT",
+            "comments": rng.choice(["___", "HEMOLYZED", None], size=n_lab),
+        }
+    )
+    write(labevents, "hosp", "labevents.csv")
+
+    n_micro = 60
+    subjects, hadm_ids, times = event_times_and_ids(n_micro)
+    microbiologyevents = pd.DataFrame(
+        {
+            "microevent_id": np.arange(n_micro),
+            "subject_id": subjects,
+            "hadm_id": hadm_ids,
+            "micro_specimen_id": rng.integers(1, 1000, size=n_micro),
+            "charttime": times,
+            "spec_itemid": 70012,
+            "spec_type_desc": "BLOOD CULTURE",
+            "test_itemid": 90201,
+            "test_name": "Blood Culture, Routine",
+            "org_itemid": rng.choice([80002.0, 90760.0, np.nan], size=n_micro),
+            "org_name": rng.choice(["ESCHERICHIA COLI", None], size=n_micro),
+            "comments": rng.choice(["No growth.", "___", None], size=n_micro),
+        }
+    )
+    write(microbiologyevents, "hosp", "microbiologyevents.csv")
@@ -0,0 +1,176 @@
+import os
+import pickle
+import tempfile
+import unittest
+from concurrent.futures import Future
+from copy import deepcopy
+from unittest.mock import patch
+
+import pandas as pd
+
+from evaluate import evaluate_patient, evaluate_runs, patient_reference
+from agents.AgentAction import AgentAction
+from agents.DiagnosisWorkflowParser import InvalidActionError
+from utils.logging import append_to_pickle_file
+from utils.results_log import convert_results_pickle
+from tests.DummyData import patient_x
+
+
+def agent_result(output, tools):
+    steps = [
+        (AgentAction(tool=tool, tool_input="", log="", custom_parsings=0), "")
+        for tool in tools
+    ]
+    return {"input": "", "output": output, "intermediate_steps": steps}
+
+
+class CountingFuture(Future):
+    def __init__(self, executor, result):
+        super().__init__()
+        self.executor = executor
+        self.set_result(result)
+
+    def result(self, timeout=None):
+        self.executor.in_flight -= 1
+        return super().result(timeout)
+
+
+class CountingExecutor:
+    """Evaluates submitted chunks in the current process and records the most chunks that were not yet collected."""
+
+    def __init__(self, max_workers):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.num_submitted = 0
+
+    def submit(self, function, *args):
+        self.in_flight += 1
+        self.num_submitted += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return CountingFuture(self, function(*args))
+
+    def shutdown(self):
+        pass
+
+
+class TestEvaluate(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        patient = deepcopy(patient_x)
+        patient["Procedures Discharge"] = []
+        self.patients = {_id: patient for _id in range(1, 8)}
+        with open(
+            os.path.join(self.tmp.name, "appendicitis_hadm_info_first_diag.pkl"), "wb"
+        ) as f:
+            pickle.dump(self.patients, f)
+
+        self.results = {
+            1: agent_result(
+                "Final Diagnosis: Acute appendicitis\nTreatment: Appendectomy",
+                ["Physical Examination"],
+            ),
+            2: agent_result(
+                "Final Diagnosis: Cholecystitis",
+                [InvalidActionError.invalid_tool_str, "Physical Examination"],
+            ),
+            # Result of run_full_info.py
+            3: "Final Diagnosis: Appendicitis",
+        }
+        for _id in range(4, 8):
+            self.results[_id] = self.results[1 + _id % 3]
+        self.results_path = os.path.join(
+            self.tmp.name, "appendicitis_ZeroShot_model_results.pkl"
+        )
+        for _id, result in self.results.items():
+            append_to_pickle_file(self.results_path, {_id: result})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_evaluate_patient(self):
+        reference = patient_reference(self.patients[1])
+        evaluation = evaluate_patient("appendicitis", self.results[2], reference)
+        self.assertEqual(evaluation["scores"]["Diagnosis"], 0)
+        self.assertEqual(evaluation["scores"]["Invalid Tools"], 1)
+        # A new evaluator for every patient, so the scores do not add up
+        evaluation = evaluate_patient("appendicitis", self.results[2], reference)
+        self.assertEqual(evaluation["scores"]["Invalid Tools"], 1)
+
+        evaluation = evaluate_patient("appendicitis", self.results[1], reference)
+        self.assertEqual(evaluation["scores"]["Diagnosis"], 1)
+        self.assertEqual(evaluation["scores"]["Physical Examination"], 1)
+        self.assertEqual(evaluation["answers"]["Treatment"], "Appendectomy")
+
+        evaluation = evaluate_patient("appendicitis", self.results[3], reference)
+        self.assertEqual(evaluation["scores"]["Diagnosis"], 1)
+        self.assertEqual(evaluation["scores"]["Rounds"], 0)
+
+    def test_evaluate_runs(self):
+        (output_path,) = evaluate_runs(
+            [self.results_path], base_mimic=self.tmp.name, num_workers=1, chunk_size=3
+        )
+        self.assertEqual(
+            output_path,
+            os.path.join(self.tmp.name, "appendicitis_ZeroShot_model_eval.parquet"),
+        )
+        table = pd.read_parquet(output_path)
+        self.assertEqual(table["hadm_id"].tolist(), list(self.results.keys()))
+        self.assertEqual(table["scores.Diagnosis"].tolist(), [1, 0, 1, 0, 1, 1, 0])
+        self.assertEqual(table["answers.Diagnosis"][1], "Cholecystitis")
+        self.assertEqual(
+            table["answers.Correct Laboratory Tests"][0], '{"Inflammation": []}'
+        )
+
+        # The table does not depend on the number of workers
+        os.remove(output_path)
+        evaluate_runs(
+            [self.results_path], base_mimic=self.tmp.name, num_workers=2, chunk_size=2
+        )
+        pd.testing.assert_frame_equal(pd.read_parquet(output_path), table)
+
+    def test_evaluate_runs_bounded(self):
+        other_results_path = os.path.join(
+            self.tmp.name, "appendicitis_ZeroShot_other_results.pkl"
+        )
+        for _id in reversed(self.results):
+            append_to_pickle_file(other_results_path, {_id: self.results[_id]})
+        results_paths = [self.results_path, other_results_path]
+        expected_paths = evaluate_runs(
+            results_paths, base_mimic=self.tmp.name, num_workers=1
+        )
+        expected = [pd.read_parquet(path) for path in expected_paths]
+
+        executor = CountingExecutor(max_workers=2)
+        with patch("evaluate.ProcessPoolExecutor", return_value=executor):
+            output_paths = evaluate_runs(
+                results_paths,
+                base_mimic=self.tmp.name,
+                num_workers=2,
+                chunk_size=1,
+                max_in_flight=3,
+            )
+        # The chunks of both files are evaluated, but never more than 3 at once are held
+        self.assertEqual(executor.num_submitted, 14)
+        self.assertEqual(executor.in_flight, 0)
+        self.assertLessEqual(executor.max_in_flight, 3)
+        self.assertEqual(output_paths, expected_paths)
+        for path, table in zip(output_paths, expected):
+            pd.testing.assert_frame_equal(pd.read_parquet(path), table)
+
+    def test_evaluate_results_log(self):
+        (pickle_output_path,) = evaluate_runs(
+            [self.results_path], base_mimic=self.tmp.name, num_workers=1
+        )
+        table = pd.read_parquet(pickle_output_path)
+        os.remove(pickle_output_path)
+
+        results_log_path = convert_results_pickle(self.results_path)
+        (output_path,) = evaluate_runs(
+            [results_log_path], base_mimic=self.tmp.name, num_workers=1
+        )
+        self.assertEqual(output_path, pickle_output_path)
+        pd.testing.assert_frame_equal(pd.read_parquet(output_path), table)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,258 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+
+from models.exllamav2_generator_base_custom import (
+    ExLlamaV2BaseGenerator,
+    GreedySampler,
+)
+
+try:
+    from exllamav2.generator import ExLlamaV2Sampler
+except ImportError:
+    ExLlamaV2Sampler = None
+
+
+class FakeCache:
+    def __init__(self, max_seq_len=256):
+        self.current_seq_len = 0
+        # Token processed at every position, standing in for the keys and values
+        self.tokens = torch.full((1, max_seq_len), -1)
+
+
+class FakeModel:
+    def __init__(self, vocab_size=32, seed=0):
+        self.processed = []
+        self.config = SimpleNamespace(max_seq_len=256)
+        # Logits of the next token only depend on the last token
+        self.logits = torch.randn(
+            (vocab_size, vocab_size), generator=torch.Generator().manual_seed(seed)
+        )
+
+    def forward(
+        self, input_ids, cache, input_mask=None, preprocess_only=False, loras=None
+    ):
+        q_len = input_ids.shape[-1]
+        cache.tokens[
+            :, cache.current_seq_len : cache.current_seq_len + q_len
+        ] = input_ids
+        cache.current_seq_len += q_len
+        self.processed.append(q_len)
+        if not preprocess_only:
+            return self.logits[input_ids[:, -1:] % len(self.logits)].half()
+
+
+class TestPrefixCacheReuse(unittest.TestCase):
+    def setUp(self):
+        self.model = FakeModel()
+        self.cache = FakeCache()
+        self.generator = ExLlamaV2BaseGenerator(self.model, self.cache, None)
+
+    def generate(self, input_ids, num_tokens):
+        # Mimics generate_simple: every sampled token is appended and only the previous token is forwarded
+        self.generator._gen_begin_base(input_ids)
+        for token in range(100, 100 + num_tokens):
+            self.model.forward(self.generator.sequence_ids[:, -1:], self.cache)
+            self.generator.sequence_ids = torch.cat(
+                [self.generator.sequence_ids, torch.tensor([[token]])], dim=1
+            )
+
+    def assert_cache_holds(self, input_ids):
+        # The cache must hold exactly the prompt without its last token, as after a full prefill
+        self.assertEqual(self.cache.current_seq_len, input_ids.shape[-1] - 1)
+        self.assertTrue(
+            torch.equal(
+                self.cache.tokens[:, : self.cache.current_seq_len], input_ids[:, :-1]
+            )
+        )
+
+    def test_reuse_previous_turn(self):
+        prompt = torch.arange(1, 11)[None]
+        self.generate(prompt, 5)
+        self.assertEqual(self.generator.last_prefill, (0, 9))
+
+        # Next turn continues the previous prompt and output with a new observation
+        next_prompt = torch.cat(
+            [self.generator.sequence_ids, torch.tensor([[7, 8, 9]])], dim=1
+        )
+        self.generator._gen_begin_base(next_prompt)
+        self.assertEqual(self.generator.last_prefill, (14, 3))
+        self.assertEqual(self.model.processed[-1], 3)
+        self.assert_cache_holds(next_prompt)
+
+    def test_partial_prefix(self):
+        prompt = torch.arange(1, 11)[None]
+        self.generate(prompt, 5)
+        # Scratchpad was rewritten after the 6th token, e.g. by summarizing
+        next_prompt = torch.cat([prompt[:, :6], torch.tensor([[50, 51, 52]])], dim=1)
+        self.generator._gen_begin_base(next_prompt)
+        self.assertEqual(self.generator.last_prefill, (6, 2))
+        self.assert_cache_holds(next_prompt)
+
+    def test_shorter_prompt(self):
+        prompt = torch.arange(1, 11)[None]
+        self.generate(prompt, 5)
+        next_prompt = prompt[:, :4]
+        self.generator._gen_begin_base(next_prompt)
+        self.assertEqual(self.generator.last_prefill, (3, 0))
+        self.assert_cache_holds(next_prompt)
+
+    def test_no_reuse(self):
+        prompt = torch.arange(1, 11)[None]
+        self.generate(prompt, 5)
+
+        # Batches with a padding mask are always processed from the start
+        self.generator._gen_begin_base(prompt, mask=torch.zeros((1, 10)))
+        self.assertEqual(self.generator.last_prefill, (0, 9))
+
+        self.generator.reuse_cache = False
+        self.generator._gen_begin_base(prompt)
+        self.assertEqual(self.generator.last_prefill, (0, 9))
+        self.assert_cache_holds(prompt)
+
+
+class FakeTokenizer:
+    def encode(self, prompt, encode_special_tokens=True):
+        return torch.tensor([[3 + ord(char) % 29 for char in prompt]])
+
+
+class StopAfter:
+    def __init__(self, length):
+        self.length = length
+
+    def __call__(self, input_ids, scores):
+        return input_ids.shape[-1] >= self.length
+
+
+def greedy_settings(token_repetition_penalty=1.15):
+    return SimpleNamespace(
+        top_k=1,
+        temperature=0.9,
+        token_repetition_penalty=token_repetition_penalty,
+        token_repetition_range=-1,
+        token_repetition_decay=0,
+        token_bias=None,
+        mirostat=False,
+        filters=[],
+        begin_filters=lambda prefix: None,
+        feed_filters=lambda token: None,
+    )
+
+
+def reference_generate(model, prompt_ids, settings, num_tokens, stop_criteria):
+    # Greedy sampling as ExLlamaV2Sampler does it on the CPU, growing the sequence with torch.cat
+    sequence_ids = prompt_ids
+    probabilities_sequence = torch.empty((1, 0))
+    for _ in range(num_tokens):
+        logits = model.logits[sequence_ids[:, -1]].half().float()
+        for token in set(sequence_ids[0].tolist()):
+            if logits[0, token] > 0:
+                logits[0, token] /= settings.token_repetition_penalty
+            else:
+                logits[0, token] *= settings.token_repetition_penalty
+        token = logits[:, 1:].argmax(dim=-1, keepdim=True) + 1
+        probabilities = torch.softmax(logits / settings.temperature, dim=-1)
+        sequence_ids = torch.cat([sequence_ids, token], dim=1)
+        probabilities_sequence = torch.cat(
+            [probabilities_sequence, probabilities.gather(1, token)], dim=1
+        )
+        if stop_criteria(sequence_ids, None):
+            break
+    return sequence_ids, probabilities_sequence
+
+
+class TestGenerateSimple(unittest.TestCase):
+    def setUp(self):
+        self.model = FakeModel()
+        self.generator = ExLlamaV2BaseGenerator(
+            self.model, FakeCache(), FakeTokenizer()
+        )
+        self.generator.greedy_sampling = True
+        self.prompt = "Patient with abdominal pain"
+        self.prompt_ids = FakeTokenizer().encode(self.prompt)
+
+    def generate(self, settings, num_tokens, stop_length, **kwargs):
+        return self.generator.generate_simple(
+            self.prompt,
+            gen_settings=settings,
+            num_tokens=num_tokens,
+            stop_criteria=StopAfter(stop_length),
+            **kwargs,
+        )
+
+    def test_greedy_same_as_sampler(self):
+        for penalty in [1.0, 1.15]:
+            settings = greedy_settings(penalty)
+            self.assertTrue(GreedySampler.supports(settings))
+            for stop_length in [len(self.prompt_ids[0]) + 20, 1000]:
+                sequence_ids, probabilities = self.generate(settings, 40, stop_length)
+                expected_ids, expected_probabilities = reference_generate(
+                    self.model, self.prompt_ids, settings, 40, StopAfter(stop_length)
+                )
+                self.assertTrue(torch.equal(sequence_ids, expected_ids))
+                self.assertTrue(torch.allclose(probabilities, expected_probabilities))
+                self.assertTrue(torch.equal(self.generator.sequence_ids, expected_ids))
+
+    def test_without_probabilities(self):
+        settings = greedy_settings()
+        expected_ids, _ = self.generate(settings, 30, 1000)
+        sequence_ids, probabilities = self.generate(
+            settings, 30, 1000, collect_probabilities=False
+        )
+        self.assertIsNone(probabilities)
+        self.assertTrue(torch.equal(sequence_ids, expected_ids))
+
+    def test_greedy_sampler_batch(self):
+        settings = greedy_settings()
+        sequence_ids = torch.randint(
+            32, (3, 10), generator=torch.Generator().manual_seed(1)
+        )
+        greedy_sampler = GreedySampler(settings, 30)
+        for _ in range(20):
+            logits = self.model.logits[sequence_ids[:, -1:]].half()
+            token, _ = greedy_sampler.sample(logits, sequence_ids)
+            for row in range(3):
+                expected_ids, _ = reference_generate(
+                    self.model, sequence_ids[row : row + 1], settings, 1, StopAfter(0)
+                )
+                self.assertEqual(token[row, 0], expected_ids[0, -1])
+            sequence_ids = torch.cat([sequence_ids, token], dim=1)
+
+    def test_sampler_settings(self):
+        settings = greedy_settings()
+        settings.top_k = 40
+        self.assertFalse(GreedySampler.supports(settings))
+        settings = greedy_settings()
+        settings.token_repetition_range = 64
+        self.assertFalse(GreedySampler.supports(settings))
+
+
+@unittest.skipIf(ExLlamaV2Sampler is None, "exllamav2 is not installed")
+class TestGreedySamplerMatchesExLlamaV2Sampler(unittest.TestCase):
+    def test_same_tokens_and_probabilities(self):
+        rng = torch.Generator().manual_seed(2)
+        for penalty in [1.0, 1.15]:
+            for batch_size in [1, 3]:
+                settings = ExLlamaV2Sampler.Settings().greedy_clone()
+                settings.token_repetition_penalty = penalty
+                self.assertTrue(GreedySampler.supports(settings))
+
+                sequence_ids = torch.randint(1000, (batch_size, 10), generator=rng)
+                greedy_sampler = GreedySampler(settings, 40)
+                for _ in range(30):
+                    logits = torch.randn((batch_size, 1, 1000), generator=rng) * 5
+                    # ExLlamaV2Sampler.sample applies the repetition penalty to the logits in place
+                    expected, expected_probabilities, _ = ExLlamaV2Sampler.sample(
+                        logits.clone(), settings, sequence_ids, 0.5, None
+                    )
+                    token, probabilities = greedy_sampler.sample(logits, sequence_ids)
+                    self.assertTrue(torch.equal(token, expected))
+                    self.assertTrue(
+                        torch.allclose(probabilities, expected_probabilities)
+                    )
+                    sequence_ids = torch.cat([sequence_ids, token], dim=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
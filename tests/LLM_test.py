@@ -1,9 +1,23 @@
+import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
+import torch
 from transformers import LlamaTokenizer
-
-from models.utils import create_stop_criteria
+from langchain.prompts import PromptTemplate
+
+from models.models import CustomLLM
+from models.response_cache import ResponseCache
+from models.utils import (
+    create_stop_criteria,
+    KeywordsStoppingCriteria,
+    BatchKeywordsStoppingCriteria,
+)
 from agents.agent import STOP_WORDS
+from agents.prompts import FULL_INFO_TEMPLATE
+from utils.nlp import static_prompt_prefix
+from tests.DummyLLM import tiny_custom_llm, tiny_llama_tokenizer
 
 
 class TestLLM(unittest.TestCase):
@@ -140,5 +154,286 @@ class TestLLM(unittest.TestCase):
         self.assertTrue(self.stop_criteria(generated_ids, None))
 
 
+def ends_with_keyword(sequence, keywords):
+    # Reference implementation comparing every keyword on its own
+    return any(len(k) > 0 and torch.equal(sequence[-len(k) :], k) for k in keywords)
+
+
+class TestKeywordsStoppingCriteria(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = tiny_llama_tokenizer()
+        # Batches are left padded as in generate_batch
+        self.tokenizer.padding_side = "left"
+        self.stop_criteria = create_stop_criteria(STOP_WORDS, self.tokenizer, "cpu")
+        self.keywords = self.stop_criteria.keywords
+
+    def encode(self, texts):
+        return self.tokenizer(
+            texts, add_special_tokens=False, padding=True, return_tensors="pt"
+        )["input_ids"]
+
+    def test_stop_words(self):
+        for text in [
+            "Thought: I need labs.\nObservation:",
+            "Action: Imaging\nObservations:",
+            "Thought: Observation",
+            "Observation: ",
+        ]:
+            self.assertEqual(
+                self.stop_criteria(self.encode([text]), None),
+                ends_with_keyword(self.encode([text])[0], self.keywords),
+            )
+        self.assertTrue(self.stop_criteria(self.encode(["Labs.Observation:"]), None))
+        self.assertFalse(self.stop_criteria(self.encode(["Observation: labs"]), None))
+
+    def test_same_as_reference(self):
+        torch.manual_seed(0)
+        vocab = sorted({token for k in self.keywords for token in k.tolist()})
+        for length in [1, 2, 5, 20]:
+            input_ids = torch.tensor(vocab)[torch.randint(len(vocab), (200, length))]
+            expected = [ends_with_keyword(row, self.keywords) for row in input_ids]
+            self.assertEqual(self.stop_criteria.matches(input_ids).tolist(), expected)
+
+    def test_per_row_completion(self):
+        stop_criteria = BatchKeywordsStoppingCriteria(self.keywords, 3)
+        texts = ["Thought: a", "Thought: bc", "Thought: def"]
+        self.assertFalse(stop_criteria(self.encode(texts), None))
+        texts = [text + "\nObservation:" for text in texts]
+        texts[2] = texts[2][:-4]
+        self.assertFalse(stop_criteria(self.encode(texts), None))
+        self.assertEqual(stop_criteria.finished_lengths[2], None)
+        finished_length = stop_criteria.finished_lengths[0]
+        self.assertEqual(stop_criteria.finished_lengths[1], finished_length)
+
+        # Rows stay finished when they continue after the keyword
+        texts = [text + "ion:" for text in texts]
+        self.assertTrue(stop_criteria(self.encode(texts), None))
+        self.assertEqual(stop_criteria.finished_lengths[0], finished_length)
+        self.assertEqual(stop_criteria.finished_lengths[2], self.encode(texts).shape[1])
+
+    def test_no_keywords(self):
+        stop_criteria = KeywordsStoppingCriteria([torch.tensor([], dtype=torch.long)])
+        self.assertFalse(stop_criteria(self.encode(["Observation:"]), None))
+
+
+class TestGenerateBatch(unittest.TestCase):
+    def setUp(self):
+        self.llm = tiny_custom_llm(max_context_length=96, batch_size=4)
+        self.prompts = [
+            "Patient presents with abdominal pain.",
+            "Short",
+            "A much longer prompt about right lower quadrant pain and fever",
+            "Another: ",
+            "Fifth prompt",
+        ]
+
+    def test_same_as_sequential(self):
+        for stop in [["z"], ["Dz"], ["m", "J"]]:
+            expected = [self.llm._call(prompt, stop) for prompt in self.prompts]
+            with patch.object(
+                CustomLLM, "_generate_uncached", wraps=self.llm._generate_uncached
+            ) as _generate_uncached:
+                outputs = self.llm.generate_batch(self.prompts, stop)
+            self.assertEqual(outputs, expected)
+            # Only the last batch with a single prompt is generated on its own
+            self.assertEqual(_generate_uncached.call_count, 1)
+
+    def test_fallback_for_unfinished_prompts(self):
+        # Without stop words the shorter prompts run out of the budget of the longest prompt
+        expected = [self.llm._call(prompt, []) for prompt in self.prompts]
+        self.assertEqual(self.llm.generate_batch(self.prompts, []), expected)
+
+    def test_langchain_generate(self):
+        # LLMChain.apply passes all prompts to LLM.generate at once
+        expected = [self.llm._call(prompt, ["z"]) for prompt in self.prompts]
+        with patch.object(
+            CustomLLM, "generate_batch", wraps=self.llm.generate_batch
+        ) as generate_batch:
+            result = self.llm.generate(self.prompts, stop=["z"])
+        generate_batch.assert_called_once_with(self.prompts, ["z"])
+        self.assertEqual(
+            [generations[0].text for generations in result.generations], expected
+        )
+
+    def test_batch_size_one(self):
+        llm = tiny_custom_llm(max_context_length=96, batch_size=1)
+        self.assertEqual(
+            llm.generate_batch(self.prompts[:2], ["z"]),
+            [llm._call(prompt, ["z"]) for prompt in self.prompts[:2]],
+        )
+
+
+class TestPrefixCache(unittest.TestCase):
+    def setUp(self):
+        self.llm = tiny_custom_llm(max_context_length=128)
+        self.prefix = (
+            "You are a medical assistant. Diagnose the patient.\nPatient History: "
+        )
+        self.prompts = [
+            self.prefix + "Pain in the right lower quadrant.\nFinal Diagnosis:",
+            self.prefix + "Fever\nFinal Diagnosis:",
+            "Unrelated prompt",
+        ]
+
+    def prefix_length(self, prompt):
+        input_ids = self.llm.tokenizer(prompt, return_tensors="pt")["input_ids"]
+        past_key_values = self.llm.prefix_cache_for(input_ids)
+        if past_key_values is None:
+            return 0
+        return past_key_values[0][0].shape[2]
+
+    def test_same_as_without_cache(self):
+        expected = [self.llm._call(prompt, ["z"]) for prompt in self.prompts]
+        num_tokens = self.llm.cache_prefix(self.prefix)
+        self.assertEqual(num_tokens, len(self.llm.tokenizer(self.prefix)["input_ids"]))
+        self.assertEqual(
+            [self.llm._call(prompt, ["z"]) for prompt in self.prompts], expected
+        )
+        # Generating must not modify the cached prefix
+        self.assertEqual(
+            [self.llm._call(prompt, ["z"]) for prompt in self.prompts], expected
+        )
+
+    def test_common_prefix_length(self):
+        self.llm.cache_prefix(self.prefix)
+        num_tokens = self.llm.prefix_ids.shape[1]
+        self.assertEqual(self.prefix_length(self.prompts[0]), num_tokens)
+        # Only the beginning of sentence token is shared
+        self.assertEqual(self.prefix_length(self.prompts[2]), 1)
+        # At least one token is left to be processed
+        self.assertEqual(self.prefix_length(self.prefix), num_tokens - 1)
+        self.assertEqual(self.prefix_length(self.prefix[:10]), 10)
+
+    def test_prefix_with_padding_token(self):
+        # generate masks padding tokens, so they can not be part of the cached prefix
+        prefix = "System<unk>Prompt"
+        prompt = prefix + " Patient"
+        expected = self.llm._call(prompt, ["z"])
+        self.assertEqual(self.llm.cache_prefix(prefix), len("System") + 1)
+        self.assertEqual(self.llm._call(prompt, ["z"]), expected)
+
+    def test_static_prompt_prefix(self):
+        prompt = PromptTemplate(
+            template=FULL_INFO_TEMPLATE,
+            input_variables=["input", "fewshot_examples", "diagnostic_criteria"],
+            partial_variables={
+                "system_tag_start": "<s>[INST] <<SYS>>\n",
+                "system_tag_end": "\n<</SYS>>\n\n",
+                "user_tag_start": "",
+                "user_tag_end": " [/INST]",
+                "ai_tag_start": "",
+            },
+        )
+        prefix = static_prompt_prefix(
+            prompt, "input", fewshot_examples="Example", diagnostic_criteria=""
+        )
+        for patient in ["Patient A has a fever.", "Patient B"]:
+            self.assertTrue(
+                prompt.format(
+                    input=patient,
+                    fewshot_examples="Example",
+                    diagnostic_criteria="Criteria",
+                ).startswith(prefix + patient)
+            )
+        self.assertTrue(prefix.startswith("<s>[INST] <<SYS>>\nYou are a medical"))
+
+    def test_no_cache(self):
+        self.assertEqual(self.prefix_length(self.prompts[0]), 0)
+        llm = CustomLLM(
+            model_name="gpt-4", openai_api_key="key", max_context_length=128, seed=0
+        )
+        self.assertEqual(llm.cache_prefix(self.prefix), 0)
+        self.assertIsNone(llm.prefix_past_key_values)
+
+
 if __name__ == "__main__":
     unittest.main()
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "responses.db")
+        self.llm = tiny_custom_llm(max_context_length=96, batch_size=4)
+        self.llm.response_cache = ResponseCache(self.path)
+        self.prompts = ["Patient presents with abdominal pain.", "Short", "Fever"]
+
+    def tearDown(self):
+        self.llm.response_cache.close()
+        self.directory.cleanup()
+
+    def test_cached_output(self):
+        expected = self.llm._call(self.prompts[0], ["z"])
+        self.assertEqual(self.llm.response_cache.stats()["misses"], 1)
+        with patch.object(CustomLLM, "_generate_uncached") as _generate_uncached:
+            self.assertEqual(self.llm._call(self.prompts[0], ["z"]), expected)
+        _generate_uncached.assert_not_called()
+        self.assertEqual(
+            self.llm.response_cache.stats(),
+            {"hits": 1, "misses": 1, "hit_rate": 0.5},
+        )
+
+    def test_key_includes_settings(self):
+        self.llm._call(self.prompts[0], ["z"])
+        for prompt, stop, kwargs in [
+            (self.prompts[1], ["z"], {}),
+            (self.prompts[0], ["y"], {}),
+            (self.prompts[0], ["z"], {"repetition_penalty": 1.0}),
+        ]:
+            self.llm._call(prompt, stop, **kwargs)
+        self.assertEqual(self.llm.response_cache.stats()["hits"], 0)
+        self.assertEqual(len(self.llm.response_cache), 4)
+        # Default arguments of _call and generate_batch share their entries
+        self.assertEqual(
+            self.llm.response_cache_key(self.prompts[0], ["z"]),
+            self.llm.response_cache_key(
+                self.prompts[0], ["z"], {"repetition_penalty": 1.2}
+            ),
+        )
+
+    def test_langchain_generate(self):
+        # LLMChain and the agent call the model through LLM.generate
+        expected = self.llm._call(self.prompts[0], ["z"])
+        result = self.llm.generate(self.prompts[:1], stop=["z"])
+        self.assertEqual(result.generations[0][0].text, expected)
+        self.assertEqual(self.llm.response_cache.stats()["hits"], 1)
+
+    def test_persistent(self):
+        expected = self.llm._call(self.prompts[0], ["z"])
+        self.llm.response_cache.close()
+        self.llm.response_cache = ResponseCache(self.path)
+        with patch.object(CustomLLM, "_generate_uncached") as _generate_uncached:
+            self.assertEqual(self.llm._call(self.prompts[0], ["z"]), expected)
+        _generate_uncached.assert_not_called()
+
+    def test_generate_batch(self):
+        expected = [self.llm._call(prompt, ["z"]) for prompt in self.prompts[:2]]
+        with patch.object(
+            CustomLLM, "_generate_batch", wraps=self.llm._generate_batch
+        ) as _generate_batch:
+            outputs = self.llm.generate_batch(self.prompts, ["z"])
+        # Only the prompt that is not cached yet is generated
+        _generate_batch.assert_called_once_with(self.prompts[2:], ["z"])
+        self.assertEqual(outputs[:2], expected)
+        self.assertEqual(
+            self.llm._call(self.prompts[2], ["z"]),
+            outputs[2],
+        )
+        self.assertEqual(self.llm.response_cache.stats()["hits"], 3)
+
+    def test_bypass_self_consistency(self):
+        self.llm.self_consistency = True
+        self.assertIsNone(self.llm.response_cache_key(self.prompts[0], ["z"]))
+        self.llm._call(self.prompts[0], ["z"])
+        self.assertEqual(len(self.llm.response_cache), 0)
+
+    def test_require_probabilities(self):
+        cache = self.llm.response_cache
+        cache.put("a", "Appendicitis")
+        cache.put("b", "Cholecystitis", torch.tensor([[0.5, 0.25]]))
+        self.assertEqual(cache.get("a"), ("Appendicitis", None))
+        self.assertIsNone(cache.get("a", require_probabilities=True))
+        output, probabilities = cache.get("b", require_probabilities=True)
+        self.assertEqual(output, "Cholecystitis")
+        self.assertTrue(torch.equal(probabilities, torch.tensor([[0.5, 0.25]])))
+        self.assertEqual(cache.stats()["misses"], 1)
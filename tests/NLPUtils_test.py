@@ -1,15 +1,80 @@
 import copy
+import os
 import pickle
+import random
+import tempfile
 import unittest
 
+from thefuzz import process, fuzz
+from tokenizers import Tokenizer, models
+from transformers import PreTrainedTokenizerFast
+
 from utils.nlp import (
+    LabTestMatcher,
+    match_fluid,
+    extract_short_and_long_name,
     convert_labs_to_itemid,
     remove_stop_words,
     extract_sections,
     extract_primary_diagnosis,
     create_lab_test_string,
+    parse_doc,
+    keyword_positive,
+    keywords_positive,
+    procedure_checker,
+    calculate_num_tokens,
+    TokenCounter,
+    prompt_segments,
 )
-from tests.DummyData import patient_x
+from tools.utils import itemid_to_field
+from tests.DummyData import patient_x, lab_test_mapping_x
+from tests.DummyLLM import tiny_llama_tokenizer
+
+
+def convert_labs_to_itemid_extract_one(tests, lab_test_mapping_df):
+    # Reference implementation scanning all labels with process.extractOne for every test
+    labels = lab_test_mapping_df["label"].tolist()
+    all_tests = []
+    for test_full in tests:
+        fluid, test_no_fluid = match_fluid(test_full)
+        test_short, test_long = extract_short_and_long_name(test_full)
+        test_match, score = process.extractOne(test_full, labels, scorer=fuzz.ratio)
+        if score < 90:
+            test_match, score = process.extractOne(test_long, labels, scorer=fuzz.ratio)
+            if score < 90:
+                test_match, score = process.extractOne(
+                    test_short, labels, scorer=fuzz.ratio
+                )
+                if score < 100:
+                    test_match = ""
+                    if fluid:
+                        labels_fluid = lab_test_mapping_df[
+                            lab_test_mapping_df["fluid"] == fluid
+                        ]["label"].tolist()
+                        test_match, score = process.extractOne(
+                            test_no_fluid, labels_fluid, scorer=fuzz.ratio
+                        )
+                        if score < 90:
+                            test_match = ""
+
+        if test_match:
+            expanded_tests = lab_test_mapping_df.loc[
+                lab_test_mapping_df["label"] == test_match, "corresponding_ids"
+            ].iloc[0]
+            if fluid:
+                expanded_tests = [
+                    test
+                    for test in expanded_tests
+                    if (itemid_to_field(test, "fluid", lab_test_mapping_df) == fluid)
+                    or (
+                        itemid_to_field(test, "fluid", lab_test_mapping_df)
+                        != itemid_to_field(test, "fluid", lab_test_mapping_df)
+                    )
+                ]
+            all_tests.extend(expanded_tests)
+        else:
+            all_tests.append(test_full)
+    return all_tests
 
 
 class TestNLPUtils(unittest.TestCase):
@@ -443,5 +508,174 @@ secondary diagnoses: portal vein thrombosis, gerd, depression"""
         self.assertEqual(output, expected_output)
 
 
+class TestLabTestMatcher(unittest.TestCase):
+    def setUp(self):
+        # Unmatched tests are logged to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.matcher = LabTestMatcher(lab_test_mapping_x)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_exact_and_panel_match(self):
+        self.assertEqual(
+            convert_labs_to_itemid(["Lipase", "CBC"], lab_test_mapping_x, self.matcher),
+            [50956, 51301, 51279, 51222, 51221, 51265],
+        )
+
+    def test_fluid_match(self):
+        self.assertEqual(
+            convert_labs_to_itemid(
+                ["Urine Creatinine", "Serum Sodium"], lab_test_mapping_x, self.matcher
+            ),
+            [51082, 50983],
+        )
+
+    def test_no_match(self):
+        self.assertEqual(
+            convert_labs_to_itemid(["Troponin T"], lab_test_mapping_x, self.matcher),
+            ["Troponin T"],
+        )
+        with open("no_canonical_names.txt") as f:
+            self.assertEqual(f.read(), "Troponin T\n")
+
+    def test_identical_to_extract_one(self):
+        rng = random.Random(0)
+        labels = lab_test_mapping_x["label"].tolist()
+        prefixes = ["", "", "Blood ", "Urine ", "serum "]
+
+        def typo(label):
+            i = rng.randrange(len(label))
+            return label[:i] + rng.choice("aeiouxyz ") + label[i + 1 :]
+
+        tests = ["", "!!", "(ALT)", "Sodium (Na)", "Hgb (Hemoglobin)"]
+        for _ in range(300):
+            label = rng.choice(labels)
+            test = rng.choice([label, label.upper(), typo(label), typo(typo(label))])
+            tests.append(rng.choice(prefixes) + test)
+
+        for test in tests:
+            self.assertEqual(
+                convert_labs_to_itemid([test], lab_test_mapping_x, self.matcher),
+                convert_labs_to_itemid_extract_one([test], lab_test_mapping_x),
+                test,
+            )
+        # Batched matching of many tests at once
+        self.assertEqual(
+            self.matcher.convert(tests),
+            convert_labs_to_itemid_extract_one(tests, lab_test_mapping_x),
+        )
+
+
+class TestKeywordsPositive(unittest.TestCase):
+    def test_parse_doc_cached(self):
+        text = "Laparoscopic appendectomy and antibiotics."
+        self.assertIs(parse_doc(text), parse_doc(text))
+
+    def test_same_as_keyword_positive(self):
+        sentences = [
+            "Laparoscopic appendectomy, IV fluids and analgesia.",
+            "No antibiotics. Pain management with fluids.",
+            "Conservative treatment with antibiotics",
+            "",
+        ]
+        keywords = ["antibiotic", "fluid", "analgesi", "pain", "Appendectomy"]
+        for sentence in sentences:
+            self.assertEqual(
+                keywords_positive(sentence, keywords),
+                [keyword_positive(sentence, keyword) for keyword in keywords],
+            )
+
+    def test_procedure_checker(self):
+        done_procedures = ["Laparoscopic appendectomy", "Drainage of abscess"]
+        self.assertTrue(procedure_checker([4701, "appendectomy"], done_procedures))
+        self.assertTrue(procedure_checker([4701], [4701]))
+        self.assertFalse(procedure_checker(["colectomy", 4701], done_procedures))
+
+
 if __name__ == "__main__":
     unittest.main()
+
+
+class TestTokenCounter(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = tiny_llama_tokenizer()
+        self.token_counter = TokenCounter(self.tokenizer)
+        self.template = "System prompt\nPatient: {input}\nThoughts: {agent_scratchpad}"
+
+    def test_count_same_as_calculate_num_tokens(self):
+        for text in ["", "Patient presents with pain", "<s>Special"]:
+            self.assertEqual(
+                self.token_counter.count(text),
+                calculate_num_tokens(self.tokenizer, [text]),
+            )
+        # Without the beginning of sentence token
+        self.assertEqual(self.token_counter.count("abc", add_special_tokens=False), 3)
+
+    def test_memoized(self):
+        for _ in range(3):
+            self.token_counter.count("Patient presents with pain")
+        self.assertEqual(
+            self.token_counter.reset_statistics(),
+            {"lookups": 3, "tokenizer_calls": 1},
+        )
+        self.token_counter.count("Patient presents with pain")
+        self.assertEqual(
+            self.token_counter.statistics(), {"lookups": 1, "tokenizer_calls": 0}
+        )
+
+    def test_max_size(self):
+        token_counter = TokenCounter(self.tokenizer, max_size=2)
+        for text in ["a", "b", "a", "c", "a", "b"]:
+            token_counter.count(text)
+        # b was evicted when c was added, a was kept since it was used last
+        self.assertEqual(token_counter.tokenizer_calls, 4)
+
+    def test_prompt_segments(self):
+        steps = ["Action: Imaging", "Observation: {no format}"]
+        segments = prompt_segments(
+            self.template.format, input="Pain", agent_scratchpad=steps
+        )
+        self.assertEqual(
+            segments,
+            ["System prompt\nPatient: ", "Pain", "\nThoughts: "] + steps,
+        )
+        self.assertEqual(
+            "".join(segments),
+            self.template.format(input="Pain", agent_scratchpad="".join(steps)),
+        )
+
+    def test_incremental_counting(self):
+        steps = []
+        for i in range(5):
+            steps.append(f"Action: Laboratory Tests {i}\nObservation: normal")
+            segments = prompt_segments(
+                self.template.format, input="Pain", agent_scratchpad=steps
+            )
+            self.assertEqual(
+                self.token_counter.count_segments(segments),
+                self.token_counter.count("".join(segments)),
+            )
+            self.token_counter.reset_statistics()
+            self.token_counter.exceeds(segments, 10000)
+            # Only the newest step is tokenized
+            self.assertEqual(self.token_counter.tokenizer_calls, 0)
+
+    def test_exceeds_close_to_limit(self):
+        # A tokenizer that merges "ab", so the segments "a" and "b" are one token more than "ab"
+        tokenizer = Tokenizer(models.BPE({"a": 0, "b": 1, "ab": 2}, [("a", "b")]))
+        token_counter = TokenCounter(
+            PreTrainedTokenizerFast(tokenizer_object=tokenizer)
+        )
+        segments = ["a", "b"] * 10
+        self.assertEqual(token_counter.count_segments(segments), 20)
+        # The whole text is tokenized if the sum of the segments is too close to the limit
+        self.assertFalse(token_counter.exceeds(segments, 15))
+        self.assertEqual(token_counter.count("".join(segments)), 10)
+        # Far from the limit the sum of the segments decides
+        calls = token_counter.tokenizer_calls
+        self.assertFalse(token_counter.exceeds(segments, 100))
+        self.assertEqual(token_counter.tokenizer_calls, calls)
@@ -0,0 +1,243 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from models.models import CustomLLM
+from models.openai_async import AsyncOpenAIEngine, OpenAIRequestError, RateLimiter
+
+
+class StubOpenAIServer:
+    """Local stand-in for the chat completions endpoint. Replies with the last message and records all requests."""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.requests = []
+        # Responses returned before the regular ones, e.g. (429, {"Retry-After": "0.2"})
+        self.errors = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests.append((time.monotonic(), request.headers, body))
+        if self.errors:
+            status, headers = self.errors.pop(0)
+            return web.json_response(
+                {"error": {"message": "error"}}, status=status, headers=headers
+            )
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        content = body["messages"][-1]["content"]
+        return web.json_response(
+            {
+                "choices": [{"message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+            }
+        )
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return f"http://127.0.0.1:{port}/v1"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def user_messages(contents):
+    return [[{"role": "user", "content": content}] for content in contents]
+
+
+class TestAsyncOpenAIEngine(unittest.TestCase):
+    def setUp(self):
+        self.engine = None
+        self.server = StubOpenAIServer()
+        self.api_base = self.server.start()
+
+    def tearDown(self):
+        if self.engine is not None:
+            self.engine.close()
+        self.server.stop()
+
+    def create_engine(self, **kwargs):
+        self.engine = AsyncOpenAIEngine(
+            api_key="key", model_name="gpt-4", api_base=self.api_base, **kwargs
+        )
+        return self.engine
+
+    def test_complete_all_in_order(self):
+        engine = self.create_engine(max_concurrency=4)
+        contents = [f"Patient {i}" for i in range(12)]
+        start = time.monotonic()
+        outputs = engine.complete_all(user_messages(contents), temperature=0.0)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(outputs, contents)
+        self.assertEqual(self.server.max_in_flight, 4)
+        # Three rounds of four concurrent requests instead of twelve sequential ones
+        self.assertLess(elapsed, 12 * self.server.delay)
+        _, headers, body = self.server.requests[0]
+        self.assertEqual(headers["Authorization"], "Bearer key")
+        self.assertEqual(body["model"], "gpt-4")
+        self.assertEqual(body["temperature"], 0.0)
+
+    def test_complete_from_threads(self):
+        engine = self.create_engine(max_concurrency=2)
+        outputs = {}
+
+        def complete(i):
+            outputs[i] = engine.complete(user_messages([f"Patient {i}"])[0])
+
+        threads = [threading.Thread(target=complete, args=(i,)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(outputs, {i: f"Patient {i}" for i in range(6)})
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_retry_after(self):
+        engine = self.create_engine()
+        self.server.errors = [
+            (429, {"Retry-After": "0.3"}),
+            (503, {"Retry-After": "0.1"}),
+        ]
+        self.assertEqual(engine.complete(user_messages(["Patient"])[0]), "Patient")
+        times = [request_time for request_time, _, _ in self.server.requests]
+        self.assertEqual(len(times), 3)
+        self.assertGreaterEqual(times[1] - times[0], 0.3)
+        self.assertGreaterEqual(times[2] - times[1], 0.1)
+
+    def test_no_retry_for_client_errors(self):
+        engine = self.create_engine()
+        self.server.errors = [(400, {})]
+        with self.assertRaises(OpenAIRequestError) as context:
+            engine.complete(user_messages(["Patient"])[0])
+        self.assertEqual(context.exception.status, 400)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_max_retries(self):
+        engine = self.create_engine(max_retries=2)
+        self.server.errors = [(500, {"Retry-After": "0"})] * 3
+        with self.assertRaises(OpenAIRequestError):
+            engine.complete(user_messages(["Patient"])[0])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_requests_per_minute(self):
+        # 600 requests per minute refill one request every 0.1s once the initial 600 are used up
+        engine = self.create_engine(requests_per_minute=600)
+        engine.rate_limiter.available["requests"] = 0
+        start = time.monotonic()
+        engine.complete_all(user_messages(["a", "b", "c"]))
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+
+    def test_custom_llm(self):
+        llm = CustomLLM(
+            model_name="gpt-4",
+            openai_api_key="key",
+            openai_api_base=self.api_base,
+            openai_max_concurrency=3,
+            max_context_length=4096,
+            seed=0,
+            tags={
+                "system_tag_start": "<|im_start|>system",
+                "system_tag_end": "<|im_end|>",
+                "user_tag_start": "<|im_start|>user",
+                "user_tag_end": "<|im_end|>",
+                "ai_tag_start": "<|im_start|>assistant",
+                "ai_tag_end": "<|im_end|>",
+            },
+        )
+        # The tiktoken encoding is downloaded on first use, so a whitespace tokenizer stands in for it
+        with mock.patch(
+            "models.models.tiktoken.encoding_for_model",
+            return_value=mock.Mock(encode=str.split),
+        ):
+            llm.load_model(None)
+        self.engine = llm.openai_engine
+
+        prompts = [
+            f"<|im_start|>user\nPatient {i}\nObservation: pain<|im_end|>"
+            for i in range(6)
+        ]
+        self.assertEqual(
+            llm.generate_batch(prompts, stop=[]),
+            [f"Patient {i}\n pain" for i in range(6)],
+        )
+        self.assertEqual(self.server.max_in_flight, 3)
+        self.assertEqual(llm._call(prompts[0], stop=[]), "Patient 0\n pain")
+        _, _, body = self.server.requests[-1]
+        self.assertEqual(body["seed"], 0)
+        self.assertEqual(body["stop"], llm.openai_parameters()["stop"])
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def acquire(self, rate_limiter, num_tokens):
+        original_sleep = asyncio.sleep
+        asyncio.sleep = self.sleep
+        try:
+            asyncio.run(rate_limiter.acquire(num_tokens))
+        finally:
+            asyncio.sleep = original_sleep
+
+    def test_tokens_per_minute(self):
+        rate_limiter = RateLimiter(tokens_per_minute=600, clock=self.clock)
+        self.acquire(rate_limiter, 500)
+        self.assertEqual(self.sleeps, [])
+        # 100 tokens left, the other 200 refill at 10 tokens per second
+        self.acquire(rate_limiter, 300)
+        self.assertAlmostEqual(sum(self.sleeps), 20)
+        # Completion tokens are charged afterwards
+        rate_limiter.consume(60)
+        self.acquire(rate_limiter, 0)
+        self.assertAlmostEqual(sum(self.sleeps), 26)
+
+    def test_request_larger_than_limit(self):
+        rate_limiter = RateLimiter(tokens_per_minute=600, clock=self.clock)
+        self.acquire(rate_limiter, 10000)
+        self.assertEqual(self.sleeps, [])
+
+    def test_block(self):
+        rate_limiter = RateLimiter(requests_per_minute=60, clock=self.clock)
+        rate_limiter.block(5)
+        self.acquire(rate_limiter, 0)
+        self.assertAlmostEqual(sum(self.sleeps), 5)
+
+    def test_no_limits(self):
+        rate_limiter = RateLimiter(clock=self.clock)
+        for _ in range(100):
+            self.acquire(rate_limiter, 10000)
+        self.assertEqual(self.sleeps, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+import tempfile
+import unittest
+from os.path import join, exists
+from unittest.mock import patch
+
+import pandas as pd
+
+from dataset.dataset import load_data, extract_info
+from dataset.parquet_cache import build_parquet_cache, load_data_from_cache, load_table
+from dataset.sharded import extract_info_sharded
+from dataset.utils import load_hadm_from_file
+from tests.DummyMimic import write_dummy_mimic
+
+
+class TestParquetCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.base_mimic = join(cls.tmp.name, "mimic")
+        cls.cache_dir = join(cls.tmp.name, "cache")
+        write_dummy_mimic(cls.base_mimic)
+        # Small chunks so that the conversion of every table spans multiple chunks
+        build_parquet_cache(cls.base_mimic, cls.cache_dir, chunksize=37)
+        cls.csv_tables = load_data(cls.base_mimic)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def assertFrameEquivalent(self, cached, csv):
+        csv = csv.reset_index(drop=True)
+        self.assertEqual(list(cached.columns), list(csv.columns))
+        for column in csv.columns:
+            if pd.api.types.is_numeric_dtype(csv[column]):
+                pd.testing.assert_series_equal(
+                    cached[column], csv[column], check_dtype=False
+                )
+            elif pd.api.types.is_datetime64_any_dtype(cached[column]):
+                # The cache stores parsed datetimes where load_data may still hold strings
+                pd.testing.assert_series_equal(
+                    cached[column], pd.to_datetime(csv[column]), check_dtype=False
+                )
+            else:
+                self.assertEqual(
+                    cached[column].fillna("<NA>").astype(str).tolist(),
+                    csv[column].fillna("<NA>").astype(str).tolist(),
+                )
+
+    def test_load_data_from_cache_matches_load_data(self):
+        cached_tables = load_data_from_cache(self.cache_dir)
+        for cached, csv in zip(cached_tables, self.csv_tables):
+            self.assertFrameEquivalent(cached, csv)
+
+    def test_load_data_from_cache_hadm_filter(self):
+        admissions_df = self.csv_tables[0]
+        hadm_ids = admissions_df["hadm_id"].values[:3]
+        subject_ids = set(admissions_df["subject_id"].values[:3])
+
+        cached_tables = load_data_from_cache(self.cache_dir, hadm_ids=hadm_ids)
+        for cached, csv in zip(cached_tables, self.csv_tables):
+            self.assertFrameEquivalent(cached, csv[csv["subject_id"].isin(subject_ids)])
+
+    def test_load_table_columns_and_filters(self):
+        lab_events_df = self.csv_tables[7]
+        hadm_id = lab_events_df["hadm_id"].dropna().iloc[0]
+
+        cached = load_table(
+            self.cache_dir,
+            "labevents",
+            columns=["hadm_id", "itemid", "valuestr"],
+            hadm_ids=[hadm_id],
+        )
+        expected = lab_events_df[lab_events_df["hadm_id"] == hadm_id]
+        self.assertEqual(list(cached.columns), ["hadm_id", "itemid", "valuestr"])
+        self.assertEqual(cached["itemid"].tolist(), expected["itemid"].tolist())
+        self.assertEqual(cached["valuestr"].tolist(), expected["valuestr"].tolist())
+
+    def test_extract_info_sharded_matches_extract_info(self):
+        (
+            admissions_df,
+            transfers_df,
+            diag_df,
+            procedures_df,
+            discharge_df,
+            radiology_report_df,
+            radiology_report_details_df,
+            lab_events_df,
+            microbiology_df,
+        ) = load_data(self.base_mimic)
+        # Shuffled, since the order determines the admission of events without hadm_id
+        hadm_ids = list(admissions_df["hadm_id"].sample(frac=1.0, random_state=0))
+
+        expected, expected_clean = extract_info(
+            hadm_ids,
+            "appendicitis",
+            ["appendix"],
+            discharge_df,
+            admissions_df,
+            transfers_df,
+            lab_events_df,
+            microbiology_df,
+            radiology_report_df,
+            radiology_report_details_df,
+            diag_df,
+            procedures_df,
+            output_dir=self.tmp.name,
+        )
+        self.assertGreater(len(expected), 0)
+
+        for num_workers in [1, 3]:
+            output, output_clean = extract_info_sharded(
+                hadm_ids,
+                "appendicitis",
+                ["appendix"],
+                self.cache_dir,
+                num_workers=num_workers,
+                output_dir=self.tmp.name,
+            )
+            self.assertEqual(list(output.keys()), list(expected.keys()))
+            self.assertEqual(output, expected)
+            self.assertEqual(output_clean, expected_clean)
+            self.assertEqual(
+                load_hadm_from_file("appendicitis_hadm_info", self.tmp.name), expected
+            )
+
+    def test_extract_info_sharded_postprocessing_error(self):
+        hadm_ids = list(self.csv_tables[0]["hadm_id"])
+        output_dir = join(self.tmp.name, "failed")
+        with patch(
+            "dataset.sharded.postprocess_hadm_info", side_effect=ValueError("failed")
+        ):
+            output, output_clean = extract_info_sharded(
+                hadm_ids,
+                "appendicitis",
+                ["appendix"],
+                self.cache_dir,
+                num_workers=1,
+                output_dir=output_dir,
+            )
+        # As in extract_info, the extracted hadm_info is returned and no files are written
+        self.assertGreater(len(output), 0)
+        self.assertIsNone(output_clean)
+        self.assertFalse(exists(join(output_dir, "appendicitis_hadm_info.pkl")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -373,6 +373,32 @@ class TestPathologyEvaluator(unittest.TestCase):
         self.assertEqual(self.evaluator.answers["Diagnosis"], "Acute Appendicitis")
         self.assertEqual(self.evaluator.scores["Diagnosis Parsing"], 0)
 
+    def test_parse_diagnosis_trace(self):
+        prediction = "Diagnosis:\n1. Acute Appendicitis - inflamed appendix\n2. Cholecystitis\nRationale: RLQ pain"
+
+        self.evaluator.parse_diagnosis(prediction)
+
+        self.assertEqual(self.evaluator.answers["Diagnosis"], "Acute Appendicitis")
+        self.assertEqual(self.evaluator.scores["Diagnosis Parsing"], 1)
+        self.assertEqual(
+            self.evaluator.diagnosis_parsing_trace,
+            ["missing final", "extra sections", "numbered list"],
+        )
+
+        self.evaluator.parse_diagnosis("Final Diagnosis: Acute Appendicitis")
+        self.assertEqual(self.evaluator.diagnosis_parsing_trace, [])
+
+    def test_parse_diagnosis_nested_sections(self):
+        # Notes are removed before other diagnoses, so the start of the other diagnoses section is kept
+        prediction = "Final Diagnosis: Acute Appendicitis Other notes: diagnoses include: Cholecystitis"
+
+        self.evaluator.parse_diagnosis(prediction)
+
+        self.assertEqual(
+            self.evaluator.answers["Diagnosis"], "Acute Appendicitis Other"
+        )
+        self.assertEqual(self.evaluator.scores["Diagnosis Parsing"], 1)
+
     def test_parse_diagnosis_empty(self):
         prediction = "Final Diagnosis:"
 
@@ -0,0 +1,81 @@
+import pickle
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join
+
+from dataset.patient_store import (
+    PatientStore,
+    write_patient_store,
+    convert_hadm_file_to_store,
+    load_patients,
+)
+from dataset.utils import write_hadm_to_file
+from tests.DummyData import patient_x
+
+
+def read_patient(store, _id):
+    return store[_id]
+
+
+class TestPatientStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # Unordered ids to check that the stored order is kept
+        self.hadm_info = {}
+        for i, _id in enumerate([20000003, 20000001, 20000002]):
+            # Reference ranges contain NaNs, which do not compare equal after unpickling
+            patient = {
+                k: v
+                for k, v in patient_x.items()
+                if not k.startswith("Reference Range")
+            }
+            patient["Patient History"] = "Patient {}".format(i)
+            self.hadm_info[_id] = patient
+        self.path = join(self.tmp.name, "hadm_info.db")
+        write_patient_store(self.hadm_info, self.path)
+        self.store = PatientStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_mapping_api(self):
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(list(self.store), [20000003, 20000001, 20000002])
+        self.assertEqual(list(self.store.keys()), list(self.hadm_info.keys()))
+        self.assertEqual(self.store[20000001], self.hadm_info[20000001])
+        self.assertIn(20000002, self.store)
+        self.assertNotIn(20000004, self.store)
+        with self.assertRaises(KeyError):
+            self.store[20000004]
+        self.assertEqual(dict(self.store.items()), self.hadm_info)
+
+    def test_get_many(self):
+        patients = self.store.get_many([20000002, 20000004, 20000003])
+        self.assertEqual(list(patients.keys()), [20000002, 20000003])
+        self.assertEqual(patients[20000003], self.hadm_info[20000003])
+
+    def test_worker_processes(self):
+        # The store is sent to workers without its connection and reopened there
+        store = pickle.loads(pickle.dumps(self.store))
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            patients = list(
+                executor.map(read_patient, [store] * 3, self.hadm_info.keys())
+            )
+        self.assertEqual(patients, list(self.hadm_info.values()))
+
+    def test_load_patients(self):
+        write_hadm_to_file(self.hadm_info, "hadm_info_pickle", self.tmp.name)
+        hadm_info = load_patients("hadm_info_pickle", self.tmp.name)
+        self.assertIsInstance(hadm_info, dict)
+
+        convert_hadm_file_to_store("hadm_info_pickle", self.tmp.name)
+        store = load_patients("hadm_info_pickle", self.tmp.name)
+        self.assertIsInstance(store, PatientStore)
+        self.assertEqual(dict(store.items()), self.hadm_info)
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
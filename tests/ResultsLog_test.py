@@ -0,0 +1,144 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from agents.AgentAction import AgentAction
+from utils.logging import append_to_pickle_file
+from utils.results_log import (
+    ResultsLog,
+    agent_result,
+    convert_results_pickle,
+    read_results,
+)
+
+
+def result(output, num_steps=2):
+    steps = [
+        (
+            AgentAction(
+                tool="Laboratory Tests",
+                tool_input={"action_input": [50912, "Lipase"]},
+                log=f"Action: Laboratory Tests\nAction Input: Creatinine {i}",
+                custom_parsings=i,
+            ),
+            f"Creatinine: {i}.0 mg/dL",
+        )
+        for i in range(num_steps)
+    ]
+    return {"input": "history", "output": output, "intermediate_steps": steps}
+
+
+class TestResultsLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "run_results.jsonl.zst")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_append_and_read(self):
+        results = ResultsLog(self.path)
+        for _id in [3, 1, 2]:
+            results.append(
+                _id,
+                result(f"Final Diagnosis: {_id}"),
+                token_usage={"prompt_tokens": _id},
+                tokenizer_stats={"lookups": _id},
+                timings={"run": 0.5},
+            )
+
+        # A new instance only reads the index
+        results = ResultsLog(self.path)
+        self.assertEqual(list(results), [3, 1, 2])
+        self.assertEqual(len(results), 3)
+        self.assertNotIn(4, results)
+        record = results[1]
+        self.assertEqual(record["prediction"], "Final Diagnosis: 1")
+        self.assertEqual(record["token_usage"], {"prompt_tokens": 1})
+        self.assertEqual(record["tokenizer_stats"], {"lookups": 1})
+        self.assertEqual(record["timings"], {"run": 0.5})
+        self.assertEqual(
+            record["trajectory"][1]["observation"], "Creatinine: 1.0 mg/dL"
+        )
+        with self.assertRaises(KeyError):
+            results[4]
+
+        # The data file is a zstd stream of all records, in the order they were appended
+        self.assertEqual([record["hadm_id"] for record in results.records()], [3, 1, 2])
+
+    def test_agent_result_round_trip(self):
+        results = ResultsLog(self.path)
+        results.append(1, result("Final Diagnosis: Appendicitis"))
+        results.append(2, "Final Diagnosis: Cholecystitis")
+        self.assertEqual(
+            agent_result(results[1]), result("Final Diagnosis: Appendicitis")
+        )
+        self.assertEqual(agent_result(results[2]), "Final Diagnosis: Cholecystitis")
+
+    def test_numpy_round_trip(self):
+        results = ResultsLog(self.path)
+        steps = [
+            (
+                AgentAction(
+                    tool="Laboratory Tests",
+                    tool_input={
+                        "action_input": [np.int64(50912), 51006, np.array([51301])]
+                    },
+                    log="",
+                    custom_parsings=np.int64(1),
+                ),
+                "Creatinine: 1.0 mg/dL",
+            )
+        ]
+        results.append(
+            np.int64(1),
+            {"input": "history", "output": "output", "intermediate_steps": steps},
+            timings={"run": np.float64(0.5)},
+        )
+
+        record = ResultsLog(self.path)[1]
+        # Itemids are read back as ints, so the evaluators can compare them with the itemids of the patient
+        action_input = record["trajectory"][0]["tool_input"]["action_input"]
+        self.assertEqual(action_input, [50912, 51006, [51301]])
+        self.assertIsInstance(action_input[0], int)
+        self.assertEqual(record["trajectory"][0]["custom_parsings"], 1)
+        self.assertEqual(record["timings"], {"run": 0.5})
+
+    def test_unserializable_value(self):
+        results = ResultsLog(self.path)
+        with self.assertRaises(TypeError):
+            results.append(1, "output", timings={"run": object()})
+        self.assertNotIn(1, ResultsLog(self.path))
+
+    def test_latest_record_wins(self):
+        results = ResultsLog(self.path)
+        results.append(1, "first")
+        results.append(1, "second")
+        self.assertEqual(len(ResultsLog(self.path)), 1)
+        self.assertEqual(ResultsLog(self.path)[1]["prediction"], "second")
+
+    def test_interrupted_index_line(self):
+        results = ResultsLog(self.path)
+        results.append(1, "first")
+        with open(results.index_path, "a") as f:
+            f.write("[2, 1")
+        self.assertEqual(list(ResultsLog(self.path)), [1])
+
+    def test_convert_results_pickle(self):
+        pickle_path = os.path.join(self.tmp.name, "run_results.pkl")
+        for _id in [2, 1]:
+            append_to_pickle_file(pickle_path, {_id: result(f"Diagnosis {_id}")})
+        output_path = convert_results_pickle(pickle_path)
+        self.assertEqual(output_path, self.path)
+        self.assertEqual(
+            list(read_results(output_path)), list(read_results(pickle_path))
+        )
+        # Converting again replaces the log instead of appending to it
+        convert_results_pickle(pickle_path)
+        self.assertEqual(len(list(ResultsLog(self.path).records())), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import pickle
+import tempfile
+import unittest
+from copy import deepcopy
+
+from hydra import initialize, compose
+
+from run_sharded import (
+    merge_shard_results,
+    run_sharded,
+    shard_patient_ids,
+    shard_rate_limit,
+    shard_results_path,
+)
+from utils.results_log import ResultsLog
+from tests.Agent_test import FakeLLM, WhitespaceTokenizer
+from tests.DummyData import patient_x, lab_test_mapping_x
+
+
+def fake_llm(args, tags):
+    # Module level, so the spawned workers can unpickle it
+    llm = FakeLLM()
+    llm.load_model(
+        responses=["Final Diagnosis: Appendicitis"], tokenizer=WhitespaceTokenizer()
+    )
+    return llm
+
+
+class TestShardedRun(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patient_ids = [101, 102, 103, 104, 105]
+        with open(
+            os.path.join(self.tmp.name, "appendicitis_hadm_info_first_diag.pkl"), "wb"
+        ) as f:
+            pickle.dump({_id: deepcopy(patient_x) for _id in self.patient_ids}, f)
+        lab_test_mapping_path = os.path.join(self.tmp.name, "lab_test_mapping.pkl")
+        with open(lab_test_mapping_path, "wb") as f:
+            pickle.dump(lab_test_mapping_x, f)
+
+        self.overrides = [
+            f"base_mimic={self.tmp.name}",
+            f"lab_test_mapping_path={lab_test_mapping_path}",
+            f"local_logging_dir={self.tmp.name}",
+            "prefix_cache=False",
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def compose_args(self, *overrides):
+        with initialize(config_path="../configs", version_base=None):
+            return compose(
+                config_name="config", overrides=self.overrides + list(overrides)
+            )
+
+    def read_results(self, path):
+        return dict(ResultsLog(path).agent_results())
+
+    def test_shard_patient_ids(self):
+        shards = shard_patient_ids(self.patient_ids, 2)
+        self.assertEqual(shards, [[101, 103, 105], [102, 104]])
+        self.assertEqual(shard_patient_ids(self.patient_ids, 2), shards)
+        # Shards are disjoint and cover all patients, even with more shards than patients
+        shards = shard_patient_ids(self.patient_ids, 7)
+        self.assertEqual(sorted(sum(shards, [])), self.patient_ids)
+
+    def test_shard_rate_limit(self):
+        self.assertEqual(shard_rate_limit(600, 4), 150)
+        # Limits below the number of workers must not become 0, i.e. unlimited
+        self.assertEqual(shard_rate_limit(3, 4), 1)
+        self.assertIsNone(shard_rate_limit(None, 4))
+
+    def test_merge_shard_results(self):
+        shard_paths = [
+            os.path.join(self.tmp.name, f"shard{i}_results.jsonl.zst") for i in range(3)
+        ]
+        for _id in [104, 102]:
+            ResultsLog(shard_paths[1]).append(_id, f"result {_id}")
+        ResultsLog(shard_paths[0]).append(101, "result 101")
+        # A worker without patients writes no file
+        merged_path = os.path.join(self.tmp.name, "merged_results.jsonl.zst")
+        num_merged = merge_shard_results(shard_paths, merged_path, self.patient_ids)
+
+        self.assertEqual(num_merged, 3)
+        self.assertEqual(list(ResultsLog(merged_path)), [101, 102, 104])
+        self.assertEqual(ResultsLog(merged_path)[104]["prediction"], "result 104")
+
+    def test_single_worker(self):
+        args = self.compose_args("first_patient=102")
+        results_path = run_sharded(args, llm_factory=fake_llm)
+        results = self.read_results(results_path)
+        self.assertEqual(list(results.keys()), [102, 103, 104, 105])
+        self.assertEqual(results[102]["output"], "Final Diagnosis: Appendicitis")
+        record = ResultsLog(results_path)[102]
+        self.assertIn("tokenizer_calls", record["tokenizer_stats"])
+        # The agent answered in a single call with a completion of three words
+        self.assertEqual(record["token_usage"]["llm_calls"], 1)
+        self.assertEqual(record["token_usage"]["completion_tokens"], 3)
+        self.assertGreater(record["token_usage"]["prompt_tokens"], 0)
+        self.assertEqual(set(record["timings"]), {"build", "run"})
+
+    def test_worker_processes(self):
+        args = self.compose_args("num_workers=2")
+        results_path = run_sharded(args, llm_factory=fake_llm)
+
+        run_dir = os.path.dirname(results_path)
+        run_name = os.path.basename(run_dir)
+        shards = [
+            list(self.read_results(shard_results_path(run_dir, run_name, i, 2)).keys())
+            for i in range(2)
+        ]
+        self.assertEqual(shards, [[101, 103, 105], [102, 104]])
+        results = self.read_results(results_path)
+        self.assertEqual(list(results.keys()), self.patient_ids)
+        for result in results.values():
+            self.assertEqual(result["output"], "Final Diagnosis: Appendicitis")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,7 +9,19 @@ from tools.Actions import (
     retrieve_imaging,
 )
 from tools.Tools import RunLaboratoryTests, RunImaging, DoPhysicalExamination
-from tests.DummyData import patient_x
+from tools.utils import (
+    ItemidLookup,
+    itemid_to_field,
+    action_input_pretty_printer,
+    count_matches,
+    KeywordMatcher,
+    MODALITY_EXACT_DICT,
+    MODALITY_SUBSTR_DICT,
+    MODALITY_SPECIAL_CASES_DICT,
+    REGION_EXACT_DICT,
+    REGION_SUBSTR_DICT,
+)
+from tests.DummyData import patient_x, lab_test_mapping_x
 from agents.AgentAction import AgentAction
 
 
@@ -321,5 +333,124 @@ class TestTools(unittest.TestCase):
         self.assertEqual(output, expected_output)
 
 
+class TestItemidLookup(unittest.TestCase):
+    def setUp(self):
+        self.itemid_lookup = ItemidLookup(lab_test_mapping_x)
+
+    def test_same_as_dataframe(self):
+        for itemid in lab_test_mapping_x["itemid"].dropna():
+            for field in ["label", "fluid", "corresponding_ids"]:
+                value = itemid_to_field(itemid, field, self.itemid_lookup)
+                expected = itemid_to_field(itemid, field, lab_test_mapping_x)
+                # Microbiology tests have a nan fluid
+                if expected != expected:
+                    self.assertNotEqual(value, value)
+                else:
+                    self.assertEqual(value, expected)
+
+    def test_first_row_wins(self):
+        df = lab_test_mapping_x.copy()
+        df.loc[len(df)] = df.iloc[0].copy()
+        df.loc[len(df) - 1, "label"] = "Duplicate"
+        self.assertEqual(
+            itemid_to_field(50861, "label", ItemidLookup(df)),
+            "Alanine Aminotransferase (ALT)",
+        )
+
+    def test_unknown_itemid(self):
+        with self.assertRaises(IndexError):
+            itemid_to_field(1, "label", self.itemid_lookup)
+
+    def test_pretty_printer(self):
+        self.assertEqual(
+            action_input_pretty_printer(
+                [51301, "Unknown test", 50912], self.itemid_lookup
+            ),
+            "White Blood Cells, Unknown test, Creatinine",
+        )
+
+    def test_RunLaboratoryTests(self):
+        tool = RunLaboratoryTests(
+            action_results=patient_x,
+            lab_test_mapping_df=lab_test_mapping_x,
+            itemid_lookup=self.itemid_lookup,
+        )
+        output = tool.run(tool_input={"action_input": [51279, 51301]})
+        expected_output = (
+            "Laboratory Tests:\n"
+            f"(Blood) Red Blood Cells: {patient_x['Laboratory Tests'][51279]}\n"
+            f"(Blood) White Blood Cells: {patient_x['Laboratory Tests'][51301]}\n"
+        )
+        self.assertEqual(output, expected_output)
+
+
+class TestKeywordMatcher(unittest.TestCase):
+    def assertSameCounts(
+        self, text, exact_dict={}, substr_dict={}, special_cases_dict={}
+    ):
+        counts = KeywordMatcher(exact_dict, substr_dict, special_cases_dict).count(text)
+        expected = count_matches(text, exact_dict, substr_dict, special_cases_dict)
+        self.assertEqual(counts, expected)
+        self.assertEqual(list(counts), list(expected))
+
+    def test_imaging(self):
+        for text in [
+            "CT Abdomen",
+            "Abdominal ultrasound, CTA of the chest",
+            "Upper GI series",
+            "MRI T2 of the pelvis and ground-glass opacities",
+            "Portable chest x-ray (AP and lateral)",
+            "US of the RUQ",
+            "Action: Cat scan",
+            "",
+        ]:
+            self.assertSameCounts(
+                text,
+                MODALITY_EXACT_DICT,
+                MODALITY_SUBSTR_DICT,
+                MODALITY_SPECIAL_CASES_DICT,
+            )
+            self.assertSameCounts(text, REGION_EXACT_DICT, REGION_SUBSTR_DICT)
+
+    def test_lab_test_names(self):
+        names = [n for n in lab_test_mapping_x["label"].tolist() if len(n) > 1]
+        for text in [
+            "White Blood Cells and Red Blood Cells",
+            "Alanine Aminotransferase (ALT), Creatinine",
+            "whiteblood cells",
+        ]:
+            self.assertSameCounts(text, exact_dict={"names": names})
+
+    def test_word_boundaries(self):
+        self.assertEqual(
+            KeywordMatcher({"CT": ["ct"]}).count("CT, act, ct_"), {"CT": 1}
+        )
+        self.assertEqual(
+            KeywordMatcher(substr_dict={"CT": ["ct"]}).count("CT, act, ct_"),
+            {"CT": 3},
+        )
+
+    def test_overlapping_matches(self):
+        # Matches of the same word do not overlap, matches of different words do
+        self.assertSameCounts("aaaaa", substr_dict={"a": ["aa", "aaa"]})
+        self.assertSameCounts("a a a a", exact_dict={"a": ["a a"]})
+        self.assertSameCounts(
+            "ushers", {"x": ["he", "she", "hers"]}, {"y": ["he", "she"]}
+        )
+
+    def test_regex_words(self):
+        self.assertSameCounts(
+            "u.s. and T1, t2 and tx", MODALITY_EXACT_DICT, MODALITY_SUBSTR_DICT
+        )
+        self.assertSameCounts("(MDRD) MDRD", exact_dict={"names": ["(MDRD)"]})
+
+    def test_not_ascii(self):
+        # re matches "ſ" to "s" case insensitively, str.lower does not
+        self.assertSameCounts(
+            "ultraſound of the cheſt", MODALITY_EXACT_DICT, MODALITY_SUBSTR_DICT
+        )
+        self.assertSameCounts("İleum CT", REGION_EXACT_DICT, REGION_SUBSTR_DICT)
+
+
 if __name__ == "__main__":
     unittest.main()
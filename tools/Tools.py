@@ -5,6 +5,7 @@ from langchain.tools import BaseTool
 import pandas as pd
 
 from tools.Actions import get_action_results, Actions
+from tools.utils import ItemidLookup
 
 
 class LaboratoryTests_Input(BaseModel):
@@ -23,6 +24,7 @@ class RunLaboratoryTests(BaseTool):
     args_schema: Type[BaseModel] = LaboratoryTests_Input
     action_results: Dict = {}
     lab_test_mapping_df: pd.DataFrame = None
+    itemid_lookup: ItemidLookup = None
     include_ref_range: bool = False
     bin_lab_results: bool = False
 
@@ -31,7 +33,7 @@ class RunLaboratoryTests(BaseTool):
             action=Actions.Laboratory_Tests,
             action_results=self.action_results,
             action_input=action_input,
-            lab_test_mapping_df=self.lab_test_mapping_df,
+            lab_test_mapping_df=self.itemid_lookup or self.lab_test_mapping_df,
             include_ref_range=self.include_ref_range,
             bin_lab_results=self.bin_lab_results,
         )
@@ -41,7 +43,7 @@ class RunLaboratoryTests(BaseTool):
             action=Actions.Laboratory_Tests,
             action_results=self.action_results,
             action_input=action_input,
-            lab_test_mapping_df=self.lab_test_mapping_df,
+            lab_test_mapping_df=self.itemid_lookup or self.lab_test_mapping_df,
             include_ref_range=self.include_ref_range,
             bin_lab_results=self.bin_lab_results,
         )
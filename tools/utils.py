@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Union
 
 import pandas as pd
 import re
@@ -599,7 +599,9 @@ UNIQUE_MODALITY_TO_ORGAN_MAPPING = {
 
 
 # Convert action input to string
-def action_input_pretty_printer(obj, lab_test_mapping_df: pd.DataFrame):
+def action_input_pretty_printer(
+    obj, lab_test_mapping_df: Union[pd.DataFrame, "ItemidLookup"]
+):
     # Check if set i.e. lab results
     if isinstance(obj, list):
         obj_str = []
@@ -655,22 +657,209 @@ def count_matches(
     return counts
 
 
+# Characters with a special meaning in patterns. Patterns without them (after unescaping) match a literal string
+REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]|()")
+
+
+def _pattern_literal(pattern: str):
+    """Returns the string a pattern matches if it contains no regex syntax apart from escaped punctuation (e.g.
+    "u\\.s\\."), and None otherwise."""
+    literal = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            # Escapes of letters and digits are classes or anchors such as \d or \b
+            if char.isalnum():
+                return None
+            literal.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in REGEX_SPECIAL_CHARACTERS:
+            return None
+        else:
+            literal.append(char)
+    if escaped or not literal:
+        return None
+    return "".join(literal)
+
+
+def _is_word_char(char: str) -> bool:
+    # Same as \w for ascii characters
+    return char.isalnum() or char == "_"
+
+
+class KeywordMatcher:
+    """
+    Precompiled version of count_matches for fixed dictionaries. The literal words and substrings of all categories
+    are compiled into one Aho-Corasick automaton, so the counts of all categories are found in a single pass over the
+    text instead of one regex scan per word. Words are matched case insensitively and exact words only count at word
+    boundaries, as in count_matches. The special cases are combined into one regex per category.
+
+    Words that are regexes (e.g. "t\\d" or "ground.glass") or not ascii are still counted with their own, precompiled
+    regex. Texts that are not ascii are passed to count_matches, because the case folding of re differs from
+    str.lower for some non-ascii characters.
+
+    Args:
+        exact_dict (Dict): Category to words that must match as whole words
+        substr_dict (Dict): Category to words that may match inside of words
+        special_cases_dict (Dict): Category to patterns. The first category with a match is returned on its own.
+
+    Example:
+        matcher = KeywordMatcher(exact_dict=MODALITY_EXACT_DICT, substr_dict=MODALITY_SUBSTR_DICT)
+        matcher.count("CT abdomen with contrast")  # Same as count_matches with the same dictionaries
+    """
+
+    def __init__(
+        self,
+        exact_dict: Dict = {},
+        substr_dict: Dict = {},
+        special_cases_dict: Dict = {},
+    ):
+        self.exact_dict = exact_dict
+        self.substr_dict = substr_dict
+        self.special_cases_dict = special_cases_dict
+        # Built like in count_matches, so the counts are returned in the same order
+        self.categories = set(list(exact_dict.keys()) + list(substr_dict.keys()))
+
+        self.special_cases = [
+            (category, re.compile("|".join(f"(?:{p})" for p in patterns), re.I))
+            for category, patterns in special_cases_dict.items()
+            if len(patterns)
+        ]
+        self.any_special_case = None
+        if self.special_cases:
+            self.any_special_case = re.compile(
+                "|".join(f"(?:{p.pattern})" for _, p in self.special_cases), re.I
+            )
+
+        # Keys of the automaton are (lowered literal, exact). Every key counts for all categories it was given for
+        self.keys = []
+        self.key_categories = []
+        key_indices = {}
+        self.regexes = []
+        for exact, words_dict in [(True, exact_dict), (False, substr_dict)]:
+            for category, words in words_dict.items():
+                for word in words:
+                    literal = _pattern_literal(word)
+                    if literal is None or not literal.isascii():
+                        pattern = r"\b" + word + r"\b" if exact else word
+                        self.regexes.append((category, self._compile(pattern)))
+                        continue
+                    key = (literal.lower(), exact)
+                    if key not in key_indices:
+                        key_indices[key] = len(self.keys)
+                        self.keys.append(key)
+                        self.key_categories.append([])
+                    self.key_categories[key_indices[key]].append(category)
+        self._build_automaton()
+
+    @staticmethod
+    def _compile(pattern: str):
+        # Invalid patterns raise the same error as count_matches, but only once they are used
+        try:
+            return re.compile(pattern, re.IGNORECASE)
+        except re.error:
+            return pattern
+
+    def _build_automaton(self):
+        self.goto = [{}]
+        self.outputs = [[]]
+        for index, (literal, _) in enumerate(self.keys):
+            node = 0
+            for char in literal:
+                if char not in self.goto[node]:
+                    self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append([])
+                node = self.goto[node][char]
+            self.outputs[node].append(index)
+
+        # Breadth first, so the failure link of every node is set before its children
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.outputs[child] = (
+                    self.outputs[child] + self.outputs[self.fail[child]]
+                )
+
+    def _key_counts(self, text: str) -> Dict[int, int]:
+        """Number of non-overlapping matches of every key, counted from the left like re.findall."""
+        lowered = text.lower()
+        counts = {}
+        match_ends = {}
+        node = 0
+        for end, char in enumerate(lowered, start=1):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for index in self.outputs[node]:
+                literal, exact = self.keys[index]
+                start = end - len(literal)
+                # Overlaps an earlier match of the same key
+                if start < match_ends.get(index, 0):
+                    continue
+                if exact and not (
+                    (start > 0 and _is_word_char(text[start - 1]))
+                    != _is_word_char(text[start])
+                    and _is_word_char(text[end - 1])
+                    != (end < len(text) and _is_word_char(text[end]))
+                ):
+                    continue
+                match_ends[index] = end
+                counts[index] = counts.get(index, 0) + 1
+        return counts
+
+    def count(self, text: str) -> Dict[str, int]:
+        """Returns the same counts as count_matches(text, exact_dict, substr_dict, special_cases_dict)."""
+        if not text.isascii():
+            return count_matches(
+                text, self.exact_dict, self.substr_dict, self.special_cases_dict
+            )
+
+        # If there is a special cases match, return that
+        if self.any_special_case is not None and self.any_special_case.search(text):
+            for category, regex in self.special_cases:
+                if regex.search(text):
+                    return {category: 1}
+
+        counts = {category: 0 for category in self.categories}
+        for index, num_matches in self._key_counts(text).items():
+            for category in self.key_categories[index]:
+                counts[category] += num_matches
+        for category, regex in self.regexes:
+            if isinstance(regex, str):
+                counts[category] += len(re.findall(regex, text, re.IGNORECASE))
+            else:
+                counts[category] += len(regex.findall(text))
+        return counts
+
+
+MODALITY_MATCHER = KeywordMatcher(
+    exact_dict=MODALITY_EXACT_DICT,
+    substr_dict=MODALITY_SUBSTR_DICT,
+    special_cases_dict=MODALITY_SPECIAL_CASES_DICT,
+)
+REGION_MATCHER = KeywordMatcher(
+    exact_dict=REGION_EXACT_DICT, substr_dict=REGION_SUBSTR_DICT
+)
+
+
 def count_radiology_modality_and_organ_matches(text):
-    modality_counts = count_matches(
-        text,
-        exact_dict=MODALITY_EXACT_DICT,
-        substr_dict=MODALITY_SUBSTR_DICT,
-        special_cases_dict=MODALITY_SPECIAL_CASES_DICT,
-    )
+    modality_counts = MODALITY_MATCHER.count(text)
     frequent_modality = max(modality_counts, key=modality_counts.get)
     frequent_modality_count = modality_counts[frequent_modality]
 
     # Count matches of each region
-    organ_counts = count_matches(
-        text,
-        exact_dict=REGION_EXACT_DICT,
-        substr_dict=REGION_SUBSTR_DICT,
-    )
+    organ_counts = REGION_MATCHER.count(text)
     frequent_region = max(organ_counts, key=organ_counts.get)
     frequent_region_count = organ_counts[frequent_region]
 
@@ -688,7 +877,40 @@ def count_radiology_modality_and_organ_matches(text):
     )
 
 
-def itemid_to_field(itemid: int, field: str, lab_test_mapping_df: pd.DataFrame):
-    return lab_test_mapping_df.loc[lab_test_mapping_df["itemid"] == itemid, field].iloc[
-        0
-    ]
+class ItemidLookup:
+    """
+    Precomputed itemid to field mapping of the lab test mapping. Replaces the scan of the whole DataFrame in
+    itemid_to_field with a dict lookup. Build it once per mapping file and share it between the tools, the output
+    parser and the runners.
+
+    Args:
+        lab_test_mapping_df (pd.DataFrame): Lab test mapping with an itemid column
+
+    Example:
+        itemid_lookup = ItemidLookup(lab_test_mapping_df)
+        itemid_to_field(51301, "label", itemid_lookup)
+    """
+
+    def __init__(self, lab_test_mapping_df: pd.DataFrame):
+        self.lab_test_mapping_df = lab_test_mapping_df
+        # Keep the first row of every itemid, as selected by .loc[...].iloc[0]
+        first_rows = lab_test_mapping_df.drop_duplicates("itemid", keep="first")
+        self.fields = {
+            field: dict(zip(first_rows["itemid"], first_rows[field]))
+            for field in lab_test_mapping_df.columns
+        }
+
+    def get(self, itemid: int, field: str):
+        try:
+            return self.fields[field][itemid]
+        except KeyError:
+            # Unknown itemids and fields raise the same errors as the DataFrame lookup
+            return itemid_to_field(itemid, field, self.lab_test_mapping_df)
+
+
+def itemid_to_field(
+    itemid: int, field: str, lab_test_mapping: Union[pd.DataFrame, ItemidLookup]
+):
+    if isinstance(lab_test_mapping, ItemidLookup):
+        return lab_test_mapping.get(itemid, field)
+    return lab_test_mapping.loc[lab_test_mapping["itemid"] == itemid, field].iloc[0]
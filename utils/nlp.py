@@ -1,21 +1,23 @@
-import logging
 from typing import List
 import string
 import copy
+from functools import lru_cache
+from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
 import spacy
 from negspacy.negation import Negex  # noqa: F401
 import nltk
 import re
-from thefuzz import process, fuzz
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz, utils as rf_utils
 from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
-from transformers import LlamaTokenizer, AutoTokenizer
+from transformers import LlamaTokenizer, AutoTokenizer, PreTrainedTokenizerBase
 from exllamav2 import ExLlamaV2Tokenizer
 import tiktoken
 
-from tools.utils import FLUID_MAPPING, itemid_to_field
+from tools.utils import FLUID_MAPPING, ItemidLookup, itemid_to_field
 
 nlp = spacy.load("en_core_sci_lg")
 nlp.add_pipe(
@@ -27,6 +29,13 @@ nlp.add_pipe(
 )
 # nltk.download("stopwords")
 
+# Number of parsed texts kept by parse_doc
+NLP_CACHE_SIZE = 4096
+# Number of texts whose token counts are kept by a TokenCounter
+TOKEN_COUNT_CACHE_SIZE = 4096
+# How far the sum of the token counts of the segments of a text may be from the count of the whole text per segment
+SEGMENT_TOKEN_TOLERANCE = 3
+
 ###
 # Collection of functions for natural language processing utility
 ###
@@ -44,17 +53,34 @@ def treatment_alternative_procedure_checker(operation_keywords, text):
     return False
 
 
-# Makes check if a keyword is positive i.e. occurs and is not negated. For negation check uses the negex algorithm i.e. "No appendicitis" or "No signs of appendicitis" or "Abscence of typical indications of appendicitis"
-def keyword_positive(sentence, keyword):
-    doc = nlp(sentence)
+# Evaluators check many keywords against the same few texts, so parsed docs are cached. Docs must not be modified.
+@lru_cache(maxsize=NLP_CACHE_SIZE)
+def parse_doc(text):
+    return nlp(text)
 
-    for e in doc.ents:
-        if keyword.lower() in e.text.lower():
-            return not e._.negex
 
-    # Just check for keyword in sentence if not found in entities
-    return keyword.lower() in sentence.lower()
-    # return False
+# Makes check if a keyword is positive i.e. occurs and is not negated. For negation check uses the negex algorithm i.e. "No appendicitis" or "No signs of appendicitis" or "Abscence of typical indications of appendicitis"
+def keyword_positive(sentence, keyword):
+    return keywords_positive(sentence, [keyword])[0]
+
+
+# Checks multiple keywords against a single parse of the sentence. Returns one bool per keyword
+def keywords_positive(sentence, keywords):
+    doc = parse_doc(sentence)
+    ents = [(e.text.lower(), e._.negex) for e in doc.ents]
+    sentence_lower = sentence.lower()
+
+    positives = []
+    for keyword in keywords:
+        keyword = keyword.lower()
+        for ent_text, negated in ents:
+            if keyword in ent_text:
+                positives.append(not negated)
+                break
+        else:
+            # Just check for keyword in sentence if not found in entities
+            positives.append(keyword in sentence_lower)
+    return positives
 
 
 def remove_punctuation(input_string):
@@ -78,14 +104,19 @@ def procedure_checker(
     valid_procedures: List,
     done_procedures: List,
 ):
+    valid_procedure_names = []
     for valid_procedure in valid_procedures:
         if type(valid_procedure) == int:
             if valid_procedure in done_procedures:
                 return True
         else:
-            for done_procedure in done_procedures:
-                if keyword_positive(done_procedure, valid_procedure):
-                    return True
+            valid_procedure_names.append(valid_procedure)
+
+    # Parse every done procedure once and check all valid procedures against it
+    if valid_procedure_names:
+        for done_procedure in done_procedures:
+            if any(keywords_positive(done_procedure, valid_procedure_names)):
+                return True
 
 
 # Extract keywords from text using spacy library. Keywords are nouns and adjectives
@@ -127,77 +158,173 @@ def match_fluid(test: str):
 
 
 # Convert list of tests to canonical names. Canonical names are the names used in the lab test mapping file
-def convert_labs_to_itemid(tests: List[str], lab_test_mapping_df: pd.DataFrame):
-    logging.getLogger().setLevel(logging.ERROR)
-    labels = lab_test_mapping_df["label"].tolist()
-    all_tests = []
-    for test_full in tests:
-        fluid, test_no_fluid = match_fluid(test_full)
+class LabCandidates:
+    """Labels to match against, preprocessed once as thefuzz does for every call of process.extractOne."""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.processed_labels = [rf_utils.default_process(l) for l in labels]
+        # First position of every processed label. An exact match always has the highest score of 100.
+        self.exact_matches = {}
+        for i, processed_label in enumerate(self.processed_labels):
+            self.exact_matches.setdefault(processed_label, i)
+
+    def best_matches(self, queries):
+        """Returns (label, score) for every query, identical to process.extractOne(query, labels, scorer=fuzz.ratio)."""
+        results = [None] * len(queries)
+        fuzzy_positions, fuzzy_queries = [], []
+        for i, query in enumerate(queries):
+            processed_query = rf_utils.default_process(query)
+            exact_match = self.exact_matches.get(processed_query)
+            if exact_match is not None:
+                results[i] = (self.labels[exact_match], 100)
+            else:
+                fuzzy_positions.append(i)
+                fuzzy_queries.append(processed_query)
+
+        if fuzzy_queries:
+            # Score all remaining queries against all labels at once. Ties go to the first label, as in extractOne.
+            scores = rf_process.cdist(
+                fuzzy_queries,
+                self.processed_labels,
+                scorer=rf_fuzz.ratio,
+                dtype=np.float64,
+            )
+            best = scores.argmax(axis=1)
+            for i, position in enumerate(fuzzy_positions):
+                results[position] = (
+                    self.labels[best[i]],
+                    int(round(scores[i, best[i]])),
+                )
+        return results
+
 
-        # Extract short and long name
-        test_short, test_long = extract_short_and_long_name(test_full)
+class LabTestMatcher:
+    """
+    Matches requested lab tests to the itemids of the lab test mapping. Builds all lookup structures once, so that a
+    single matcher can be reused for all patients of a run.
+
+    Args:
+        lab_test_mapping_df (pd.DataFrame): Lab test mapping with label, fluid, itemid and corresponding_ids columns
+        itemid_lookup (ItemidLookup): Lookup of the same mapping to share with the tools. Built if not given.
+
+    Example:
+        matcher = LabTestMatcher(lab_test_mapping_df)
+        convert_labs_to_itemid(tests, lab_test_mapping_df, matcher=matcher)
+    """
+
+    def __init__(
+        self, lab_test_mapping_df: pd.DataFrame, itemid_lookup: ItemidLookup = None
+    ):
+        self.lab_test_mapping_df = lab_test_mapping_df
+        self.candidates = LabCandidates(lab_test_mapping_df["label"].tolist())
+        self.fluid_candidates = {
+            fluid: LabCandidates(group["label"].tolist())
+            for fluid, group in lab_test_mapping_df.groupby("fluid", sort=False)
+        }
+
+        # First row of every label, as selected by .loc[...].iloc[0]
+        self.label_to_ids = {}
+        for label, ids in zip(
+            lab_test_mapping_df["label"], lab_test_mapping_df["corresponding_ids"]
+        ):
+            self.label_to_ids.setdefault(label, ids)
+        if itemid_lookup is None:
+            itemid_lookup = ItemidLookup(lab_test_mapping_df)
+        self.itemid_lookup = itemid_lookup
+
+    def match_labels(self, tests: List[str]):
+        """Returns the matched label of every test, or an empty string if no label matched."""
+        parsed = []
+        for test_full in tests:
+            fluid, test_no_fluid = match_fluid(test_full)
+            test_short, test_long = extract_short_and_long_name(test_full)
+            parsed.append((test_full, fluid, test_no_fluid, test_short, test_long))
 
         # Try fuzzy matching to allow for spelling mistakes and small discrepencies. Use ratio because we have many tests that are just one letter that match too strong with partial ratio
         # Start with full name since its hardest to match and has least amount of false positives
-        test_match, score = process.extractOne(test_full, labels, scorer=fuzz.ratio)
-        if score < 90:
-            # If no match, try using the long name.
-            test_match, score = process.extractOne(test_long, labels, scorer=fuzz.ratio)
-            if score < 90:
-                # If no match, try using the short name but look for exact match because a single letter difference typically completely changes the test
-                test_match, score = process.extractOne(
-                    test_short, labels, scorer=fuzz.ratio
-                )
-                if score < 100:
-                    # If no match, try removing the fluid and searching again
-                    if fluid:
-                        labels_fluid = lab_test_mapping_df[
-                            lab_test_mapping_df["fluid"] == fluid
-                        ]["label"].tolist()
-                        test_match, score = process.extractOne(
-                            test_no_fluid, labels_fluid, scorer=fuzz.ratio
+        matches = self.candidates.best_matches([p[0] for p in parsed])
+
+        # If no match, try using the long name.
+        remaining = [i for i, (_, score) in enumerate(matches) if score < 90]
+        long_matches = self.candidates.best_matches([parsed[i][4] for i in remaining])
+        for i, match in zip(remaining, long_matches):
+            matches[i] = match
+
+        # If no match, try using the short name but look for exact match because a single letter difference typically completely changes the test
+        remaining = [i for i in remaining if matches[i][1] < 90]
+        short_matches = self.candidates.best_matches([parsed[i][3] for i in remaining])
+        for i, match in zip(remaining, short_matches):
+            matches[i] = match
+
+        # If no match, try removing the fluid and searching again
+        remaining = [i for i in remaining if matches[i][1] < 100]
+        test_matches = [match for match, _ in matches]
+        for i in remaining:
+            test_full, fluid, test_no_fluid, _, _ = parsed[i]
+            test_matches[i] = ""
+            if fluid and fluid in self.fluid_candidates:
+                test_match, score = self.fluid_candidates[fluid].best_matches(
+                    [test_no_fluid]
+                )[0]
+                if score >= 90:
+                    test_matches[i] = test_match
+
+        return test_matches
+
+    def convert(self, tests: List[str]):
+        all_tests = []
+        for test_full, test_match in zip(tests, self.match_labels(tests)):
+            fluid, _ = match_fluid(test_full)
+
+            # Replace test with full list of valid names if matched
+            if test_match:
+                expanded_tests = self.label_to_ids[test_match]
+
+                # Only include those of specific fluid if specified
+                if fluid:
+                    expanded_tests = [
+                        test
+                        for test in expanded_tests
+                        if (self.itemid_lookup.get(test, "fluid") == fluid)
+                        or (  # If fluid is nan then its a microbio test. TODO: Check against spec_itemid instead
+                            self.itemid_lookup.get(test, "fluid")
+                            != self.itemid_lookup.get(test, "fluid")
                         )
-                        if score < 90:
-                            # Finally, return just test itself. Will not match going forward but saves original intent
-                            test_match = ""
-                            with open("no_canonical_names.txt", "a") as f:
-                                f.write(f"{test_full}\n")
-                    else:
-                        # Finally, return just test itself. Will not match going forward but saves original intent
-                        test_match = ""
-                        with open("no_canonical_names.txt", "a") as f:
-                            f.write(f"{test_full}\n")
-
-        # Replace test with full list of valid names if matched
-        if test_match:
-            expanded_tests = lab_test_mapping_df.loc[
-                lab_test_mapping_df["label"] == test_match, "corresponding_ids"
-            ].iloc[0]
-
-            # Only include those of specific fluid if specified
-            if fluid:
-                expanded_tests = [
-                    test
-                    for test in expanded_tests
-                    if (itemid_to_field(test, "fluid", lab_test_mapping_df) == fluid)
-                    or (  # If fluid is nan then its a microbio test. TODO: Check against spec_itemid instead
-                        itemid_to_field(test, "fluid", lab_test_mapping_df)
-                        != itemid_to_field(test, "fluid", lab_test_mapping_df)
-                    )
-                ]
-            all_tests.extend(expanded_tests)
-        else:
-            all_tests.append(test_full)
-    logging.getLogger().setLevel(logging.INFO)
-    return all_tests
+                    ]
+                all_tests.extend(expanded_tests)
+            else:
+                # Finally, return just test itself. Will not match going forward but saves original intent
+                with open("no_canonical_names.txt", "a") as f:
+                    f.write(f"{test_full}\n")
+                all_tests.append(test_full)
+        return all_tests
+
+
+def convert_labs_to_itemid(
+    tests: List[str], lab_test_mapping_df: pd.DataFrame, matcher=None
+):
+    if matcher is None:
+        matcher = LabTestMatcher(lab_test_mapping_df)
+    return matcher.convert(tests)
 
 
-def remove_stop_words(sentence):
-    nltk_stop_words = set(stopwords.words("english"))
+@lru_cache(maxsize=None)
+def stop_word_sets():
+    """Returns the nltk english stop words without the single letters, and the single letters. Loaded once."""
+    nltk_stop_words = frozenset(stopwords.words("english"))
 
     # Keep uppercase single letters as they often are part of lab tests
-    lowercase_single_letters = {w for w in nltk_stop_words if len(w) == 1}
-    nltk_stop_words = nltk_stop_words - lowercase_single_letters
+    lowercase_single_letters = frozenset(w for w in nltk_stop_words if len(w) == 1)
+    return nltk_stop_words - lowercase_single_letters, lowercase_single_letters
+
+
+SPECIAL_CHARACTERS_REGEX = re.compile(r"[^\w\s]")
+LEADING_A_REGEX = re.compile(r"\bA\s")
+
+
+def remove_stop_words(sentence):
+    nltk_stop_words, lowercase_single_letters = stop_word_sets()
 
     # Split words and keep punctuation
     words_with_punct = sentence.split(" ")
@@ -212,13 +339,13 @@ def remove_stop_words(sentence):
     )
 
     # Remove A if it is the first word
-    filtered_sentence = re.sub(r"\bA\s", "", filtered_sentence)
+    filtered_sentence = LEADING_A_REGEX.sub("", filtered_sentence)
 
     return filtered_sentence
 
 
 def remove_special_characters(word):
-    return re.sub(r"[^\w\s]", "", word)
+    return SPECIAL_CHARACTERS_REGEX.sub("", word)
 
 
 def extract_sections(text, tags_list):
@@ -266,7 +393,7 @@ def extract_primary_diagnosis(text):
     earliest_keyword_index = len(text)
 
     # Do parsing of entire text and check for earliest possible diagnosis
-    doc = nlp(text)
+    doc = parse_doc(text)
     diag = check_ents_for_diagnosis_noun_chunks(doc)
     if diag:
         earliest_keyword_index = min(earliest_keyword_index, text.find(diag))
@@ -276,7 +403,7 @@ def extract_primary_diagnosis(text):
 
     # Do parsing of each line and check for earliest possible diagnosis
     for line in text.split("\n"):
-        doc = nlp(line)
+        doc = parse_doc(line)
         diag = check_ents_for_diagnosis_noun_chunks(doc)
         if diag:
             earliest_keyword_index = min(earliest_keyword_index, text.find(diag))
@@ -342,6 +469,115 @@ def calculate_num_tokens(tokenizer, inputs):
     return num_tokens
 
 
+class TokenCounter:
+    """
+    Counts tokens like calculate_num_tokens, but remembers the count of every text, so that the static parts of a
+    prompt are only tokenized once. Prompts are counted as the sum of their segments, e.g. the system prompt, the
+    patient information and every step of the scratchpad, so that a budget check only tokenizes the text that was not
+    seen before.
+
+    The count of a text can differ from the sum of the counts of its segments by a few tokens at the boundaries of the
+    segments. exceeds therefore tokenizes the whole text if the sum is too close to the limit to decide.
+
+    Args:
+        tokenizer: Tokenizer of the model, as passed to calculate_num_tokens
+        max_size (int): Number of texts whose counts are kept
+
+    Example:
+        token_counter = TokenCounter(llm.tokenizer)
+        segments = prompt_segments(prompt.format, input=patient, agent_scratchpad=thoughts)
+        if token_counter.exceeds(segments, max_context_length - 100):
+            ...
+    """
+
+    def __init__(self, tokenizer, max_size: int = TOKEN_COUNT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.counts = OrderedDict()
+        self.lookups = 0
+        self.tokenizer_calls = 0
+
+    def _encode_length(self, text, add_special_tokens):
+        if isinstance(self.tokenizer, ExLlamaV2Tokenizer):
+            return self.tokenizer.encode(text).shape[-1]
+        # Only transformers tokenizers add special tokens by default
+        if (
+            isinstance(self.tokenizer, PreTrainedTokenizerBase)
+            and not add_special_tokens
+        ):
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        return len(self.tokenizer.encode(text))
+
+    def count(self, text: str, add_special_tokens: bool = True) -> int:
+        """Returns the number of tokens of text, with the same special tokens as calculate_num_tokens by default."""
+        self.lookups += 1
+        key = (text, add_special_tokens)
+        num_tokens = self.counts.get(key)
+        if num_tokens is None:
+            self.tokenizer_calls += 1
+            num_tokens = self._encode_length(text, add_special_tokens)
+            self.counts[key] = num_tokens
+            if len(self.counts) > self.max_size:
+                self.counts.popitem(last=False)
+        else:
+            self.counts.move_to_end(key)
+        return num_tokens
+
+    def count_segments(self, segments: List[str]) -> int:
+        """Estimates the number of tokens of the concatenated segments. Only the first segment gets special tokens."""
+        return sum(
+            self.count(segment, add_special_tokens=(i == 0))
+            for i, segment in enumerate(segments)
+            if segment or i == 0
+        )
+
+    def exceeds(self, segments: List[str], limit: int) -> bool:
+        """Returns whether the concatenated segments have more than limit tokens."""
+        estimate = self.count_segments(segments)
+        if abs(estimate - limit) > SEGMENT_TOKEN_TOLERANCE * len(segments):
+            return estimate > limit
+        return self.count("".join(segments)) > limit
+
+    def statistics(self):
+        return {"lookups": self.lookups, "tokenizer_calls": self.tokenizer_calls}
+
+    def reset_statistics(self):
+        """Returns the statistics since the last reset, e.g. per patient, and starts counting from zero."""
+        statistics = self.statistics()
+        self.lookups = 0
+        self.tokenizer_calls = 0
+        return statistics
+
+
+def prompt_segments(format, **kwargs) -> List[str]:
+    """Formats a prompt like format(**kwargs), but returns it split into the static text between the variables and the
+    values of the variables, so that a TokenCounter counts them separately. Values that are lists of segments
+    themselves are inserted as they are.
+
+    Args:
+        format: The format method of the prompt, e.g. PromptTemplate.format or str.format
+        **kwargs: Values of the variables of the prompt
+
+    Returns:
+        List[str]: Segments whose concatenation is the formatted prompt
+    """
+    names = list(kwargs)
+    placeholders = {name: "\x00{}\x00".format(i) for i, name in enumerate(names)}
+    parts = re.split("\x00(\\d+)\x00", format(**placeholders))
+    segments = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if part:
+                segments.append(part)
+            continue
+        value = kwargs[names[int(part)]]
+        if isinstance(value, list):
+            segments.extend(value)
+        else:
+            segments.append(value)
+    return segments
+
+
 def truncate_text(tokenizer, input, available_tokens):
     if isinstance(tokenizer, ExLlamaV2Tokenizer):
         truncated_input_tokens = tokenizer.encode(input)[:, :available_tokens]
@@ -359,6 +595,21 @@ def truncate_text(tokenizer, input, available_tokens):
     return input
 
 
+def static_prompt_prefix(prompt, variable, **kwargs):
+    """Returns the part of a formatted prompt that comes before the given variable.
+
+    Args:
+        prompt: The PromptTemplate
+        variable (str): First input variable that changes between prompts, e.g. the patient information
+        **kwargs: Values of all other input variables of the prompt
+
+    Returns:
+        str: The prompt text up to the variable
+    """
+    placeholder = "<<{}>>".format(variable)
+    return prompt.format(**{variable: placeholder}, **kwargs).split(placeholder)[0]
+
+
 def create_lab_test_string(
     test_id,
     lab_test_mapping_df,
@@ -0,0 +1,230 @@
+import json
+import os
+import sys
+import threading
+from collections.abc import Mapping
+from os.path import exists
+
+import numpy as np
+import zstandard
+
+from agents.AgentAction import AgentAction
+from utils.logging import read_from_pickle_file
+
+RESULTS_LOG_SUFFIX = "_results.jsonl.zst"
+INDEX_SUFFIX = ".idx"
+
+
+def _json_default(value):
+    # Itemids and values taken from the lab test mapping are numpy scalars. Anything else would silently change type,
+    # e.g. be compared as a string by the evaluators, so it is rejected.
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(type(value).__name__)
+    )
+
+
+def result_record(_id, result, token_usage=None, tokenizer_stats=None, timings=None):
+    """
+    Converts the output of an AgentExecutor into a plain, json serializable record.
+
+    Args:
+        _id: hadm_id of the patient
+        result: Dict with input, output and intermediate_steps returned by the AgentExecutor, or the plain output of
+            the model for run_full_info.py, which has no trajectory
+        token_usage: Number of LLM calls of the agent and their prompt and completion tokens, see
+            TokenUsageCallbackHandler.usage
+        tokenizer_stats: Lookups and tokenizer calls of the token counter of the agent
+        timings: Seconds spent on the patient, e.g. {"build": 0.1, "run": 12.3}
+    """
+    if isinstance(result, str):
+        input, prediction, trajectory = "", result, None
+    else:
+        input, prediction = result["input"], result["output"]
+        trajectory = [
+            {
+                "tool": action.tool,
+                "tool_input": action.tool_input,
+                "log": action.log,
+                # Actions created by langchain itself, e.g. for parsing errors, have no custom parsings
+                "custom_parsings": getattr(action, "custom_parsings", 0),
+                "observation": observation,
+            }
+            for action, observation in result["intermediate_steps"]
+        ]
+    return {
+        "hadm_id": int(_id),
+        "input": input,
+        "prediction": prediction,
+        "trajectory": trajectory,
+        "token_usage": token_usage or {},
+        "tokenizer_stats": tokenizer_stats or {},
+        "timings": timings or {},
+    }
+
+
+def agent_result(record):
+    """Inverse of result_record. Returns the result in the format of the AgentExecutor, as expected by the evaluators."""
+    if record["trajectory"] is None:
+        return record["prediction"]
+    return {
+        "input": record["input"],
+        "output": record["prediction"],
+        "intermediate_steps": [
+            (
+                AgentAction(
+                    tool=step["tool"],
+                    tool_input=step["tool_input"],
+                    log=step["log"],
+                    custom_parsings=step["custom_parsings"],
+                ),
+                step["observation"],
+            )
+            for step in record["trajectory"]
+        ],
+    }
+
+
+class ResultsLog(Mapping):
+    """
+    Appendable, dict-like log of the results of a run, keyed by hadm_id.
+
+    Every record is written as a json line in its own zstd frame, so the data file is a valid zstd stream of the
+    jsonl records and can be appended to without rewriting earlier records. The offset and length of every frame are
+    appended to an index file next to it, so a single patient is read without decompressing the records before it.
+    If a patient is appended again, e.g. by a restarted run, the latest record is returned.
+
+    Args:
+        path (str): Path to the data file, usually <run_name>_results.jsonl.zst. The index is written to path + ".idx".
+        compression_level (int): zstd level used for new records
+
+    Example:
+        results = ResultsLog("appendicitis_ZeroShot_model_results.jsonl.zst")
+        results.append(_id, agent_executor_result, token_usage=..., timings=...)
+        record = results[_id]  # reads only this record
+    """
+
+    def __init__(self, path, compression_level=3):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.compression_level = compression_level
+        # Appends from the threads of a batched run must not interleave
+        self._lock = threading.Lock()
+        self._index = self._read_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _read_index(self):
+        index = {}
+        if exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    try:
+                        _id, offset, length = json.loads(line)
+                    except ValueError:
+                        # Last line of an interrupted append. Its record is incomplete as well.
+                        continue
+                    index[_id] = (offset, length)
+        return index
+
+    def append(self, _id, result, token_usage=None, tokenizer_stats=None, timings=None):
+        """Appends the result of an AgentExecutor (or the output of run_full_info.py) for patient _id."""
+        self.append_record(
+            result_record(_id, result, token_usage, tokenizer_stats, timings)
+        )
+
+    def append_record(self, record):
+        frame = zstandard.ZstdCompressor(level=self.compression_level).compress(
+            json.dumps(record, default=_json_default).encode("utf-8") + b"\n"
+        )
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(frame)
+            # The index is written after the record, so it never points to data that was not written
+            with open(self.index_path, "a") as f:
+                f.write(json.dumps([record["hadm_id"], offset, len(frame)]) + "\n")
+            self._index[record["hadm_id"]] = (offset, len(frame))
+
+    def _read_record(self, f, _id):
+        offset, length = self._index[_id]
+        f.seek(offset)
+        return json.loads(zstandard.ZstdDecompressor().decompress(f.read(length)))
+
+    def __getitem__(self, _id):
+        if _id not in self._index:
+            raise KeyError(_id)
+        with open(self.path, "rb") as f:
+            return self._read_record(f, _id)
+
+    def __contains__(self, _id):
+        return _id in self._index
+
+    def __iter__(self):
+        # Order in which the patients were first appended
+        return iter(list(self._index))
+
+    def __len__(self):
+        return len(self._index)
+
+    def records(self):
+        """Yields all records in order while keeping the data file open."""
+        if not self._index:
+            return
+        with open(self.path, "rb") as f:
+            for _id in list(self._index):
+                yield self._read_record(f, _id)
+
+    def agent_results(self):
+        """Yields (_id, result) with the results in the format of the AgentExecutor, like the results pickles."""
+        for record in self.records():
+            yield record["hadm_id"], agent_result(record)
+
+
+def read_results(results_path):
+    """Yields (_id, result) of a results log or of a results pickle written with append_to_pickle_file."""
+    if results_path.endswith(".pkl"):
+        for entry in read_from_pickle_file(results_path):
+            yield from entry.items()
+    else:
+        yield from ResultsLog(results_path).agent_results()
+
+
+def results_log_path(pickle_path):
+    return (
+        pickle_path.replace("_results.pkl", "").replace(".pkl", "") + RESULTS_LOG_SUFFIX
+    )
+
+
+def convert_results_pickle(pickle_path, output_path=None):
+    """Converts a results pickle written by earlier runs into a ResultsLog. Token counts and timings were not logged
+    in the pickles and are left empty. Returns the path of the results log."""
+    output_path = output_path or results_log_path(pickle_path)
+    for path in [output_path, output_path + INDEX_SUFFIX]:
+        if exists(path):
+            os.remove(path)
+    results = ResultsLog(output_path)
+    for entry in read_from_pickle_file(pickle_path):
+        for _id, result in entry.items():
+            results.append(_id, result)
+    return output_path
+
+
+if __name__ == "__main__":
+    # python -m utils.results_log <results.pkl> [<results.pkl> ...]
+    for pickle_path in sys.argv[1:]:
+        print(
+            "Converted {} to {}".format(
+                pickle_path, convert_results_pickle(pickle_path)
+            )
+        )